@@ -1,5 +1,5 @@
 
-import glob,os,re,math,sys,random
+import glob,os,re,math,sys,random,time
 
 # Should version this... 140813-16 TAW
 # More flexible handling of residue/molecule names
@@ -278,11 +278,15 @@ class ResidueMap:
         self.mod     = mod
 
 
-    def do(self, residue, target=None, coords=False, nterm=False, cterm=False, nt=False, kick=0.05):
+    def do(self, residue, target=None, coords=False, nterm=False, cterm=False, nt=False, kick=0.05, profile=None):
         # Given a set of source atoms with coordinates
         # return the corresponding list of mapped atoms
         # with suitable starting coordinates.
 
+        # If a profile dictionary is given, the time spent on the 
+        # projection and on each type of geometric modification is
+        # added to it.
+
         # If a target list is given, match every atom against
         # the atoms in the ResidueMap. If an atom is not in
         # the definition, then it is returned with the 
@@ -294,6 +298,9 @@ class ResidueMap:
         # added in stead of three if nterm is true and an additional
         # hydrogen will be added at the end if cterm is true.
 
+        if profile is not None:
+            t0 = time.time()
+
         # Unpack first atom
         first, resn, resi, chain, x, y, z = residue[0]
         resn = resn.strip()
@@ -475,10 +482,19 @@ class ResidueMap:
         # Before making modifications, save the raw projection results
         raw = [i for i in out]
 
+        if profile is not None:
+            t1 = time.time()
+            profile["projection"] = profile.get("projection",0) + t1 - t0
+
 
         # Treat special cases: coordinate modifying operations
         for tag,i in self.mod:            
+            if profile is not None:
+                t0 = time.time()
             coord[i[0]] = _do[tag](i[0],i[1:],coord)
+            if profile is not None:
+                t1 = time.time()
+                profile[tag] = profile.get(tag,0) + t1 - t0
             if not coord[i[0]] and i[0] in atomlist:
                 print "Not all positions defined for [%s] in residue %s:" % (tag,resn),
                 print i[0], i[1:], coord.keys()
@@ -7,7 +7,7 @@ authors=["Tsjerk A. Wassenaar"]
 
 ##
 
-import sys, random, math, re, os, itertools
+import sys, random, math, re, os, itertools, time, numpy
 import Mapping
 
 ##
@@ -120,53 +120,10 @@ def kick(x,u):
 ## STAGE 1: READ ATOMISTIC TOPOLOGY ##
 ######################################
 
-# Need to extract moleculetypes, residues and atom lists
-
-
-# Set the pattern for matching files to be included
-includePattern = re.compile('#include "(.*)"')
-
-
-# Gromacs force field directory
-gmxlib = os.environ.get("GMXLIB")
-if not gmxlib:
-    gmxdat = os.environ.get("GMXDATA")
-    if gmxdat:
-        gmxlib = os.path.join(gmxdat,"gromacs","top")
-    else:
-        gmxlib="."
-
-
-# The following function finds and follows #included files
-def reciter(filename):
-    # Set the directory of the filename so we know where to expect #included files
-    dir = os.path.dirname(filename)
-
-    # Iterate over the lines
-    for line in open(filename):
-
-        # Check for an #include statement; yield the line if there is none
-        if line.strip().startswith("#include"):
-            
-            # Extract the #include filename             
-            matches = re.findall(includePattern,line)
-
-            if matches:
-                fr = matches[0]
-
-                if not os.path.exists(fr):
-                    fr = os.path.join(dir,matches[0])
-
-                if not os.path.exists(fr):
-                    fr = os.path.join(gmxlib,matches[0])
-
-                if not os.path.exists(fr):
-                    yield "; " + line + " ; File not found\n"
-                else:
-                    for j in reciter(fr):
-                        yield j
-        else:
-            yield line
+# Need to extract moleculetypes, residues and atom lists.
+# The topology reader from the gmx package keeps molecules as
+# (moleculetype, count) blocks and caches parsed #included files.
+from gmx.top.top import TOP as Topology
 
 ######
 
@@ -316,29 +273,41 @@ def is_terminal(a, b, box, invbox):
 
 
 class Structure:
-    def __init__(self,other,strict=False):
-
-        if type(other) == str:
-            lines = open(other).readlines()
-        else:
-            lines = other
-
-
-        # Try extracting PDB atom/hetatm definitions and set the box
-        self.box = None
-        rest   = []
-        self.atoms  = [pdbAtom(i,strict) for i in lines if isPDBAtom(i) or rest.append(i)]
-        if not self.atoms:             
-            # This should be a GRO file - get the atom count
-            n = int(lines[1])+2
-            self.atoms = [groAtom(i) for i in lines[2:n]]
-            b = [float(i) for i in lines[n].split()] + 6*[0]                 # Padding for rectangular boxes
-            self.box = [[b[0],b[3],b[4]],[b[5],b[1],b[6]],[b[7],b[8],b[2]]]  # Full definition xx,xy,xz,yx,yy,yz,zx,zy,zz
+    def __init__(self,other,strict=False,x=None,box=None,termini=None):
+
+        # Time spent on parts of setting up the frame, for profiling
+        self.timing = {}
+
+        # A new frame for a structure read before can be made by passing 
+        # that structure with a coordinate array (like from a TRR frame).
+        # The termini can be passed as (nterm,cterm) to keep them fixed 
+        # over frames, rather than inferring them from the coordinates.
+        if isinstance(other,Structure):
+            if len(x) != len(other.atoms):
+                raise ValueError("Coordinates given for %d atoms, while the structure has %d."%(len(x),len(other.atoms)))
+            self.box   = box
+            self.atoms = [i[:4]+tuple(j) for i,j in zip(other.atoms,x)]
         else:
-            # Make sure there is a box definition
-            b = [i for i in rest if i.startswith("CRYST1")]
-            if b:
-                self.box = pdbBoxRead(b[-1])
+            if type(other) == str:
+                lines = open(other).readlines()
+            else:
+                lines = other
+
+            # Try extracting PDB atom/hetatm definitions and set the box
+            self.box = None
+            rest   = []
+            self.atoms  = [pdbAtom(i,strict) for i in lines if isPDBAtom(i) or rest.append(i)]
+            if not self.atoms:             
+                # This should be a GRO file - get the atom count
+                n = int(lines[1])+2
+                self.atoms = [groAtom(i) for i in lines[2:n]]
+                b = [float(i) for i in lines[n].split()] + 6*[0]                 # Padding for rectangular boxes
+                self.box = [[b[0],b[3],b[4]],[b[5],b[1],b[6]],[b[7],b[8],b[2]]]  # Full definition xx,xy,xz,yx,yy,yz,zx,zy,zz
+            else:
+                # Make sure there is a box definition
+                b = [i for i in rest if i.startswith("CRYST1")]
+                if b:
+                    self.box = pdbBoxRead(b[-1])
 
 
         # Build a residue list
@@ -360,19 +329,24 @@ class Structure:
         A, B = None, None
         if self.box and not options["-nopbc"]:
             A = zip(*self.box)
+            t = time.time()
 	    try:
                 B = m_inv(A)            
                 self.residues = [ unbreak(i,A,B) for i in self.residues ]
             except ZeroDivisionError:
                 print "Non-invertable box. Not able to unbreak molecules..."
+            self.timing["unbreak"] = time.time()-t
 
 
         # Check for protein chains and breaks
         # List the coordinates for amino acid backbone
         protein     = [ i[0][1].strip() in AminoAcids and get_calpha_xyz(i) for i in self.residues ]
-        termini     = [ is_terminal(i,j,A,B) for i,j in zip([False]+protein,protein+[False]) ]
-        self.nterm  = [ j and i for i,j in zip(termini,    protein) ]
-        self.cterm  = [ j and i for i,j in zip(termini[1:],protein) ]
+        if termini:
+            self.nterm, self.cterm = termini
+        else:
+            termini     = [ is_terminal(i,j,A,B) for i,j in zip([False]+protein,protein+[False]) ]
+            self.nterm  = [ j and i for i,j in zip(termini,    protein) ]
+            self.cterm  = [ j and i for i,j in zip(termini[1:],protein) ]
 
 
         # Set chain backbones based on termini. Begin with a 'chain' unless the first residue is protein.
@@ -465,104 +439,108 @@ class Structure:
             return groBoxLine % (0,0,0,0,0,0,0,0,0)
 
 
-class Topology:
-    def __init__(self,other,out=None):
-        
-        # Process the topology file extract moleculetypes, atom lists and the molecule list
-        self.molecules = []
-        self.top       = []
-
-        # Processed topology
-        # This is equal to the input target topology, but with all #include statements resolved
-        if out:
-            out = open(out,"w")
-
-        # List of line numbers at which to find moleculetype definitions
-        mols     = []
-
-        # Moleculetypes
-        moltypes = []
-
-        # Atoms per moleculetype
-        atoms    = []
-
-        # Gromacs topology directive
-        tag      = re.compile('^ *\[ *(.*) *\]')
-        # Last directive read (current)
-        cur      = None
-        # Set line counter
-        counter = 0
-        # Iterate over lines, processing #included files
-        for line in reciter(other):
-            if out:
-                out.write(line)
-
-            # Increment the line counter
-            counter += 1
-            # Add the line to the (processed) topology
-            self.top.append(line)
-            # Strip leading and trailing spaces
-            s = line.strip()
-            # Lines starting with [ indicate a directive
-            if s.startswith("["):
-                # Extract the directive name
-                cur = re.findall(tag,s)[0].strip()
-                continue
-            # Conditionals :S
-            # Conditionals are simply skipped             
-            if s.startswith("#"):
-                continue            
-            # Strip comments
-            s = s.split(';')[0].strip()
-            # Skip empty lines
-            if not s:
-                continue
-            if cur == "moleculetype":
-                moltypes.append(s.split()[0])
-                atoms.append([])
-                mols.append(counter)
-                continue
-            if cur == "system":
-                mols.append(counter)
-                continue
-            if cur == "atoms":
-                # Comments are already skipped
-                a = s.split()                
-                atoms[-1].append((a[4],a[3],a[2],""))
-                continue
-            if cur == "molecules":
-                # Each molecules entry has a moleculetype name and a number
-                # The moleculetype name is added to the molecules list 
-                # as many times as the number indicates. This makes it easy
-                # to expand the molecules to atoms.
-                m = s.split()
-                for j in range(int(m[1])):
-                    self.molecules.append(m[0])
-
-        if out:
-            out.close()
-
-
-        # Convert moleculetypes to dictionary
-        self.moleculetypes = dict(zip(moltypes,atoms))
+## Trajectory handling - multi-model PDB/GRO files and TRR files
 
-        molecules = [(i,len(list(j))) for i,j in itertools.groupby(self.molecules)]
+def frameLines(filename):
+    """Yield the lines of each frame/model in a PDB or GRO file"""
 
-        # Build a full atom list
-        # The chain identifier is unique for each molecule
-        # The moleculetype name is added as last element
-        mr = zip(self.molecules, range(len(self.molecules)))
-        self.atoms = [[a,r,i,c,0,0,0,t] for t,c in mr for a,r,i,m in self.moleculetypes[t]]
+    stream = open(filename)
+    stored = [stream.readline(), stream.readline()]
 
-        # Build a residue list
-        if self.atoms:
-            self.residues = [[self.atoms[0]]]        
-            for i in self.atoms[1:]:
-                if i[1:4] != self.residues[-1][-1][1:4]:
-                    self.residues.append([])
-                self.residues[-1].append(i)
-        else:
-            self.residues = []
+    if stored[-1].strip().isdigit():
+        # Must be a GRO file. Each frame has a title, an atom count, 
+        # the atoms and a box line.
+        lines = stored
+        while lines and lines[-1].strip():
+            n = int(lines[1])
+            lines.extend([stream.readline() for i in range(n+1)])
+            yield lines
+            lines = [stream.readline(), stream.readline()]
+    else:
+        # Then must be a PDB file. Frames end with ENDMDL. A CRYST1
+        # record given only once is used for all frames.
+        lines, cryst = [], None
+        for i in itertools.chain(stored,stream):
+            if i.startswith("CRYST1"):
+                cryst = i
+            lines.append(i)
+            if i.startswith("ENDMDL"):
+                if cryst and not [j for j in lines if j.startswith("CRYST1")]:
+                    lines.insert(0,cryst)
+                yield lines
+                lines = []
+        if [i for i in lines if isPDBAtom(i)]:
+            yield lines
+
+    stream.close()
+
+
+def trrFrames(filename):
+    """Yield (coordinates, box) for each frame in a TRR file"""
+    from gmx.trr import TRR
+    for frame in TRR(filename):
+        box = frame.box()
+        yield frame.x().tolist(), box is not None and box.tolist() or None
+
+
+## Profiling
+
+class Profile:
+    """
+    Bookkeeping of wall time per stage of the program, time spent on
+    parts of stages (like unbreaking residues), and the mapping cost
+    per residue type. Stages are timed in the main process; the
+    residue statistics and the times of parts done per frame are
+    also collected from worker processes.
+    """
+
+    def __init__(self):
+        self.start    = time.time()
+        self.last     = self.start
+        self.stages   = []
+        self.parts    = {}
+        self.residues = {}
+
+    def stage(self,name):
+        """Close a stage, assigning it the time since the previous one"""
+        now = time.time()
+        self.stages.append((name,now-self.last))
+        self.last = now
+
+    def add(self,name,seconds):
+        self.parts[name] = self.parts.get(name,0) + seconds
+
+    def merge(self,stats):
+        """Add the times of parts and residue statistics, as returned by backmapFrame"""
+        for name, seconds in stats.get("parts",{}).items():
+            self.add(name,seconds)
+        for resn, d in stats.get("residues",{}).items():
+            p = self.residues.setdefault(resn,{})
+            for key, value in d.items():
+                p[key] = p.get(key,0) + value
+
+    def report(self,filename,**extra):
+        """Write a JSON report"""
+        import json, resource
+        residues = {}
+        for resn, d in self.residues.items():
+            residues[resn] = dict(d, mean=d["time"]/max(1,d["count"]))
+        report = {
+            "total":    time.time()-self.start,
+            "stages":   [{"stage": i, "time": j} for i,j in self.stages],
+            "parts":    self.parts,
+            "residues": residues,
+            # Linux reports the maximum resident set size in kB
+            "peak_memory_kb": {
+                "main":    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                }
+            }
+        report.update(extra)
+        f = open(filename,"w")
+        json.dump(report,f,indent=2,sort_keys=True)
+        f.write("\n")
+        f.close()
 
 
 ################################################################################
@@ -613,6 +591,11 @@ options = [
     ("-solname",  Option(str,           1,        "SOL", "Residue name for solvent molecules")),
     ("-kick",     Option(float,         1,            0, "Random kick added to output atom positions")),
     ("-nopbc",    Option(bool,          0,         None, "Don't try to unbreak residues (like when having large residues in a small box)")),
+    ("-trr",      Option(str,           1,         None, "Input TRR trajectory with coordinates for the structure given with -f")),
+    ("-np",       Option(int,           1,            1, "Number of worker processes for backmapping frames and residues")),
+    ("-chunk",    Option(int,           1,            0, "Number of residues per chunk for parallel backmapping (0: automatic)")),
+    ("-seed",     Option(int,           1,         None, "Seed for the random kicks (random if not given)")),
+    ("-profile",  Option(str,           1,         None, "Output JSON report with timings per stage and residue type and peak memory")),
     ]
 
 
@@ -639,6 +622,10 @@ while args:
 
 
 ## DONE PARSING ARGUMENTS ##
+
+
+# Profiling is only done if a report is requested
+profile = options["-profile"] and Profile() or None
     
 
 ################################################################################
@@ -651,17 +638,32 @@ while args:
 
 top = options["-p"] and Topology(options["-p"].value,out=options["-pp"].value)
 
+if profile:
+    profile.stage("topology")
+
 
 ##### B. Read in the structure
 
 
-struc = Structure(options["-f"].value,strict=options["-strict"].value)
+# The first frame is used to set up the mapping. Following frames,
+# from a multi-model PDB/GRO file or from a TRR trajectory, only
+# provide new coordinates.
+if options["-trr"]:
+    frames = None
+    struc  = Structure(options["-f"].value,strict=options["-strict"].value)
+else:
+    frames = frameLines(options["-f"].value)
+    struc  = Structure(frames.next(),strict=options["-strict"].value)
+
+if profile:
+    profile.merge({"parts": struc.timing})
+    profile.stage("structure")
 
 
 ##### C. Set the mapping dictionary
 
 
-# Convert force field tags to lower case 
+# Convert force field tags to lower case
 # Default is backmapping from MARTINI to GROMOS53A6
 # If to_ff == martini, default from_ff = gromos
 to_ff = options["-to"] and options["-to"].value.lower() or "gromos"
@@ -673,54 +675,50 @@ mapping     = Mapping.get(source=from_ff,target=to_ff)
 backmapping = levels[from_ff] > levels[to_ff]
 reslist     = mapping.keys()
 
+if profile:
+    profile.stage("mapping definitions")
+
 
 ##### D. Iterate over atoms to write out, based on residue names
 
 
-# Copy the residue list from the target topology
-# This gives a list we can pop from, while keeping
-# the original.
+# Convert the target topology to an indexed residue table.
+# Residues are consumed by advancing a cursor, rather than by
+# popping from a list, and the atom names of a residue are
+# taken as a slice from the atom table. Whether a residue or
+# molecule has duplicate atom names is determined up front.
 # The solvent residues are skipped.
-topresidues = None
+topres = None
 if top:
-    topresidues = [i for i in top.residues]
+    topatoms = top.atomtable()
+    topres   = top.residuetable()
+    topres["solvent"] = numpy.in1d(topres["resname"],solvent_stuff)
+    topcur   = 0
+    topend   = len(topres["resname"])
     if options["-atomlist"]:
         atm    = open(options["-atomlist"].value,"w")
-        topatm = [j for i in topresidues for j in i]
-        atm.writelines("".join(["%6d %5s %5s\n"%(u,v[0],v[1]) for u,v in zip(range(1,len(topatm)+1),topatm)]))
+        atm.writelines("".join(["%6d %5s %5s\n"%(u,v,w) for u,v,w in zip(range(1,len(topatoms["name"])+1),topatoms["name"],topatoms["resname"])]))
 
 
-# Iterate over residues
-# If we are backmapping, we store the BB bead
-# positions, to generate a spline, which we use
-# afterwards to place the backbone atoms.
-# To set the positions, we use some bookkeeping
-# tricks for the atoms to place on, or relative
-# to, the spline.
-# The backbone list will end up being equal in 
-# length to the number of (amino acid) residues.
-# It is processed afterwards to be three times
-# the length. Indices are used to indicate which
-# entry from the resulting interpolated spline 
-# list need to be taken for the position, and an
-# offset (tuple) is added to control the placement
-# of hydrogens and oxygens to N/C.
+# The residues of the first frame are matched against the mapping
+# definitions and the target topology, which gives the plan: for
+# each residue what to do with it. The plan is applied to every
+# frame. For solvent, the plan lists the residue name, the residue
+# counter and the bead name. For other residues, it lists the
+# residue name from the mapping, the target atom list and whether
+# the residue is N-terminal or C-terminal.
 counter  =  0
-out      = []
-cg       = []
-raw      = []
-sol      = []
-ions     = []
+plan     = []
 msgs     = []
-for residue,bb,nterm,cterm in zip(struc.residues,struc.backbone,struc.nterm,struc.cterm):
+for residue,nterm,cterm in zip(struc.residues,struc.nterm,struc.cterm):
 
 
     counter += 1
 
 
     # Ignore solvent molecules from the topology
-    while topresidues and topresidues[0][0][1] in solvent_stuff:
-        topresidues.pop(0)
+    while topres and topcur < topend and topres["solvent"][topcur]:
+        topcur += 1
 
 
     # Unpack first atom
@@ -734,55 +732,38 @@ for residue,bb,nterm,cterm in zip(struc.residues,struc.backbone,struc.nterm,stru
 
     # Just read one residue from the CG structure
     # If we have a topology, we need to check whether
-    # the residue we just read matches the next in the 
+    # the residue we just read matches the next in the
     # topology. Several cases are possible:
     #
     #   - The residuename is equal in both cases:
     #     This is too easy! Just proceed and thank your deity.
     #
-    #   - The residues do not match, but the CG residuename 
+    #   - The residues do not match, but the CG residuename
     #     matches the AA moleculetype name:
     #     This may happen with lipids, if the atomistic structure
     #     is split in residues like in the De Vries model.
     #     In this case, all residues corresponding to the molecule
-    #     need to be read from the topology, based on the chain 
+    #     need to be read from the topology, based on the chain
     #     identifier.
     #
     #   - The residuename does not match, but the residue does:
-    #     The residues should match, or at least the first 
-    #     characters.      
+    #     The residues should match, or at least the first
+    #     characters.
     #
-    #   - The residue does not match with either the residue or 
+    #   - The residue does not match with either the residue or
     #     moleculetype from the atomistic topology:
     #     If the residue is solvent, then we leave the topology
-    #     untouched, and the atoms are generated based on the 
+    #     untouched, and the atoms are generated based on the
     #     mapping.
 
 
     # Check for solvent
     if resn in solvent.keys():
-        cx, cy, cz = residue[0][4:7]
-        for atom, x, y, z in solvent[resn]:
-            # Should add random rotation
-            if atom in ion_stuff:
-                atom = atoms[0]
-                ions.append((atom,resn,counter,chain,cx+x,cy+y,cz+z)) 
-                # They are added at the end, which is safe, as the
-                # ion position is taken from the CG bead position
-                # anyway.
-            else:
-                # If we do not want solvent written then this is 
-                # a good time to break: the first atom of a stretch
-                # of solvent. Note that this ensures that we write 
-                # ions if we have those.
-                if not options["-sol"]:
-                    break
-                resn = options["-solname"].value
-                # Increase the counter if we have an oxygen.
-                # A little hack to keep track of water molecules
-                if atom[0] == "O":
-                    counter += 1
-                sol.append((atom,resn,counter,chain,cx+x,cy+y,cz+z)) 
+        plan.append(("solvent",resn,counter,atoms[0]))
+        # Increase the counter for each oxygen if we write solvent.
+        # A little hack to keep track of water molecules
+        if options["-sol"]:
+            counter += len([i for i in solvent[resn] if i[0] not in ion_stuff and i[0][0] == "O"])
         # Go to next residue
         continue
 
@@ -790,35 +771,41 @@ for residue,bb,nterm,cterm in zip(struc.residues,struc.backbone,struc.nterm,stru
     # Read a residue from the target topology if we have one
     # Read several if the mapping so requires
     # Make an atom list from the residues read
-    if topresidues:
+    if topres and topcur < topend:
         # Check whether the CG residue corresponds to the next AA residue
-        # or to the next moleculetype 
-        topres = topresidues.pop(0)
-        if resn != topres[0][1] and resn == topres[0][7]:
+        # or to the next moleculetype
+        topresn = str(topres["resname"][topcur])
+        if resn != topresn and resn == topres["moltype"][topcur]:
             # Add residues based on chain id
-            while topresidues and topresidues[0][0][3] == topres[0][3]:
-                topres.extend(topresidues.pop(0))
-        topres = [i for j in range(mapnum.get(resn,1)) for i in topres]
-        # Set the residue name to the moleculetype name
-        topres[0][3] = topres[0][7]
-        target = zip(*topres)[0]
+            stop = topres["molend"][topcur]
+            if topres["first"][topcur]:
+                dup = topres["moldup"][topcur]
+            else:
+                dup = None
+        else:
+            stop = topcur+1
+            dup  = topres["dup"][topcur]
+        target = tuple(topatoms["name"][topres["start"][topcur]:topres["start"][stop]].tolist())
+        topcur = stop
         # Check for duplicate atom names
-        if not len(target) == len(set(target)):
+        # Solvent-like residues mapping to multiple molecules have
+        # the atom list repeated, which always gives duplicates.
+        if dup is None:
+            dup = len(target) != len(set(target))
+        if dup or (target and mapnum.get(resn,1) > 1):
             print "The target list for residue %s contains duplicate names. Relying on mapping file."%resn
             target = None
+        # Except for solvent, the residue name from a topology
+        # takes precedence over the one from the structure.
+        if topresn in mapping.keys():
+            resn = topresn
     else:
         target = None
 
 
-    # Except for solvent, the residue name from a topology 
-    # takes precedence over the one from the structure.
-    if top and topres[0][1] in mapping.keys():
-        resn = topres[0][1]
-
-    
     # Check if the residue is in the list
     # or whether we have an ambiguity.
-    # In that case the first part of the 
+    # In that case the first part of the
     # residue proper is equal to what we have
     # and the atom lists should be equal
     if not resn in reslist:
@@ -845,75 +832,254 @@ for residue,bb,nterm,cterm in zip(struc.residues,struc.backbone,struc.nterm,stru
                             msgs.append(msg)
                         resn = i
                         break
-        
+
 
     if not resn in mapping.keys():
         # If the residue is still not in the mapping list
         # then there is no other choice that to bail out
         raise ValueError, "Unknown residue: %s\n"%resn
-        
- 
-    o, r = mapping[resn].do(residue,target,bb,nterm,cterm,options["-nt"])
-    out.extend(o)
-    raw.extend(r)
+
+
+    plan.append(("map",resn,target,nterm,cterm))
+
+if profile:
+    profile.stage("plan")
+
+
+# Iterate over residues
+# If we are backmapping, we store the BB bead
+# positions, to generate a spline, which we use
+# afterwards to place the backbone atoms.
+# To set the positions, we use some bookkeeping
+# tricks for the atoms to place on, or relative
+# to, the spline.
+# The backbone list will end up being equal in
+# length to the number of (amino acid) residues.
+# It is processed afterwards to be three times
+# the length. Indices are used to indicate which
+# entry from the resulting interpolated spline
+# list need to be taken for the position, and an
+# offset (tuple) is added to control the placement
+# of hydrogens and oxygens to N/C.
+#
+# Every residue gets its own random stream, seeded with the base seed,
+# the frame number and the residue number. This makes the result
+# independent of the way the residues are distributed over processes.
+seed = options["-seed"].value
+if seed is None:
+    seed = random.randint(0,sys.maxint)
+
+def backmapFrame(struc,index=0,start=0,stop=None):
+    """
+    Apply the mapping plan to (a range of residues of) a frame; return
+    out, raw, sol, ions and the statistics if profiling
+    """
+    out      = []
+    raw      = []
+    sol      = []
+    ions     = []
+    stats    = None
+    if profile:
+        stats = {"parts": {}, "residues": {}}
+    todo     = itertools.islice(itertools.izip(struc.residues,struc.backbone,plan),start,stop)
+    for resnum,(residue,bb,step) in enumerate(todo,start):
+
+        random.seed((seed,index,resnum))
+
+        if profile:
+            t = time.time()
+            d = stats["residues"].setdefault(step[1],{"count": 0, "time": 0})
+            d["count"] += 1
+
+        if step[0] == "solvent":
+            # Solvent and ions are placed as idealized configurations
+            # on the bead position.
+            what, resn, counter, name = step
+            chain      = residue[0][3]
+            cx, cy, cz = residue[0][4:7]
+            for atom, x, y, z in solvent[resn]:
+                # Should add random rotation
+                if atom in ion_stuff:
+                    ions.append((name,resn,counter,chain,cx+x,cy+y,cz+z))
+                    # They are added at the end, which is safe, as the
+                    # ion position is taken from the CG bead position
+                    # anyway.
+                else:
+                    # If we do not want solvent written then this is
+                    # a good time to break: the first atom of a stretch
+                    # of solvent. Note that this ensures that we write
+                    # ions if we have those.
+                    if not options["-sol"]:
+                        break
+                    # Increase the counter if we have an oxygen.
+                    if atom[0] == "O":
+                        counter += 1
+                    sol.append((atom,options["-solname"].value,counter,chain,cx+x,cy+y,cz+z))
+            if profile:
+                d["time"] += time.time()-t
+            continue
+
+        what, resn, target, nterm, cterm = step
+        o, r = mapping[resn].do(residue,target,bb,nterm,cterm,options["-nt"],profile=profile and d)
+        out.extend(o)
+        raw.extend(r)
+
+        if profile:
+            d["time"] += time.time()-t
+
+    return out, raw, sol, ions, stats
+
+
+def backmapWorker(item):
+    """Backmap a single frame given as lines or as (coordinates, box)"""
+    index, frame = item
+    if type(frame) == tuple:
+        try:
+            s = Structure(struc,x=frame[0],box=frame[1],termini=(struc.nterm,struc.cterm))
+        except ValueError, e:
+            raise ValueError("Frame %d of %s: %s"%(index,options["-trr"].value,e))
+    else:
+        s = Structure(frame,strict=options["-strict"].value,termini=(struc.nterm,struc.cterm))
+    result = backmapFrame(s,index)
+    # The time for setting up the frame goes with its statistics,
+    # as the frame may have been done in a worker process.
+    if profile:
+        result[4]["parts"].update(s.timing)
+    return result + (s.groBoxString(),)
+
+
+def backmapChunk(bounds):
+    """Backmap a range of residues of the first frame"""
+    return backmapFrame(struc,0,*bounds)
+
+
+def backmapChunked(pool,nres,size):
+    """Backmap the first frame in chunks of residues, using a process pool"""
+    if not size:
+        # Aim for a few chunks per process, to even out the load
+        size = max(1,nres//(4*options["-np"].value)+1)
+    chunks = [(i,min(i+size,nres)) for i in range(0,nres,size)]
+    parts  = pool.map(backmapChunk,chunks)
+    if profile:
+        for part in parts:
+            profile.merge(part[4])
+    # The chunks come back in order; combine them per category
+    return tuple([[j for part in parts for j in part[k]] for k in range(4)])
 
 
 ## Write out
 
-# Combine things
+if backmapping:
+    title = "Backmapped structure from MARTINI to %s\n"%options["-to"].value
+else:
+    title = "Mapped structure from %s to MARTINI\n"%options["-from"].value
+
+def writeFrame(dev,title,atoms,box):
+    """Write a frame in GRO format"""
 
-out.extend(sol)
-out.extend(ions)
-raw.extend(sol)
-raw.extend(ions)
+    # Title and atom count
+    dev.write(title)
+    dev.write("%5d\n"%len(atoms))
+
+    u = options["-kick"].value
+
+    # Atoms
+    idx = 1
+    for atom in atoms:
+        # Regular atom
+        nam,res,id,chn,x,y,z = atom
+        if False and res not in solvent_stuff:
+            x,y,z = kick(x,u),kick(y,u),kick(z,u)
+        dev.write("%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"%(id%1e5,res,nam,idx%1e5,x,y,z))
+        idx += 1
+
+    # Box
+    dev.write(box+"\n")
 
-# Write out
 
 if options["-o"]:
     dev = open(options["-o"].value,"w")
 else:
     dev = sys.stdout
 
-# Title
-if backmapping:
-    dev.write("Backmapped structure from MARTINI to %s\n"%options["-to"].value)
+# Write the "raw" structure obtained by projection
+if options["-raw"]:
+    rawdev = open(options["-raw"].value,"w")
+
+
+# The workers are forked here, after reading the first frame and
+# setting up the plan. This way the structure, the plan and the
+# mapping are shared with the workers, and only the residue ranges
+# for chunks need to be sent.
+if options["-np"].value > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(options["-np"].value)
 else:
-    dev.write("Mapped structure from %s to MARTINI\n"%options["-from"].value)
+    pool = None
 
-# Atom count
-dev.write("%5d\n"%len(out))
 
-u = options["-kick"].value
+# The first frame is done here, and the results are kept for
+# writing the topology and the index file.
+# With a TRR trajectory, the structure only serves to set up the
+# mapping, and all frames written come from the trajectory.
+if pool:
+    out, raw, sol, ions = backmapChunked(pool,len(struc.residues),options["-chunk"].value)
+else:
+    out, raw, sol, ions, stats = backmapFrame(struc)
+    if profile:
+        profile.merge(stats)
+first = out+sol+ions
 
-# Atoms
-idx = 1
-for atom in out:
-    # Regular atom
-    nam,res,id,chn,x,y,z = atom
-    if False and res not in solvent_stuff:
-        x,y,z = kick(x,u),kick(y,u),kick(z,u)
-    dev.write("%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"%(id%1e5,res,nam,idx%1e5,x,y,z))
+if profile:
+    profile.stage("backmapping")
 
-    idx += 1
+if not options["-trr"]:
+    writeFrame(dev,title,first,struc.groBoxString())
+    if options["-raw"]:
+        writeFrame(rawdev,"Projected structure before modifications\n",raw+sol+ions,struc.groBoxString())
 
-# Box
-dev.write(struc.groBoxString()+"\n")
+if profile:
+    profile.stage("output")
+
+
+# The other frames are streamed, possibly using multiple processes.
+if options["-trr"]:
+    frames = trrFrames(options["-trr"].value)
+
+if pool:
+    results = pool.imap(backmapWorker, enumerate(frames,1))
+else:
+    results = itertools.imap(backmapWorker, enumerate(frames,1))
+
+# Frames written
+nframes = not options["-trr"] and 1 or 0
+for o, r, s, i, stats, box in results:
+    if profile:
+        profile.merge(stats)
+        t = time.time()
+    writeFrame(dev,title,o+s+i,box)
+    if options["-raw"]:
+        writeFrame(rawdev,"Projected structure before modifications\n",r+s+i,box)
+    if profile:
+        profile.add("output (frames)",time.time()-t)
+    nframes += 1
+
+if pool:
+    pool.close()
+    pool.join()
 
 # Close if we were writing to file
 if options["-o"]:
     dev.close()
+if options["-raw"]:
+    rawdev.close()
 
+if profile:
+    profile.stage("frames")
 
-# Write the "raw" structure obtained by projection
-if options["-raw"]: 
-    dev = open(options["-raw"].value,"w")
-    dev.write("Projected structure before modifications\n")
-    dev.write("%5d\n"%len(raw))
-    idx = 1
-    for nam,res,id,chn,x,y,z in raw:
-        dev.write("%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"%(id%1e5,res,nam,idx%1e5,x,y,z))
-    idx += 1
-    dev.write(struc.groBoxString()+"\n")
+
+# The following refers to the first frame
+out = first
 
 
 ## Write the output topology
@@ -972,3 +1138,8 @@ if options["-n"]:
     ndx.write("[ Membrane ]\n"+"\n".join([str(i) for i in ndx_membrane])+"\n")
     ndx.write("[ Solvent ]\n"+"\n".join([str(i) for i in ndx_solvent])+"\n")
 
+
+if profile:
+    profile.stage("topology and index output")
+    profile.report(options["-profile"].value,frames=nframes,processes=options["-np"].value,
+                   residues_total=len(struc.residues),atoms_total=len(out))
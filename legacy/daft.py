@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import sys, random, math, os, itertools, numpy
+import sys, random, math, os, itertools, time, numpy
 
 version = "TAW 20140707.2120"
 
@@ -171,36 +171,72 @@ def groAtom(a):
     return (str(a[10:15]), str(a[5:10]), int(a[:5]), " ", float(a[20:28]),float(a[28:36]),float(a[36:44]))
 
 
+# Parsed structures and their descriptors are stored between runs
+# in the directory given by DAFTCACHE, if that is set.
+daftcache = None
+if os.environ.get("DAFTCACHE"):
+    from gmx.cache import Cache, fileTag
+    daftcache = Cache(os.environ["DAFTCACHE"])
+
+
 class Structure:
+    # Attributes stored in the cache file
+    _cached = ("atoms","xyz","xyz0","d","d3","zrange","axes","moments")
+
     def __init__(self,other):
+        self.name = None
         if type(other) == str:
             t = other.find("=") 
-            self.name = None
             if t > -1:
                 self.name = other[:t]
                 other = other[t+1:]            
+            tag = daftcache and fileTag(other)
+            if tag and self.load(tag,os.path.basename(other)):
+                return
             f = open(other)
             lines = f.readlines()
             f.close()
         else:
             lines = other
-            self.name = None
+            tag   = None
         # Try extracting PDB atom/hetatm definitions
         rest   = []
         self.atoms  = [pdbAtom(i) for i in lines if isPDBAtom(i) or rest.append(i)]
         if not self.atoms:             
             # This should be a GRO file
             self.atoms = [groAtom(i) for i in lines[2:-1]]
-        self.x, self.y, self.z = zip(*self.atoms)[4:7]
-        # Center XY
-        mx,my,mz    = [sum(i)/len(i) for i in (self.x,self.y,self.z)]
-        self.x0     = [ i-mx for i in self.x ]
-        self.y0     = [ i-my for i in self.y ]
-        self.z0     = [ i-mz for i in self.z ]
+        self.xyz    = numpy.array([i[4:7] for i in self.atoms])
+        # Center; the mean is summed like before, to keep coordinates equal
+        mean        = [sum(i)/len(i) for i in self.xyz.T.tolist()]
+        self.xyz0   = self.xyz - mean
         # Calculate diameter
-        self.d      = 2*math.sqrt(max([i*i+j*j for i,j in zip(self.x0,self.y0)]))
-        self.d3     = 2*math.sqrt(max([i*i+j*j+k*k for i,j,k in zip(self.x0,self.y0,self.z0)]))
-        self.zrange = (min(self.z0),max(self.z0)) 
+        self.d      = 2*math.sqrt((self.xyz0[:,0]**2+self.xyz0[:,1]**2).max())
+        self.d3     = 2*math.sqrt((self.xyz0**2).sum(axis=1).max())
+        self.zrange = (float(self.xyz0[:,2].min()),float(self.xyz0[:,2].max()))
+        # Principal axes (rows) and moments of the gyration tensor,
+        # with the largest moment first
+        moments, axes = numpy.linalg.eigh(numpy.dot(self.xyz0.T,self.xyz0)/len(self.xyz0))
+        self.moments  = moments[::-1]
+        self.axes     = axes.T[::-1]
+        if tag:
+            daftcache.save(tag,dict([(attr,getattr(self,attr)) for attr in self._cached]),os.path.basename(other))
+
+    def load(self,tag,name):
+        """Set the cached attributes from the disk cache, if the tag matches"""
+        stuff = daftcache.load(tag,name)
+        if stuff is None:
+            return False
+        for attr in self._cached:
+            setattr(self,attr,stuff[attr])
+        return True
+
+    # Coordinates by component, as views on the arrays
+    x  = property(lambda self: self.xyz[:,0])
+    y  = property(lambda self: self.xyz[:,1])
+    z  = property(lambda self: self.xyz[:,2])
+    x0 = property(lambda self: self.xyz0[:,0])
+    y0 = property(lambda self: self.xyz0[:,1])
+    z0 = property(lambda self: self.xyz0[:,2])
 
     def __len__(self):
         return len(self.x)
@@ -224,6 +260,69 @@ class Structure:
         return out
         
 
+def quaternionMatrices(a,b,c):
+    """Rotation matrices (n,3,3) for arrays of random numbers, as used in randrotate3D"""
+    s,  t           = numpy.sqrt(1-a), numpy.sqrt(a)
+    qw, qx, qy, qz  = 2*s*numpy.sin(b), s*numpy.cos(b), t*numpy.sin(c), t*numpy.cos(c)
+    qq              = 0.25*qw*qw-qx*qx-qy*qy-qz*qz
+    # v' = 2(q.v)q + qq v + qw (q x v)
+    q = numpy.array((qx,qy,qz)).T
+    R = 2*q[:,:,None]*q[:,None,:] + qq[:,None,None]*numpy.eye(3)
+    R[:,0,1] -= qw*qz
+    R[:,0,2] += qw*qy
+    R[:,1,0] += qw*qz
+    R[:,1,2] -= qw*qx
+    R[:,2,0] -= qw*qy
+    R[:,2,1] += qw*qx
+    return R
+
+
+def planeMatrices(r,i=0,j=1):
+    """Rotation matrices (n,3,3) for arrays of angles, rotating in the plane of axes i and j"""
+    c, s = numpy.cos(r), numpy.sin(r)
+    R = numpy.zeros((len(r),3,3))
+    R[:,0,0] = R[:,1,1] = R[:,2,2] = 1
+    R[:,i,i], R[:,i,j] = c, -s
+    R[:,j,i], R[:,j,j] = s,  c
+    return R
+
+
+# Packed output: all replicas of a combination are written to a single
+# file, with an index file (.idx) listing the replica number, the offset
+# and the size of each. The replicas are stored exactly as they would be
+# written to separate files, so a replica can be read directly, using 
+# the offset, and extracted to the same file it would have been.
+def readPackIndex(filename):
+    if not os.path.exists(filename):
+        return []
+    return [tuple([int(j) for j in i.split()]) for i in open(filename) if i.strip() and not i.startswith(";")]
+
+
+def unpack(filename,num=None):
+    """Extract a replica to stdout, or all replicas to their own directories"""
+    index = readPackIndex(filename+".idx")
+    pack  = open(filename,"rb")
+    base  = filename[:filename.rfind(".")]+"-%04d"
+    fnm   = os.path.basename(filename)
+    for k,offset,size in index:
+        if num is not None and k != num:
+            continue
+        pack.seek(offset)
+        text = pack.read(size)
+        if num is not None:
+            sys.stdout.write(text)
+            break
+        if not os.path.exists(base%k):
+            os.mkdir(base%k)
+        f = open(os.path.join(base%k,fnm),"w")
+        f.write(text)
+        f.close()
+    else:
+        if num is not None:
+            raise IndexError, "Replica %d not in %s"%(num,filename)
+    pack.close()
+
+
 # Very simple option class
 class Option:
     def __init__(self,func=str,num=1,default=None,description=""):
@@ -270,6 +369,11 @@ options = [
     ("-3d",   Option(bool,         0,        None, "Rotations in three dimensions")),
     ("-ads",  Option(float,        1,        None, "Membrane adsorption at distance specified")),
     ("-mem",  Option(float,        1,         5.0, "Membrane thickness for adsorption")),
+    ("-np",   Option(int,          1,           1, "Number of processes for building combinations (0: number of CPUs)")),
+    ("-seed", Option(int,          1,        None, "Random seed; each combination gets its own stream from it")),
+    ("-pack", Option(bool,         0,        None, "Write the replicas of a combination to a single file, with an index")),
+    ("-unpack", Option(str,        1,        None, "Extract replicas from a packed file to their directories")),
+    ("-k",    Option(int,          1,        None, "Replica to extract to standard output with -unpack")),
     ]
 
 args = sys.argv[1:]
@@ -303,6 +407,11 @@ if options["-F"]:
         options[ar].setvalue([stuff.pop(0) for i in range(options[ar].num)])
         
 
+if options["-unpack"]:
+    unpack(options["-unpack"].value,options["-k"].value)
+    sys.exit()
+
+
 if not options["-o"]:
     options["-o"].setvalue([options["-name"].value+".pdb"])
 if not options["-ndx"]:
@@ -386,9 +495,24 @@ _vectors   = [ [mvmul(r,u) for u in v] for r,v in zip(_rotations, vectors) ]
 # Write a list of structures with IDs and tags
 
 
-combi = list(stuff)
-combi.sort()
-for combination in combi:
+# Coordinate arrays to rotate for each item, made once and shared by 
+# all combinations. For rotations in 3D, the centered coordinates are 
+# used. Otherwise z is kept.
+if options["-3d"]:
+    itemCoords = [j.xyz0 for j in items]
+else:
+    itemCoords = [numpy.column_stack((j.xyz0[:,:2],j.xyz[:,2])) for j in items]
+
+
+# Build the structures for a single combination. The combinations are
+# independent, and are processed in parallel if requested. The items 
+# are parsed before, and are shared with the worker processes by 
+# forking. Each combination seeds the random generator with its own
+# seed, so the results do not depend on the order of processing.
+def buildCombination(task):
+    combination, seed = task
+    start = time.time()
+
     tags = [items[j].name or str(j) for j in combination]
     assayDir = "-".join(tags)
 
@@ -439,77 +563,146 @@ for combination in combi:
     base = os.path.join(assayDir,base)+"-%04d"
     fnm  = options["-o"] and options["-o"].value or base+".pdb"
 
-    # Skip existing directories; allow extending existing runs
-    num     = 1
-    while os.path.exists(base%num):
-        num += 1
+    if options["-pack"]:
+        # Continue the numbering from the packed file
+        packName = os.path.join(assayDir,fnm)
+        index    = readPackIndex(packName+".idx")
+        num      = index and index[-1][0]+1 or 1
+        pack     = open(packName,"ab")
+        pack.seek(0,2)
+        packed   = []
+        target   = packName
+    else:
+        # Skip existing directories; allow extending existing runs
+        num     = 1
+        while os.path.exists(base%num):
+            num += 1
+        target  = os.path.join(base,fnm)
 
-    # Print the fnm, the item numbers and the starting number of the directory
-    print "@ %s %d %d :"%(os.path.join(base,fnm),num,num+options["-n"].value), " ".join([str(j+1) for j in combination])   
+    # Report the fnm, the item numbers and the starting number of the directory
+    report = "@ %s %d %d : %s"%(target,num,num+options["-n"].value," ".join([str(j+1) for j in combination]))
+
+    # The first replica number is part of the seed, so that extending
+    # a run with the same seed gives new replicas.
+    random.seed(seed+(num,))
 
     groline = "%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"
     pdbline = "ATOM  %5i %-3s %3s%2s%4i%1s   %8.3f%8.3f%8.3f%6.2f%6.2f\n"
 
-    for i in xrange(options["-n"].value):
-        id  = 1
-        p   = random.sample(positions,n)
-
-        itemDir = base%num
-        os.mkdir(itemDir)
-        
-        f = open(os.path.join(itemDir,fnm),"w")
-        f.write("MODEL %8d\n"%num)
-        f.write(pdbBoxString(box)+"\n")
-
-        for j in [items[k] for k in combination]:
-            u,v = p.pop()
-
-            # Random rotation
+    # The atom lines only differ in the coordinates between replicas.
+    # A single format string is made for the whole model, with the
+    # coordinates left to fill in.
+    model = []
+    id    = 1
+    for j in [items[k] for k in combination]:
+        for a in j.atoms:
+            model.append((pdbline[:30]%(id,a[0],a[1],a[3],a[2]," ")).replace("%","%%"))
+            model.append(pdbline[30:45]+pdbline[45:]%(1,0))
+            id += 1
+        model.append("TER\nENDMDL\n")
+    model = "".join(model)
+
+    # Coordinates to rotate for each item
+    coords = [itemCoords[k] for k in combination]
+
+    # The replicas are done in chunks, rotating all structures of a
+    # chunk at once. The random numbers are drawn one replica at a 
+    # time, in the same order as when doing the rotations one by one.
+    nrep  = options["-n"].value
+    chunk = max(1,1000000/max(1,sum([len(i) for i in coords])))
+    for first in xrange(0,nrep,chunk):
+        reps  = range(first,min(nrep,first+chunk))
+        draws = []
+        for i in reps:
+            p = random.sample(positions,n)
+            row = []
+            for k in combination:
+                u,v = p.pop()
+                if options["-3d"]:
+                    row.append((u,v,random.random(),2*math.pi*random.random(),2*math.pi*random.random()))
+                else:
+                    row.append((u,v,random.random()*math.pi*2))
+            draws.append(row)
+
+        # Rotated and translated coordinates for each item: (replicas, atoms, 3)
+        xyz = []
+        for m,X in enumerate(coords):
+            d    = numpy.array([row[m] for row in draws])
+            off  = numpy.zeros((len(reps),3))
             if options["-3d"]:
-                
-                for x,y,z,a in j.randrotate3D():
-                    if not options["-ads"].value is None:
-                        z += halfz
-                    f.write(pdbline%(id,a[0],a[1],a[3],a[2]," ",10*x,10*y,10*z,1,0))
-                    id += 1
-
+                R = quaternionMatrices(d[:,2],d[:,3],d[:,4])
+                off[:,0], off[:,1] = d[:,0]*D, d[:,1]*D
+                if not options["-ads"].value is None:
+                    off[:,2] = halfz
             elif not options["-ads"].value is None:
                 # Random rotation around X (parallel to membrane)
-                r   = random.random()*math.pi*2
-                c,s = math.cos(r), math.sin(r)        
-       
-                for x,y,z,a in zip(j.x0,j.y0,j.z,j.atoms):
-                    #     position    rotation
-                    yn =    u*D   +   c*y-s*z
-                    zn =    v*D   +   s*y+c*z
-
-                    # Print the line; mind the conversion from nanometer to angstrom
-                    f.write(pdbline%(id,a[0],a[1],a[3],a[2]," ",10*x,10*yn,10*(zn+halfz),1,0))
-                    id += 1
-
+                R = planeMatrices(d[:,2],1,2)
+                off[:,1], off[:,2] = d[:,0]*D, d[:,1]*D + halfz
             else:
                 # Random rotation in XY-plane
-                r   = random.random()*math.pi*2
-                c,s = math.cos(r), math.sin(r)        
-       
-                for x,y,z,a in zip(j.x0,j.y0,j.z,j.atoms):
-                    #     position    rotation
-                    xn =    u*D   +   c*x-s*y
-                    yn =    v*D   +   s*x+c*y
-
-                    # Print the line; mind the conversion from nanometer to angstrom
-                    f.write(pdbline%(id,a[0],a[1],a[3],a[2]," ",10*xn,10*yn,10*z,1,0))
-                    id += 1
-
-            f.write("TER\nENDMDL\n")
-        f.close()
-        num += 1
-
-
-
-
+                R = planeMatrices(d[:,2],0,1)
+                off[:,0], off[:,1] = d[:,0]*D, d[:,1]*D
+            # Mind the conversion from nanometer to angstrom
+            xyz.append(10*(numpy.einsum('rij,aj->rai',R,X) + off[:,None,:]))
+        xyz = numpy.concatenate(xyz,axis=1)
+
+        for i in range(len(reps)):
+            text = "MODEL %8d\n"%num + pdbBoxString(box)+"\n" + model%tuple(xyz[i].ravel().tolist())
+            if options["-pack"]:
+                packed.append((num,pack.tell(),len(text)))
+                pack.write(text)
+            else:
+                itemDir = base%num
+                os.mkdir(itemDir)
+                f = open(os.path.join(itemDir,fnm),"w")
+                f.write(text)
+                f.close()
+            num += 1
 
+    if options["-pack"]:
+        pack.close()
+        idx = open(packName+".idx","a")
+        if not index:
+            idx.write("; %6s %12s %10s\n"%("replica","offset","size"))
+        idx.writelines(["%8d %12d %10d\n"%i for i in packed])
+        idx.close()
 
+    return report, nrep, time.time()-start
 
 
+combi = list(stuff)
+combi.sort()
 
+# The seed for a combination is made from the base seed and the items,
+# and the number of the first replica (see buildCombination).
+# Without a seed given, the base seed is random.
+seed  = options["-seed"].value
+if seed is None:
+    seed = random.randint(0,sys.maxint)
+tasks = [(combination,(seed,)+combination) for combination in combi]
+
+nproc = options["-np"].value
+if nproc != 1:
+    import multiprocessing
+    nproc   = nproc or multiprocessing.cpu_count()
+    pool    = multiprocessing.Pool(nproc)
+    results = pool.imap(buildCombination,tasks)
+else:
+    pool    = None
+    results = itertools.imap(buildCombination,tasks)
+
+start  = time.time()
+total  = 0
+for i,(report,count,seconds) in enumerate(results):
+    print report
+    sys.stdout.flush()
+    total += count
+    sys.stderr.write("[%d/%d] %d structures in %.2f s: %s\n"%(i+1,len(tasks),count,seconds,report.split()[1]))
+
+if pool:
+    pool.close()
+    pool.join()
+
+elapsed = time.time() - start
+sys.stderr.write("Built %d structures for %d combinations in %.2f s (%.1f structures/s, %d process%s)\n"%
+                 (total,len(tasks),elapsed,elapsed and total/elapsed or 0,nproc,nproc>1 and "es" or ""))
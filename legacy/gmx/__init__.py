@@ -6,7 +6,7 @@ import gzip
 
 from tpr   import TPR
 from trr   import TRR
-from conf  import CONF,PDB,GRO
+from conf  import CONF,PDB,GRO,Trajectory
 from top   import TOP
 from index import Index
 
@@ -17,12 +17,12 @@ class GMXIOError(Exception):
 
 
 _loaders = [
-    (".pdb",    PDB),
-    (".pdb.gz", PDB),
-    (".ent",    PDB),
-    (".ent.gz", PDB),
-    (".gro",    GRO),
-    (".gro.gz", GRO),
+    (".pdb",    Trajectory),
+    (".pdb.gz", Trajectory),
+    (".ent",    Trajectory),
+    (".ent.gz", Trajectory),
+    (".gro",    Trajectory),
+    (".gro.gz", Trajectory),
     (".trr",    TRR),
     (".tpr",    TPR),
     (".ndx",    Index),
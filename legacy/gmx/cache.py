@@ -0,0 +1,77 @@
+
+import os, hashlib, tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Disk cache for data derived from files (parsed topologies, frame
+# offsets, ...) or from other input (DSSP results), to reuse between
+# runs. The cache is opt-in: it is only used if a directory is given,
+# normally through an environment variable. Every entry is stored with
+# a tag describing the input it was derived from, and is only used if
+# the tag matches on loading.
+
+
+def fileTag(filename):
+    """Tag for a file, changing if the file is modified"""
+    path = os.path.abspath(filename)
+    st   = os.stat(path)
+    return "%s-%d-%d" % (path, int(1e6*st.st_mtime), st.st_size)
+
+
+class Cache:
+    def __init__(self, directory=None, suffix=".pkl"):
+        self.directory = directory or None
+        self.suffix    = suffix
+
+    @classmethod
+    def environ(cls, variable, suffix=".pkl"):
+        """Cache in the directory given by an environment variable, if it is set"""
+        return cls(os.environ.get(variable), suffix)
+
+    def __nonzero__(self):
+        return self.directory is not None
+
+    def filename(self, tag, name=""):
+        """Name of the cache file for a tag, with an optional readable part"""
+        key = hashlib.md5(tag).hexdigest()[:16]
+        if name:
+            key = "%s-%s" % (key, name)
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, tag, name=""):
+        """Return the data stored for the tag, or None"""
+        if self.directory is None:
+            return None
+        try:
+            with open(self.filename(tag, name), "rb") as f:
+                stored, data = pickle.load(f)
+        except Exception:
+            return None
+        if stored != tag:
+            return None
+        return data
+
+    def save(self, tag, data, name=""):
+        """Store the data for the tag; failures are ignored"""
+        if self.directory is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first, to not leave broken
+            # cache files if something goes wrong. The name is unique
+            # for concurrent processes and threads.
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump((tag, data), f, 2)
+                os.rename(tmp, self.filename(tag, name))
+            except:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError, pickle.PicklingError):
+            pass
@@ -3,4 +3,5 @@
 from strucstream import strucStream as CONF
 from gro import groFrameIterator as GRO
 from pdb import pdbFrameIterator as PDB
+from trajectory import Trajectory
 
@@ -1,7 +1,8 @@
 
 from structure import Structure
+from reader    import openStream, charMatrix, column, numbers, Ring
 
-import numpy, gzip
+import numpy, itertools
 
 groline = "%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"                                    
 
@@ -38,18 +39,25 @@ def groAtom(a,prec=None):
 
 
 
-# Simple GRO iterator
-def groFrameIterator(stream):
-    """Read a GRO file stream frame by frame"""
+# GRO frame iterator
+def groFrameIterator(stream,ring=0):
+    """
+    Read a GRO file stream frame by frame. The atom lines of each
+    frame are read in one block and converted column-wise. The
+    coordinates go into preallocated arrays if ring is set (see
+    reader.Ring). The atom data are shared between frames if they
+    do not change.
+    """
 
-    if type(stream) == str:
-        if stream.endswith(".gz"):
-            stream = gzip.open(stream)
-        else:
-            stream = open(stream)
+    stream = openStream(stream)
+    buffer = Ring(ring)
 
-    # For efficiency, we need to know the precision
-    precision = None
+    # The atom data of the previous frame
+    meta, atoms, names = None, None, None
+
+    # Iteration is used throughout, as mixing it with readline
+    # does not work for plain files.
+    stream = iter(stream)
 
     while True:
         try:
@@ -62,17 +70,26 @@ def groFrameIterator(stream):
             break
 
         natoms = int(natoms)
-        
-        if not precision:
-            a = stream.next()
-            prec = len(a.split(".")[-2])+1
-            atoms = [groAtom(a,precision)]
-            atoms.extend([groAtom(stream.next(),precision)  for i in range(natoms-1)]) 
-        else:
-            atoms  = [groAtom(stream.next(),precision)  for i in range(natoms)] 
+        lines  = list(itertools.islice(stream,natoms))
         box    = groBoxRead(stream.next())
 
-        yield Structure(title=title, atoms=atoms, box=box)
-
-
-
+        # The width of the coordinate fields follows from the positions
+        # of the decimal points. This is determined for every frame, as
+        # it is cheap and files may have been concatenated.
+        a      = lines[0]
+        prec   = a.index(".",a.index(".",20)+1)-a.index(".",20)
+        chars  = charMatrix(lines,20+3*prec)
+
+        # Atom name, residue name, residue number: only converted if changed
+        m = chars[:,:20].tostring()
+        if m != meta:
+            meta  = m
+            resi  = numbers(column(chars,0,5),int).astype(str)
+            names = column(chars,5,10)
+            atoms = numpy.column_stack((column(chars,10,15),names,resi,numpy.repeat(" ",natoms)))
+
+        coord = buffer.next(natoms)
+        for i in range(3):
+            coord[:,i] = column(chars,20+i*prec,20+(i+1)*prec).astype(float)
+
+        yield Structure(title=title, atoms=atoms, coord=coord, names=names, box=box)
@@ -1,7 +1,8 @@
 
 from structure import Structure
+from reader    import openStream, charMatrix, column, numbers, Ring
 
-import math, numpy, gzip
+import math, numpy
 
 
 # Reformatting of lines in structure file                                     
@@ -78,28 +79,53 @@ def pdbAtom(a):
             float(a[60:66]))                # B-factor
 
 
-# Simple PDB iterator
-def pdbFrameIterator(stream):  
-    if type(stream) == str:
-        if stream.endswith(".gz"):
-            stream = gzip.open(stream)
-        else:
-            stream = open(stream)
+# PDB frame iterator
+def pdbFrameIterator(stream,ring=0):
+    """
+    Read a PDB file stream frame by frame. The lines of a model are
+    collected and the atom lines are converted column-wise. The
+    coordinates go into preallocated arrays if ring is set (see
+    reader.Ring). The atom data are shared between models if they
+    do not change.
+    """
 
-    title, atoms, box = [], [], []
+    stream = openStream(stream)
+    buffer = Ring(ring)
+
+    def frame(title,lines,box,data):
+        # data holds the atom data of the previous model
+        chars  = charMatrix(lines,66)
+        natoms = len(lines)
+
+        m = chars[:,12:27].tostring()
+        if not data or m != data[0]:
+            resi  = numbers(column(chars,22,26),int).astype(str)
+            names = column(chars,17,20)
+            atoms = numpy.column_stack((column(chars,12,16),names,resi,column(chars,21,22)))
+            data  = (m,atoms,names)
+        m,atoms,names = data
+
+        coord = buffer.next(natoms)
+        for i in range(3):
+            coord[:,i] = 0.1*numbers(column(chars,30+8*i,38+8*i))
+        q = numbers(column(chars,54,60))
+        b = numbers(column(chars,60,66))
+
+        return Structure(title="".join(title), atoms=atoms, coord=coord, q=q, b=b, names=names, box=box), data
+
+    title, lines, box, data = [], [], None, None
 
     for i in stream:
         if i.startswith("ENDMDL"):
-            yield Structure(title="".join(title), atoms=atoms, box=box)
-            title, atoms, box = [], [], None            
+            struc, data = frame(title,lines,box,data)
+            yield struc
+            title, lines, box = [], [], None
         elif i.startswith("TITLE"):
             title.append(i)
         elif i.startswith("CRYST1"):
             box = pdbReadBox(i)
         elif i.startswith("ATOM") or i.startswith("HETATM"):
-            atoms.append(pdbAtom(i))
-
-    if atoms:
-        yield Structure(title="".join(title), atoms=atoms, box=box)
-
+            lines.append(i)
 
+    if lines:
+        yield frame(title,lines,box,data)[0]
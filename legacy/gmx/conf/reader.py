@@ -0,0 +1,71 @@
+
+"""
+Helpers for reading text structure files in bulk
+
+Frames are read as blocks of lines, which are turned into a
+character matrix, from which fixed width columns are converted
+to arrays in one go.
+"""
+
+import gzip, io, numpy
+
+
+def openStream(stream):
+    """
+    Open a (gzipped) file for reading, or return the stream if it
+    is already open. Gzipped files are wrapped in a buffered reader,
+    which is much faster for iterating over lines than GzipFile itself.
+    """
+
+    if type(stream) != str:
+        return stream
+
+    if stream.endswith("gz"):
+        return io.BufferedReader(gzip.open(stream))
+
+    return open(stream)
+
+
+def charMatrix(lines,width):
+    """Character matrix (lines, width) from lines, truncated or padded with spaces"""
+    chars = numpy.array(lines,dtype="S%d"%width).view("S1").reshape((len(lines),width))
+    # Short lines are padded with null characters
+    chars[chars == ""] = " "
+    return chars
+
+
+def column(chars,start,end):
+    """Fixed width column as array of strings"""
+    return numpy.ascontiguousarray(chars[:,start:end]).view("S%d"%(end-start)).ravel()
+
+
+def numbers(col,dtype=float,default=0):
+    """Convert a column of strings to numbers, using default for empty fields"""
+    try:
+        return col.astype(dtype)
+    except ValueError:
+        return numpy.array([i.strip() and dtype(i) or default for i in col],dtype=dtype)
+
+
+class Ring:
+    """
+    Preallocated coordinate arrays, reused across frames. With a
+    ring of size n, the arrays returned for the last n frames are
+    valid; older ones are overwritten. With size 0, a new array is
+    returned for each frame.
+    """
+
+    def __init__(self,size=0):
+        self.size = size
+        self.data = None
+        self.pos  = 0
+
+    def next(self,natoms):
+        if not self.size:
+            return numpy.empty((natoms,3))
+        if self.data is None or self.data.shape[1] != natoms:
+            self.data = numpy.empty((self.size,natoms,3))
+            self.pos  = 0
+        out = self.data[self.pos]
+        self.pos = (self.pos+1) % self.size
+        return out
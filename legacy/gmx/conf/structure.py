@@ -1,20 +1,41 @@
 
 import numpy
 
+
+def kabsch(XY):
+    """
+    Optimal rotation(s) from (stacked) 3x3 covariance matrices XY = X'Y
+    of centered coordinate sets. Returns the sum of the corrected singular
+    values, which gives the msd as (XX+YY-2*s)/n, and the rotation matrices R,
+    such that X R fits onto Y.
+    """
+
+    U,l,V = numpy.linalg.svd(XY)
+
+    # Correct for reflections: if the determinant of UV is negative,
+    # the smallest singular value changes sign.
+    d = numpy.sign(numpy.linalg.det(U)*numpy.linalg.det(V))
+    d[d == 0] = 1
+    l[...,-1] *= d
+    U[...,:,-1] *= d[...,None]
+
+    return l.sum(axis=-1), numpy.einsum('...ij,...jk->...ik',U,V)
+
+
 class Structure(numpy.ndarray):
 
-    def __new__(cls, title=None, atoms=None, coord=None, q=None, b=None, m=1, box=None, center=False):
+    def __new__(cls, title=None, atoms=None, coord=None, q=None, b=None, m=1, box=None, center=False, names=None):
 
-        if coord == None:
+        if coord is None:
             stuff = zip(*atoms)
             names = stuff[1]
             atoms = numpy.asarray(zip(*stuff[:4]))
             coord = zip(*stuff[4:7])
-            if not q and len(stuff) > 7:
+            if q is None and len(stuff) > 7:
                 q = numpy.array(stuff[7])
-            if not b and len(stuff) > 8:
+            if b is None and len(stuff) > 8:
                 b = numpy.array(stuff[8])
-            
+
         obj = numpy.asarray(coord).view(cls)
 
         obj.title = title
@@ -24,7 +45,7 @@ class Structure(numpy.ndarray):
         obj.b     = b
         obj.m     = m
         obj._box  = box
-        
+
         if center:
             obj -= obj.mean()
             obj.centered = True
@@ -35,19 +56,24 @@ class Structure(numpy.ndarray):
 
 
     def __array_finalize__(self,obj):
-        if obj == None:
+        # Coordinates are not yet set (or just changed) for a new array.
+        # Derived (cached) properties are tied to the stamp.
+        self._stamp   = 0
+        self.centered = False
+
+        if obj is None:
             return
 
         self.title    = getattr(obj,"title", None)
+        self.names    = getattr(obj,"names", None)
         self.atoms    = getattr(obj,"atoms", None)
         self.q        = getattr(obj,"q",     None)
         self.b        = getattr(obj,"b",     None)
         self.m        = getattr(obj,"m",     None)
         self._box     = getattr(obj,"_box",  None)
-        self.centered = False
 
 
-    def __array_wrap__(self,out,context):
+    def __array_wrap__(self,out,context=None):
         return numpy.ndarray.__array_wrap__(self,out,context)
 
 
@@ -57,34 +83,67 @@ class Structure(numpy.ndarray):
 
     def __getitem__(self,items):
         # Dealing with 'internal' calls.
-        if numpy.rank(self) == 1:
+        if self.ndim == 1:
             return numpy.ndarray.__getitem__(self,items)
 
-        if type(items) in (int,slice):
-            atoms, items = items, (items,slice(None,None,None))
-        else:
-            atoms = list(items[0])
-            
+        if type(items) != tuple:
+            items = (items,slice(None,None,None))
+        atoms = items[0]
+
         obj = numpy.ndarray.__getitem__(self,items)
 
+        # Single atoms or coordinates
+        if numpy.ndim(obj) < 2:
+            return obj.view(numpy.ndarray) if isinstance(obj,numpy.ndarray) else obj
+
         obj.title = self.title
         obj._box  = self._box
 
-        obj.atoms = self.atoms[atoms,:]
-        obj.q     = self.q[atoms] if self.q != None else None
-        obj.b     = self.b[atoms] if self.b != None else None
-        obj.m     = self.m[atoms] if self.m != 1    else 1
+        obj.atoms = self.atoms[atoms] if self.atoms is not None else None
+        obj.names = numpy.asarray(self.names)[atoms] if self.names is not None else None
+        obj.q     = self.q[atoms] if self.q is not None else None
+        obj.b     = self.b[atoms] if self.b is not None else None
+        obj.m     = self.m[atoms] if numpy.ndim(self.m) else self.m
 
         obj.centered = False
 
         return obj
 
-    
+
+    def __setitem__(self,items,value):
+        self.touch()
+        numpy.ndarray.__setitem__(self,items,value)
+
+
     def __iadd__(self,other):
+        self.touch()
         self.centered = False
         return numpy.ndarray.__iadd__(self,other)
 
 
+    def __isub__(self,other):
+        self.touch()
+        self.centered = False
+        return numpy.ndarray.__isub__(self,other)
+
+
+    def __imul__(self,other):
+        self.touch()
+        return numpy.ndarray.__imul__(self,other)
+
+
+    def touch(self):
+        """
+        Mark the coordinates as changed, invalidating cached properties.
+
+        Item assignment and in-place arithmetic on the structure call
+        this. Writes that bypass these methods, through a view such as
+        numpy.asarray(s) or through ufunc(..., out=s), are not noticed:
+        call touch() after them.
+        """
+        self._stamp += 1
+
+
     def x(self):
         # Return x similar to method for TRRFrames
         return self
@@ -99,21 +158,30 @@ class Structure(numpy.ndarray):
         return numpy.ndarray.mean(self,axis=axis)
 
 
+    def select(self,index):
+        """
+        Return a selection of atoms, given as list/array of indices,
+        a boolean mask or a slice. The selection refers to this
+        structure, rather than copying coordinates and atom data.
+        """
+        return Selection(self,index)
+
+
     def radiusOfGyrationSquared(self):
         """Fetch the radius of gyration or determine and store the value and return it"""
 
         g = getattr(self,"_radiusOfGyrationSquared",None)
 
-        if not g:
+        if not g or g[0] != self._stamp:
             if self.centered:
                 g = numpy.sum(self**2)
             else:
                 g = numpy.sum((self-self.mean())**2)
 
-            self._radiusOfGyrationSquared = g
+            g = self._radiusOfGyrationSquared = (self._stamp, float(g))
+
+        return g[1]
 
-        return g
-        
 
     def cov(self):
         """3x3 covariance matrix"""
@@ -133,13 +201,203 @@ class Structure(numpy.ndarray):
     def msd(self,target,align=True):
         "Mean square displacement and fitting"
 
-        XX = self.radiusOfGyrationSquared
-        YY = target.radiusOfGyrationSquared
-        
-        if self.centered or target.centered:
-            XY = numpy.dot(self.T,target)
+        X = self.view(numpy.ndarray)
+        Y = numpy.asarray(target)
+
+        if not align:
+            return ((X-Y)**2).sum()/len(X)
+
+        XX = self.radiusOfGyrationSquared()
+        YY = numpy.sum((Y-Y.mean(axis=0))**2)
+
+        if self.centered:
+            XY = numpy.dot(X.T,Y)
+        else:
+            XY = numpy.dot((X-X.mean(axis=0)).T,Y)
+
+        l, R = kabsch(XY[None])
+
+        return max(0, (XX+YY-2*l[0])/len(X))
+
+
+class Selection(object):
+    """
+    A selection of atoms of a parent Structure.
+
+    The selection only holds the atom indices (and the mask, if it was
+    given as one). Coordinates and atom data are taken from the parent
+    when requested, and the centered coordinates, center and radius of
+    gyration are cached until the coordinates of the parent change.
+    """
+
+    def __init__(self,parent,index):
+        self.parent = parent
+
+        if isinstance(index,Selection):
+            index = index.index
+        elif isinstance(index,slice):
+            index = numpy.arange(len(parent))[index]
+
+        index = numpy.asarray(index)
+        if index.dtype == bool:
+            self._mask = index
+            index = numpy.flatnonzero(index)
         else:
-            XY = numpy.dot(self.T,(target-target.mean()))
+            self._mask = None
+
+        self.index  = index.astype(numpy.intp)
+        self._cache = None
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __and__(self,other):
+        return Selection(self.parent,self.mask & other.mask)
+
+
+    def __or__(self,other):
+        return Selection(self.parent,self.mask | other.mask)
+
+
+    def __invert__(self):
+        return Selection(self.parent,~self.mask)
+
+
+    @property
+    def mask(self):
+        """Boolean mask over the atoms of the parent"""
+        if self._mask is None:
+            self._mask = numpy.zeros(len(self.parent),dtype=bool)
+            self._mask[self.index] = True
+        return self._mask
+
+
+    def bind(self,parent):
+        """Apply the same selection to another structure (frame)"""
+        return Selection(parent,self.index)
+
+
+    # Atom data is looked up on request only
+    @property
+    def atoms(self):
+        return self.parent.atoms[self.index] if self.parent.atoms is not None else None
+
+    @property
+    def q(self):
+        return self.parent.q[self.index] if self.parent.q is not None else None
+
+    @property
+    def b(self):
+        return self.parent.b[self.index] if self.parent.b is not None else None
+
+    @property
+    def m(self):
+        return self.parent.m[self.index] if numpy.ndim(self.parent.m) else self.parent.m
+
+
+    def x(self):
+        """Coordinates of the selected atoms"""
+        return numpy.asarray(self.parent)[self.index]
+
+
+    def _update(self):
+        stamp = getattr(self.parent,"_stamp",None)
+        if self._cache is None or self._cache[0] != stamp or stamp is None:
+            x  = self.x()
+            c  = x.mean(axis=0)
+            x -= c
+            self._cache = (stamp, c, x, float((x**2).sum()))
+        return self._cache
+
+
+    def mean(self):
+        """Center (geometric) of the selection"""
+        return self._update()[1]
+
+
+    def centered(self):
+        """Centered coordinates of the selection"""
+        return self._update()[2]
+
+
+    def radiusOfGyrationSquared(self):
+        return self._update()[3]
+
+
+    def msd(self,target,align=True):
+        """Mean square displacement to the same atoms of target, optionally after fitting"""
+        return msd([self],target,align)[0]
+
+
+    def fit(self,target):
+        """Return the coordinates of the selection fitted onto the same atoms of target"""
+        R, xm, ym = fit([self],target)
+        return numpy.dot(self.centered(),R[0]) + ym[0]
+
+
+def _stacked(selections,target):
+    """
+    Centered coordinates of selections and the same atoms from target,
+    concatenated, with the offsets of the selections and the centers.
+    """
+
+    sizes = numpy.array([len(s) for s in selections])
+    if not sizes.all():
+        raise ValueError("Cannot fit empty selections")
+
+    starts = numpy.append(0,numpy.cumsum(sizes)[:-1])
+    index  = numpy.concatenate([s.index for s in selections])
+
+    X  = numpy.concatenate([s.centered() for s in selections])
+    xm = numpy.array([s.mean() for s in selections])
+
+    Y  = numpy.asarray(target)[index]
+    ym = numpy.add.reduceat(Y,starts,axis=0)/sizes[:,None]
+    Y -= numpy.repeat(ym,sizes,axis=0)
+
+    return X, Y, starts, sizes, xm, ym
+
+
+def msd(selections,target,align=True):
+    """
+    Mean square displacement for a number of selections, to the
+    same atoms of target, optionally after translational and
+    rotational fitting. All selections are processed in one go.
+    """
+
+    if not align:
+        index  = numpy.concatenate([s.index for s in selections])
+        sizes  = numpy.array([len(s) for s in selections])
+        starts = numpy.append(0,numpy.cumsum(sizes)[:-1])
+        X = numpy.concatenate([s.x() for s in selections])
+        d = ((X-numpy.asarray(target)[index])**2).sum(axis=1)
+        return numpy.add.reduceat(d,starts)/sizes
+
+    X, Y, starts, sizes, xm, ym = _stacked(selections,target)
+
+    XX = numpy.array([s.radiusOfGyrationSquared() for s in selections])
+    YY = numpy.add.reduceat((Y**2).sum(axis=1),starts)
+    XY = numpy.add.reduceat(numpy.einsum('ai,aj->aij',X,Y),starts,axis=0)
+
+    l, R = kabsch(XY)
+
+    return numpy.maximum(0,(XX+YY-2*l)/sizes)
+
+
+def fit(selections,target):
+    """
+    Fit parameters for a number of selections onto the same atoms of
+    target. Returns the rotation matrices and the centers of the
+    selections and of the target atoms, such that (x-xm) R + ym
+    gives the fitted coordinates.
+    """
+
+    X, Y, starts, sizes, xm, ym = _stacked(selections,target)
+
+    XY = numpy.add.reduceat(numpy.einsum('ai,aj->aij',X,Y),starts,axis=0)
+
+    l, R = kabsch(XY)
 
-        U,l,V = numpy.linalg.svd(XY)
-        
+    return R, xm, ym
@@ -0,0 +1,205 @@
+
+"""
+Random access to the frames of multi-model PDB and multi-frame GRO files
+
+The byte offsets of the frames are determined once and stored, so that
+any frame can be read directly. For GRO files with fixed width atom lines
+only the title, atom count, last atom and box lines of each frame are read.
+"""
+
+import os, gzip, numpy
+
+from gro       import groFrameIterator, groBoxRead
+from pdb       import pdbFrameIterator
+from reader    import openStream
+from gmx.cache import Cache, fileTag
+
+
+# Frame offsets are stored between runs in the directory given by
+# GMXCONFCACHE, if that is set.
+confcache = Cache.environ("GMXCONFCACHE",".idx")
+
+
+def isBox(line):
+    """Check whether a line is a GRO box line: 3 or 9 numbers"""
+    fields = line.split()
+    if len(fields) not in (3,9):
+        return False
+    try:
+        groBoxRead(line)
+    except ValueError:
+        return False
+    return True
+
+
+def groOffsets(f):
+    """Byte offsets of the frames in a GRO file, with the end as last element"""
+
+    offsets = []
+    pos     = 0
+
+    while True:
+        f.seek(pos)
+        title = f.readline()
+        count = f.readline()
+        if not title or not count.strip():
+            break
+
+        natoms = int(count)
+        start  = pos + len(title) + len(count)
+        first  = f.readline()
+        width  = len(first)
+        end    = start + natoms*width
+        box    = None
+
+        # With fixed width lines, the last atom line ends right before
+        # the box. To be sure, the atom number of the last atom is checked.
+        if natoms > 1:
+            f.seek(end-width-1)
+            last = f.read(width+1)
+            if (len(last) == width+1 and last[0] == "\n" and last[-1] == "\n" and
+                last[16:21].strip() == str(natoms % 100000)):
+                box = f.readline()
+                if not isBox(box):
+                    box = None
+
+        # Otherwise run over the lines
+        if box is None:
+            f.seek(start)
+            for i in range(natoms):
+                f.readline()
+            box = f.readline()
+
+        offsets.append(pos)
+        pos = f.tell()
+
+    offsets.append(pos)
+
+    return offsets
+
+
+def pdbOffsets(f):
+    """
+    Byte offsets of the frames in a PDB file, with the end as last
+    element. A frame ends at ENDMDL and the next starts right after,
+    such that TITLE and CRYST1 records go with the next model.
+    """
+
+    offsets = [0]
+    pos     = 0
+    atoms   = False
+
+    f.seek(0)
+    for line in f:
+        pos += len(line)
+        if line.startswith("ENDMDL"):
+            offsets.append(pos)
+            atoms = False
+        elif line.startswith("ATOM") or line.startswith("HETATM"):
+            atoms = True
+
+    # Atoms after the last ENDMDL (or no models at all)
+    if atoms:
+        offsets.append(pos)
+
+    return offsets
+
+
+class Trajectory:
+    """
+    Multi-frame GRO or PDB file with random access to frames:
+
+        traj = Trajectory("models.pdb")
+        traj[k], traj[-1], traj[10:20:2], len(traj)
+
+    Iterating goes over the file sequentially.
+
+    Gzipped files can not be read from an arbitrary position: seeking
+    forward decompresses the data in between, and seeking backward
+    starts again from the beginning of the file. Reading frames in
+    increasing order is fine, but random access is not O(1) then.
+    """
+
+    def __init__(self,stream,ring=0):
+        self.filename = stream
+        self.ring     = ring
+        self.gro      = stream.endswith(".gro") or stream.endswith(".gro.gz")
+        self.gz       = stream.endswith("gz")
+        self.index    = -1
+        self._iter    = None
+        self._offsets = None
+        self._file    = None
+
+
+    def _open(self):
+        if self.gz:
+            return gzip.open(self.filename)
+        return open(self.filename,"rb")
+
+
+    @property
+    def offsets(self):
+        """Byte offsets of the frames (decompressed for .gz), with the end as last element"""
+
+        if self._offsets is None:
+            tag  = fileTag(self.filename)
+            name = os.path.basename(self.filename)
+            self._offsets = confcache.load(tag,name)
+            if self._offsets is None:
+                f = self._open()
+                self._offsets = numpy.array((groOffsets if self.gro else pdbOffsets)(f),dtype=numpy.int64)
+                f.close()
+                confcache.save(tag,self._offsets,name)
+
+        return self._offsets
+
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+
+    def __iter__(self):
+        frames = (groFrameIterator if self.gro else pdbFrameIterator)(openStream(self.filename),self.ring)
+        for i, frame in enumerate(frames):
+            self.index = i
+            yield frame
+
+
+    def next(self):
+        if self._iter is None:
+            self._iter = iter(self)
+        return self._iter.next()
+
+
+    def frame(self,k):
+        """Read frame k"""
+
+        n = len(self)
+        if k < 0:
+            k += n
+        if not 0 <= k < n:
+            raise IndexError("Frame index out of range: %d (%d frames)" % (k,n))
+
+        # The file is kept open; for gzipped files, seeking forward
+        # only decompresses the part in between, but seeking backward
+        # decompresses from the start again.
+        if self._file is None:
+            self._file = self._open()
+        self._file.seek(self.offsets[k])
+        lines = self._file.read(self.offsets[k+1]-self.offsets[k]).splitlines(True)
+
+        self.index = k
+
+        return (groFrameIterator if self.gro else pdbFrameIterator)(lines).next()
+
+
+    def __getitem__(self,k):
+        if isinstance(k,slice):
+            return [self.frame(i) for i in range(*k.indices(len(self)))]
+        return self.frame(k)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
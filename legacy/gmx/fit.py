@@ -0,0 +1,177 @@
+
+"""
+Fitting and RMSD calculation for blocks of frames
+
+The coordinates of a trajectory are processed as (frames, atoms, 3)
+arrays, to do the fitting of many frames in one go: the covariance
+matrices are stacked with einsum and the rotations are determined
+with a stacked SVD. Frames can be given as an array, or as an iterable
+of frames, like a TRR trajectory, which is read in blocks.
+"""
+
+import itertools, numpy
+
+from conf.structure import kabsch
+
+
+def indices(index):
+    """Atom indices from a list or array of indices or a boolean mask; None for all atoms"""
+    if index is None:
+        return None
+    index = numpy.asarray(index)
+    if index.dtype == bool:
+        return numpy.flatnonzero(index)
+    return index
+
+
+def coordinates(frame,index=None):
+    """Coordinates from a frame (TRRFrame, Structure, Selection or array)"""
+    if hasattr(frame,"parent") and hasattr(frame,"index"):
+        # Selection
+        index, frame = frame.index, frame.parent
+    if callable(getattr(frame,"x",None)):
+        x = frame.x()
+        if hasattr(frame,"clear"):
+            # TRRFrame: do not keep the data in the reader
+            frame.clear()
+        frame = x
+    x = numpy.asarray(frame)
+    return x[index] if index is not None else x
+
+
+def blocks(frames,size=1000,index=None):
+    """
+    Yield (frames, atoms, 3) arrays of at most size frames from
+    an array or an iterable of frames, optionally only taking the
+    atoms given by index.
+    """
+
+    index = indices(index)
+
+    if isinstance(frames,numpy.ndarray) and frames.ndim == 3:
+        for i in range(0,len(frames),size):
+            b = frames[i:i+size]
+            yield b[:,index] if index is not None else b
+        return
+
+    frames = iter(frames)
+    while True:
+        chunk = [coordinates(i,index) for i in itertools.islice(frames,size)]
+        if not chunk:
+            break
+        yield numpy.array(chunk)
+
+
+def center(X):
+    """Center a block of frames; return centered coordinates and centers"""
+    X  = numpy.asarray(X,dtype=float)
+    xm = X.mean(axis=-2)
+    return X - xm[...,None,:], xm
+
+
+def msdBlock(X,reference,align=True):
+    """
+    Mean square deviation of each frame in block X (frames, atoms, 3)
+    to the reference (atoms, 3), optionally after fitting.
+    """
+
+    Y = numpy.asarray(reference,dtype=float)
+
+    if not align:
+        return ((numpy.asarray(X)-Y)**2).sum(axis=2).mean(axis=1)
+
+    Xc, xm = center(X)
+    Yc, ym = center(Y)
+
+    XX = numpy.einsum('fai,fai->f',Xc,Xc)
+    YY = (Yc**2).sum()
+    XY = numpy.einsum('fai,aj->fij',Xc,Yc)
+
+    l, R = kabsch(XY)
+
+    return numpy.maximum(0,(XX+YY-2*l)/Y.shape[0])
+
+
+def fitBlock(X,reference):
+    """Return the frames of block X (frames, atoms, 3) fitted onto the reference"""
+
+    Xc, xm = center(X)
+    Yc, ym = center(reference)
+
+    l, R = kabsch(numpy.einsum('fai,aj->fij',Xc,Yc))
+
+    return numpy.einsum('fai,fij->faj',Xc,R) + ym
+
+
+def rmsd(frames,reference,index=None,align=True,size=1000):
+    """
+    RMSD time series of frames to the reference, after fitting if align
+    is set. The frames are read and processed in blocks of size frames.
+    If index is given, only those atoms are used; the reference should
+    have either all atoms or only the selected ones. The index can be a
+    list of atom indices or a boolean mask.
+    """
+
+    index = indices(index)
+    Y     = coordinates(reference)
+
+    out = []
+    for X in blocks(frames,size):
+        if index is not None:
+            # The reference has all atoms if it has as many as the frames
+            if not out and len(Y) == X.shape[1]:
+                Y = Y[index]
+            X = X[:,index]
+        out.append(msdBlock(X,Y,align))
+
+    return numpy.sqrt(numpy.concatenate(out)) if out else numpy.array([])
+
+
+def pairwise(frames,index=None,chunk=256,size=1000):
+    """
+    All-vs-all RMSD matrix after fitting. The (centered) coordinates of
+    all frames are kept, with the precision of the input, but the
+    covariance matrices are determined for chunk x chunk pairs of frames
+    at a time, to bound the memory use. Only the upper triangle
+    is calculated. The index can be a list of atom indices or a
+    boolean mask.
+    """
+
+    index = indices(index)
+
+    # Centered coordinates and 'radii of gyration' of all frames
+    C, G = [], []
+    for X in blocks(frames,size,index):
+        Xc, xm = center(X)
+        G.append(numpy.einsum('fai,fai->f',Xc,Xc))
+        C.append(Xc.astype(X.dtype if X.dtype.kind == 'f' else float))
+
+    if not C:
+        return numpy.zeros((0,0))
+
+    C = numpy.concatenate(C)
+    G = numpy.concatenate(G)
+    F, N = C.shape[:2]
+
+    D = numpy.zeros((F,F))
+
+    for i in range(0,F,chunk):
+        # Frames of the row chunk as (3 x frames, atoms)
+        A = C[i:i+chunk].transpose(0,2,1).reshape(-1,N).astype(float)
+        a = len(A)//3
+        for j in range(i,F,chunk):
+            B = C[j:j+chunk].transpose(1,0,2).reshape(N,-1).astype(float)
+            b = B.shape[1]//3
+
+            # Covariance matrices of all pairs as (a, b, 3, 3)
+            XY = numpy.dot(A,B).reshape(a,3,b,3).transpose(0,2,1,3)
+
+            l, R = kabsch(XY)
+
+            m = numpy.maximum(0,(G[i:i+a,None]+G[None,j:j+b]-2*l)/N)
+            D[i:i+a,j:j+b] = m
+            D[j:j+b,i:i+a] = m.T
+
+    numpy.fill_diagonal(D,0)
+
+    return numpy.sqrt(D)
@@ -1,9 +1,91 @@
-import collections
+
+import numpy
+
+from conf.reader import openStream
+
+
+def numbers(text):
+    """Array of the whitespace separated numbers in text"""
+    # fromstring is fast, but gives a zero for an empty string
+    if not text.strip():
+        return numpy.array([],dtype=numpy.int32)
+    return numpy.fromstring(text,dtype=numpy.int32,sep=" ")
+
+
+class Group(numpy.ndarray):
+    """
+    Index group: sorted array of unique (0-based) atom indices.
+
+    Groups combine like sets: a & b (intersection), a | b (union),
+    a - b (difference) and ~a (complement, which requires the
+    number of atoms in the system to be known).
+    """
+
+    def __new__(cls, atoms=(), natoms=None):
+        obj = numpy.unique(numpy.asarray(atoms,dtype=numpy.int32)).view(cls)
+        obj.natoms = natoms
+        return obj
+
+
+    def __array_finalize__(self,obj):
+        self.natoms = getattr(obj,"natoms",None)
+
+
+    def _group(self,atoms,other=None):
+        # Set operations give sorted unique arrays already
+        obj = numpy.asarray(atoms,dtype=numpy.int32).view(Group)
+        obj.natoms = self.natoms or getattr(other,"natoms",None)
+        return obj
+
+
+    def _other(self,other):
+        # Other operands (lists, arrays) may be unsorted and have duplicates
+        if not isinstance(other,Group):
+            other = Group(other)
+        return other
+
+
+    def __and__(self,other):
+        other = self._other(other)
+        return self._group(numpy.intersect1d(self.view(numpy.ndarray),other.view(numpy.ndarray),assume_unique=True),other)
+
+
+    def __or__(self,other):
+        other = self._other(other)
+        return self._group(numpy.union1d(self.view(numpy.ndarray),other.view(numpy.ndarray)),other)
+
+
+    def __sub__(self,other):
+        other = self._other(other)
+        return self._group(numpy.setdiff1d(self.view(numpy.ndarray),other.view(numpy.ndarray),assume_unique=True),other)
+
+
+    def __invert__(self):
+        if self.natoms is None:
+            raise ValueError("Cannot take the complement of an index group without knowing the number of atoms")
+        mask = numpy.ones(self.natoms,dtype=bool)
+        mask[self.view(numpy.ndarray)] = False
+        return self._group(numpy.flatnonzero(mask))
+
+
+    def mask(self,natoms=None):
+        """Boolean mask over all atoms"""
+        mask = numpy.zeros(natoms or self.natoms,dtype=bool)
+        mask[self.view(numpy.ndarray)] = True
+        return mask
+
 
 class Index(dict):
     """Class for reading a Gromacs index file and allow referencing by group name or number"""
 
     def __init__(self,*args):
+        # Attributes are private, as other names are looked up as groups
+        self._structure   = None
+        self._natoms      = None
+        self._expressions = []
+        self._residue     = None
+        self._chain       = None
+
         for item in args:
             if item.lower().endswith('.ndx') or item.lower().endswith(".ndx.gz"):
                 self.from_file(item)
@@ -12,7 +94,7 @@ class Index(dict):
                     for i in f:
                         self.fromExpression(i)
             else:
-                self.fromExpression(i,ref)
+                self.fromExpression(item)
 
 
     def __str__(self):
@@ -30,23 +112,101 @@ class Index(dict):
         raise IndexError("Index group not found: {}\nGroups:\n{}".format(attr, self))
 
 
+    def __setitem__(self,name,atoms):
+        group = Group(atoms,self._natoms)
+        dict.__setitem__(self,name,group)
+
+
     def from_file(self,filename):
         """Read index groups from GROMACS style index file"""
 
         # The GROMACS index files contains records with a [ header ]
         # followed by whitespace separated numbers.
 
-        stuff = open(filename).read()
+        stuff = openStream(filename).read()
 
-        #          name           numbers                                                           records
-        data = [ (a.strip(),tuple(int(u)-1 for u in b.split())) for a,b in [i.split(']') for i in stuff.split('[')[1:]]]
+        #          name           numbers                                                                       records
+        data = [ (a.strip(),numbers(b)-1) for a,b in [i.split(']') for i in stuff.split('[')[1:]]]
 
         # Remove disallowed characters. Make everything lowercase
-        for name, numbers in data:
+        for name, atoms in data:
             name = name.translate("{0:_>58}_{1:_^38}{1:_<159}".format("0123456789","abcdefghijklmnopqrstuvwxyz"))
-            self[name] = numbers
+            self[name] = atoms
+
+
+    def write(self,filename,groups=None):
+        """Write (selected) index groups to a GROMACS style index file"""
+
+        # Numbers are written 15 per line, as GROMACS does. The lines
+        # are formatted all at once, which is much faster than per line.
+        line = " ".join(15*["%4d"])+"\n"
+
+        with open(filename,"w") as out:
+            for name in groups or self.keys():
+                atoms = self[name].view(numpy.ndarray)+1
+                n     = len(atoms) - len(atoms) % 15
+                out.write("[ %s ]\n" % name)
+                if n:
+                    out.write((line*(n//15)) % tuple(atoms[:n].tolist()))
+                if n < len(atoms):
+                    out.write(" ".join(len(atoms[n:])*["%4d"]) % tuple(atoms[n:].tolist()) + "\n")
+
+
+    def fromExpression(self,text):
+        """
+        Add a group from a selection expression (see selection.py), given
+        as 'name = expression' or just as expression, which is then also
+        used as name. The group is determined once a structure is bound.
+        """
+
+        from selection import Expression
+
+        text = text.split("#")[0].strip()
+        if not text:
+            return
+
+        if "=" in text:
+            name, text = [i.strip() for i in text.split("=",1)]
+        else:
+            name = text
+
+        expression = Expression(text,self)
+        self._expressions.append((name,expression))
+        if self._structure is not None:
+            self[name] = expression.group(self._structure)
+
 
-    
-    def bind(atoms):
+    def bind(self,structure):
         """Bind a structure to an index to allow selections based on atoms/residues/chains"""
-        pass
+
+        self._structure = structure
+        self._natoms    = len(structure)
+
+        for group in self.values():
+            group.natoms = self._natoms
+
+        # Residue and chain numbers per atom, from the atom data (name,
+        # residue name, residue number, chain). A new residue starts where
+        # any of the last three changes, a new chain where the chain changes.
+        atoms = numpy.asarray(structure.atoms)
+        new   = numpy.ones(self._natoms,dtype=bool)
+        new[1:] = (atoms[1:,1:] != atoms[:-1,1:]).any(axis=1)
+        self._residue = numpy.cumsum(new)-1
+        new[1:] = atoms[1:,3] != atoms[:-1,3]
+        self._chain   = numpy.cumsum(new)-1
+
+        # Groups from selection expressions, in the order given
+        for name, expression in self._expressions:
+            self[name] = expression.group(structure)
+
+        return self
+
+
+    def residues(self,group):
+        """Expand a group to complete residues"""
+        return Group(numpy.flatnonzero(numpy.in1d(self._residue,self._residue[group])),self._natoms)
+
+
+    def chains(self,group):
+        """Expand a group to complete chains"""
+        return Group(numpy.flatnonzero(numpy.in1d(self._chain,self._chain[group])),self._natoms)
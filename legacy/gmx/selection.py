@@ -0,0 +1,378 @@
+
+"""
+Selection expressions compiled to mask operations on structure arrays
+
+    sel = Expression("name CA and resid 10-20 or within 0.5 of resname LIG")
+    sel(structure)         # conf.structure.Selection
+    sel.mask(structure)    # boolean array
+    sel.group(structure)   # index.Group
+
+Keywords:
+
+    name, resname     names; * and ? are wildcards
+    resid, resnr      numbers and ranges: 1 5-10 12:15
+    chain             chain identifiers
+    group             index group (or just the name of the group)
+    within D of ...   atoms within distance D (nm) of the selection
+    all, none
+    and, or, not      also &, | and !; parentheses for grouping
+
+The atom data are converted to columns (name, resname, resid, chain) once
+for each atom table. As frames read from a trajectory share the atom table,
+the masks of all parts that do not depend on coordinates are kept and only
+distance based parts (within) are determined anew for each frame.
+"""
+
+import re, fnmatch, itertools, numpy
+
+from index          import Group
+from conf.structure import Selection
+
+
+class SelectionError(Exception):
+    def __init__(self,msg): self.msg = msg
+    def __str__(self):      return self.msg
+
+
+_tokens   = re.compile(r'\(|\)|&|\||!|[^\s()&|!]+')
+_keywords = ("name","resname","resid","resnr","chain","group","within","all","none","and","or","not")
+
+
+def columns(atoms):
+    """Columns from an atom table (name, residue name, residue number, chain)"""
+    atoms = numpy.asarray(atoms)
+    return {
+        "name":    numpy.char.strip(atoms[:,0]),
+        "resname": numpy.char.strip(atoms[:,1]),
+        "resid":   atoms[:,2].astype(int),
+        "chain":   numpy.char.strip(atoms[:,3])
+        }
+
+
+def within(x,ref,cutoff,box=None,chunk=100000):
+    """
+    Mask of points x within cutoff of any of the points ref, using a cell
+    list. Periodic boundary conditions are applied for rectangular boxes.
+    """
+
+    x    = numpy.asarray(x,dtype=float)
+    ref  = numpy.asarray(ref,dtype=float)
+    mask = numpy.zeros(len(x),dtype=bool)
+
+    if not len(x) or not len(ref):
+        return mask
+
+    L = None
+    if box is not None:
+        box = numpy.asarray(box)
+        if box.shape == (3,3) and not (box-numpy.diag(box.diagonal())).any() and box.diagonal().all():
+            L = box.diagonal()
+
+    # Cells of at least cutoff size
+    if L is not None:
+        x    = x % L
+        ref  = ref % L
+        n    = numpy.maximum(numpy.floor(L/cutoff),1).astype(int)
+        size = L/n
+    else:
+        lo   = numpy.minimum(x.min(axis=0),ref.min(axis=0))
+        x    = x - lo
+        ref  = ref - lo
+        n    = (numpy.maximum(x.max(axis=0),ref.max(axis=0))//cutoff).astype(int)+1
+        size = cutoff*numpy.ones(3)
+
+    def cells(p):
+        return numpy.minimum((p/size).astype(int),n-1)
+
+    def key(c):
+        return (c[:,0]*n[1]+c[:,1])*n[2]+c[:,2]
+
+    # Reference points sorted by cell
+    order = numpy.argsort(key(cells(ref)),kind="mergesort")
+    ref   = ref[order]
+    rkeys = key(cells(ref))
+
+    # Neighbouring cells; with fewer than three cells in a
+    # periodic dimension, the neighbours are all cells.
+    shifts = [range(n[i]) if L is not None and n[i] < 3 else (-1,0,1) for i in range(3)]
+
+    c2 = cutoff**2
+
+    for start in range(0,len(x),chunk):
+        xc = x[start:start+chunk]
+        cx = cells(xc)
+        for shift in itertools.product(*shifts):
+            todo = numpy.flatnonzero(~mask[start:start+chunk])
+            if not len(todo):
+                break
+
+            if L is not None and min(n) < 3:
+                # Shifts are absolute cells in small dimensions
+                c = numpy.array([shift[i]*numpy.ones(len(todo),dtype=int) if n[i] < 3 else cx[todo,i]+shift[i] for i in range(3)]).T
+            else:
+                c = cx[todo]+shift
+
+            if L is not None:
+                c %= n
+            else:
+                valid = ((c >= 0) & (c < n)).all(axis=1)
+                todo, c = todo[valid], c[valid]
+
+            k  = key(c)
+            a  = numpy.searchsorted(rkeys,k,"left")
+            b  = numpy.searchsorted(rkeys,k,"right")
+            nb = b-a
+            if not nb.any():
+                continue
+
+            # All pairs of points and reference points in the cell
+            i = numpy.repeat(todo,nb)
+            j = numpy.repeat(a-numpy.cumsum(nb)+nb,nb) + numpy.arange(nb.sum())
+            d = xc[i]-ref[j]
+            if L is not None:
+                d -= L*numpy.round(d/L)
+            hit = (d**2).sum(axis=1) <= c2
+            mask[start+i[hit]] = True
+
+    return mask
+
+
+class Node:
+    """Part of a compiled expression. Static nodes do not depend on coordinates."""
+
+    static = True
+
+    def __init__(self,*args):
+        self.args   = args
+        self._cache = None
+
+    def mask(self,structure,cols):
+        # Static masks are kept as long as the atom table is the same
+        if self.static:
+            if self._cache is None or self._cache[0] is not structure.atoms:
+                self._cache = (structure.atoms, self.evaluate(structure,cols))
+            return self._cache[1]
+        return self.evaluate(structure,cols)
+
+
+class Match(Node):
+    """Names, with wildcards, residue names or chains"""
+
+    def evaluate(self,structure,cols):
+        field, values = self.args
+        col = cols[field]
+        plain = [v for v in values if not ("*" in v or "?" in v)]
+        wild  = [v for v in values if v not in plain]
+        if wild:
+            # Patterns are matched against the unique values only
+            unique = numpy.unique(col)
+            plain.extend([u for u in unique if any(fnmatch.fnmatchcase(u,w) for w in wild)])
+        return numpy.in1d(col,plain)
+
+
+class Range(Node):
+    """Residue numbers and ranges"""
+
+    def evaluate(self,structure,cols):
+        col  = cols["resid"]
+        mask = numpy.zeros(len(col),dtype=bool)
+        for lo, hi in self.args[0]:
+            mask |= (col >= lo) & (col <= hi)
+        return mask
+
+
+class IndexGroup(Node):
+    def evaluate(self,structure,cols):
+        index, name = self.args
+        if index is None:
+            raise SelectionError("No index groups to select group %s from" % name)
+        return getattr(index,name).mask(len(structure))
+
+
+class All(Node):
+    def evaluate(self,structure,cols):
+        return numpy.ones(len(structure),dtype=bool) if self.args[0] else numpy.zeros(len(structure),dtype=bool)
+
+
+class Not(Node):
+    def __init__(self,a):
+        Node.__init__(self,a)
+        self.static = a.static
+
+    def evaluate(self,structure,cols):
+        return ~self.args[0].mask(structure,cols)
+
+
+class And(Node):
+    def __init__(self,a,b):
+        Node.__init__(self,a,b)
+        self.static = a.static and b.static
+
+    def evaluate(self,structure,cols):
+        # Static parts are cheap after the first frame, so they go first
+        a, b = sorted(self.args,key=lambda i: not i.static)
+        m = a.mask(structure,cols)
+        if not m.any():
+            return m
+        return m & b.mask(structure,cols)
+
+
+class Or(Node):
+    def __init__(self,a,b):
+        Node.__init__(self,a,b)
+        self.static = a.static and b.static
+
+    def evaluate(self,structure,cols):
+        return self.args[0].mask(structure,cols) | self.args[1].mask(structure,cols)
+
+
+class Within(Node):
+    static = False
+
+    def evaluate(self,structure,cols):
+        cutoff, node = self.args
+        x   = numpy.asarray(structure)
+        ref = node.mask(structure,cols)
+        return within(x,x[ref],cutoff,structure.box())
+
+
+class Parser:
+    """Recursive descent parser: or < and < not/within < terms"""
+
+    def __init__(self,text,index=None):
+        self.tokens = _tokens.findall(text)
+        self.pos    = 0
+        self.index  = index
+
+    def peek(self):
+        return self.tokens[self.pos].lower() if self.pos < len(self.tokens) else None
+
+    def take(self):
+        self.pos += 1
+        return self.tokens[self.pos-1]
+
+    def values(self):
+        out = []
+        while self.peek() not in (None,"(",")","&","|","!") and self.peek() not in _keywords:
+            out.append(self.take())
+        if not out:
+            raise SelectionError("Missing values at position %d" % self.pos)
+        return out
+
+    def parse(self):
+        node = self.disjunction()
+        if self.peek() is not None:
+            raise SelectionError("Unexpected '%s'" % self.tokens[self.pos])
+        return node
+
+    def disjunction(self):
+        node = self.conjunction()
+        while self.peek() in ("or","|"):
+            self.take()
+            node = Or(node,self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.unary()
+        while self.peek() in ("and","&"):
+            self.take()
+            node = And(node,self.unary())
+        return node
+
+    def unary(self):
+        t = self.peek()
+        if t in ("not","!"):
+            self.take()
+            return Not(self.unary())
+        if t == "within":
+            self.take()
+            try:
+                cutoff = float(self.take())
+            except (ValueError, IndexError):
+                raise SelectionError("within requires a distance")
+            if self.peek() != "of":
+                raise SelectionError("Expected 'of' after within %s" % cutoff)
+            self.take()
+            return Within(cutoff,self.unary())
+        return self.term()
+
+    def term(self):
+        t = self.peek()
+        if t is None:
+            raise SelectionError("Unexpected end of selection")
+        if t == "(":
+            self.take()
+            node = self.disjunction()
+            if self.peek() != ")":
+                raise SelectionError("Missing closing parenthesis")
+            self.take()
+            return node
+        self.take()
+        if t in ("name","resname","chain"):
+            return Match(t,self.values())
+        if t in ("resid","resnr"):
+            ranges = []
+            for v in self.values():
+                try:
+                    lo, hi = (re.split("[-:]",v,1)+[v])[:2]
+                    ranges.append((int(lo),int(hi)))
+                except ValueError:
+                    raise SelectionError("Invalid residue number or range: %s" % v)
+            return Range(ranges)
+        if t == "group":
+            return IndexGroup(self.index,self.take().lower())
+        if t in ("all","none"):
+            return All(t == "all")
+        # The name of an index group
+        if self.index is not None:
+            return IndexGroup(self.index,t)
+        raise SelectionError("Unknown keyword: %s" % self.tokens[self.pos-1])
+
+
+class Expression:
+    """
+    Compiled selection expression. Expressions combine with &, | and ~,
+    like index groups and structure selections.
+    """
+
+    def __init__(self,text=None,index=None,node=None):
+        self.text     = text
+        self.node     = node or Parser(text,index).parse()
+        self._columns = None
+
+
+    def __str__(self):
+        return self.text
+
+
+    def __and__(self,other):
+        return Expression("(%s) and (%s)" % (self,other),node=And(self.node,other.node))
+
+
+    def __or__(self,other):
+        return Expression("(%s) or (%s)" % (self,other),node=Or(self.node,other.node))
+
+
+    def __invert__(self):
+        return Expression("not (%s)" % self,node=Not(self.node))
+
+
+    @property
+    def static(self):
+        return self.node.static
+
+
+    def mask(self,structure):
+        """Boolean mask over the atoms of the structure"""
+        if self._columns is None or self._columns[0] is not structure.atoms:
+            self._columns = (structure.atoms, columns(structure.atoms))
+        return self.node.mask(structure,self._columns[1])
+
+
+    def group(self,structure):
+        """Index group of the selected atoms"""
+        return Group(numpy.flatnonzero(self.mask(structure)),len(structure))
+
+
+    def __call__(self,structure):
+        return Selection(structure,self.mask(structure))
@@ -0,0 +1,60 @@
+
+"""The opt-in disk cache"""
+
+import os, shutil, tempfile, unittest
+
+from cache import Cache, fileTag
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        cache = Cache(os.path.join(self.dir,"cache"))
+        self.assertEqual(cache.load("tag"),None)
+        cache.save("tag",{"a": [1,2]},"name")
+        self.assertEqual(cache.load("tag","name"),{"a": [1,2]})
+        # Only the cache file, no temporary files left
+        self.assertEqual(os.listdir(cache.directory),[os.path.basename(cache.filename("tag","name"))])
+
+    def test_tag(self):
+        # A file with the name for a tag, but storing another tag
+        cache = Cache(self.dir)
+        cache.save("other","data")
+        os.rename(cache.filename("other"),cache.filename("tag"))
+        self.assertEqual(cache.load("tag"),None)
+
+    def test_disabled(self):
+        for cache in (Cache(), Cache(""), Cache.environ("GMX_NO_SUCH_VARIABLE")):
+            self.assertFalse(cache)
+            cache.save("tag","data")
+            self.assertEqual(cache.load("tag"),None)
+
+    def test_environ(self):
+        os.environ["GMX_TEST_CACHE"] = self.dir
+        try:
+            self.assertEqual(Cache.environ("GMX_TEST_CACHE",".idx").directory,self.dir)
+        finally:
+            del os.environ["GMX_TEST_CACHE"]
+
+    def test_broken(self):
+        cache = Cache(self.dir)
+        open(cache.filename("tag"),"w").write("not a pickle")
+        self.assertEqual(cache.load("tag"),None)
+
+    def test_filetag(self):
+        filename = os.path.join(self.dir,"file")
+        open(filename,"w").write("abc")
+        tag = fileTag(filename)
+        self.assertEqual(fileTag(filename),tag)
+        open(filename,"w").write("abcd")
+        self.assertNotEqual(fileTag(filename),tag)
+
+
+if __name__ == "__main__":
+    unittest.main()
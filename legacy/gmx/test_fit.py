@@ -0,0 +1,150 @@
+
+"""Kabsch fitting and (pairwise) RMSD over blocks of frames"""
+
+import unittest
+
+import numpy
+
+import fit
+from conf.structure import kabsch, Structure
+
+
+def rotation(rng):
+    """Random proper rotation matrix"""
+    q, r = numpy.linalg.qr(rng.normal(size=(3,3)))
+    q *= numpy.sign(numpy.diag(r))
+    if numpy.linalg.det(q) < 0:
+        q[:,0] *= -1
+    return q
+
+
+def msdQuaternion(X,Y):
+    """
+    Reference msd after optimal proper rotation, from the largest
+    eigenvalue of the 4x4 quaternion key matrix (Horn, 1987).
+    """
+    X = X - X.mean(axis=0)
+    Y = Y - Y.mean(axis=0)
+    S = numpy.dot(X.T,Y)
+    (xx,xy,xz),(yx,yy,yz),(zx,zy,zz) = S
+    K = numpy.array([[xx+yy+zz, yz-zy,     zx-xz,     xy-yx    ],
+                     [yz-zy,    xx-yy-zz,  xy+yx,     zx+xz    ],
+                     [zx-xz,    xy+yx,    -xx+yy-zz,  yz+zy    ],
+                     [xy-yx,    zx+xz,     yz+zy,    -xx-yy+zz ]])
+    l = numpy.linalg.eigvalsh(K).max()
+    return max(0,((X**2).sum()+(Y**2).sum()-2*l)/len(X))
+
+
+class TestKabsch(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(7)
+
+    def test_rotation(self):
+        X = self.rng.normal(size=(20,3))
+        R = rotation(self.rng)
+        Y = numpy.dot(X,R) + 1.5
+        Xc, Yc = X-X.mean(axis=0), Y-Y.mean(axis=0)
+        l, Q = kabsch(numpy.dot(Xc.T,Yc)[None])
+        self.assertTrue(numpy.allclose(Q[0],R))
+        self.assertTrue(numpy.allclose(numpy.dot(Xc,Q[0]),Yc))
+
+    def test_reflection(self):
+        # A mirror image can not be fitted by a proper rotation
+        X = self.rng.normal(size=(15,3))
+        Y = numpy.dot(X*[1,1,-1],rotation(self.rng))
+        Xc, Yc = X-X.mean(axis=0), Y-Y.mean(axis=0)
+        l, R = kabsch(numpy.dot(Xc.T,Yc)[None])
+        self.assertAlmostEqual(numpy.linalg.det(R[0]),1)
+        msd = ((Xc**2).sum()+(Yc**2).sum()-2*l[0])/len(X)
+        self.assertAlmostEqual(msd,msdQuaternion(X,Y))
+        self.assertAlmostEqual(msd,((numpy.dot(Xc,R[0])-Yc)**2).sum()/len(X))
+        self.assertTrue(msd > 0.01)
+
+    def test_stacked(self):
+        XY = self.rng.normal(size=(10,3,3))
+        l, R = kabsch(XY)
+        self.assertEqual(R.shape,(10,3,3))
+        self.assertTrue(numpy.allclose([numpy.linalg.det(i) for i in R],1))
+        self.assertTrue(numpy.allclose(l,[kabsch(i[None])[0][0] for i in XY]))
+
+    def test_structure_msd(self):
+        X = self.rng.normal(size=(12,3))
+        Y = self.rng.normal(size=(12,3))
+        s = Structure(coord=X)
+        self.assertAlmostEqual(s.msd(Y),msdQuaternion(X,Y))
+        self.assertAlmostEqual(s.select(range(6)).msd(Y),msdQuaternion(X[:6],Y[:6]))
+
+
+class TestFit(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(11)
+        self.ref    = rng.normal(size=(9,3))
+        self.frames = self.ref + 0.3*rng.normal(size=(23,9,3))
+
+    def test_rmsd(self):
+        expected = numpy.sqrt([msdQuaternion(i,self.ref) for i in self.frames])
+        # Blocks smaller than and not dividing the number of frames
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref,size=5),expected))
+        # Frames given one by one
+        self.assertTrue(numpy.allclose(fit.rmsd(list(self.frames),self.ref,size=4),expected))
+
+    def test_rmsd_index(self):
+        index    = [0,2,3,8]
+        expected = numpy.sqrt([msdQuaternion(i[index],self.ref[index]) for i in self.frames])
+        # The reference with all atoms or only the selected ones
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref,index=index,size=6),expected))
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref[index],index=index),expected))
+
+    def test_rmsd_mask(self):
+        mask     = numpy.zeros(9,dtype=bool)
+        mask[[0,2,3,8]] = True
+        expected = numpy.sqrt([msdQuaternion(i[mask],self.ref[mask]) for i in self.frames])
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref,index=mask,size=6),expected))
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref[mask],index=mask),expected))
+        self.assertTrue(numpy.allclose(fit.rmsd(list(self.frames),self.ref,index=mask,size=5),expected))
+
+    def test_rmsd_all_index(self):
+        # An index with as many atoms as the frames, but in another order:
+        # the reference has all atoms
+        index    = numpy.arange(9)[::-1]
+        expected = numpy.sqrt([msdQuaternion(i,self.ref) for i in self.frames])
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref,index=index),expected))
+
+    def test_rmsd_noalign(self):
+        expected = numpy.sqrt(((self.frames-self.ref)**2).sum(axis=2).mean(axis=1))
+        self.assertTrue(numpy.allclose(fit.rmsd(self.frames,self.ref,align=False,size=7),expected))
+
+    def test_fitblock(self):
+        fitted = fit.fitBlock(self.frames[:4],self.ref)
+        for x, y in zip(self.frames[:4],fitted):
+            self.assertAlmostEqual(((y-self.ref)**2).sum()/len(y),msdQuaternion(x,self.ref))
+
+    def test_pairwise(self):
+        F = len(self.frames)
+        expected = numpy.sqrt([[msdQuaternion(i,j) for j in self.frames] for i in self.frames])
+        numpy.fill_diagonal(expected,0)
+        # Chunks that do not divide the number of frames, and blocks
+        for chunk, size in ((7,5),(1,100),(64,3)):
+            D = fit.pairwise(self.frames,chunk=chunk,size=size)
+            self.assertEqual(D.shape,(F,F))
+            self.assertTrue(numpy.allclose(D,expected,atol=1e-6))
+            self.assertTrue(numpy.allclose(D,D.T))
+
+    def test_pairwise_index(self):
+        index = [1,4,5,6]
+        D = fit.pairwise(self.frames,index=index,chunk=5)
+        self.assertAlmostEqual(D[3,17],numpy.sqrt(msdQuaternion(self.frames[3][index],self.frames[17][index])))
+        mask = numpy.zeros(9,dtype=bool)
+        mask[index] = True
+        self.assertTrue(numpy.allclose(fit.pairwise(list(self.frames),index=mask,chunk=5),D))
+        self.assertEqual(fit.indices([True,False,True]).tolist(),[0,2])
+
+    def test_empty(self):
+        self.assertEqual(fit.pairwise(numpy.zeros((0,4,3))).shape,(0,0))
+        self.assertEqual(len(fit.rmsd([],self.ref)),0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+
+"""Index groups and index files"""
+
+import os, gzip, shutil, tempfile, unittest
+
+import numpy
+
+from index          import Group, Index
+from conf.structure import Structure
+
+
+def structure():
+    """Two residues in chain A, one in chain B"""
+    atoms = [("N","ALA",1,"A"),("CA","ALA",1,"A"),("N","GLY",2,"A"),("N","SER",1,"B"),("CA","SER",1,"B")]
+    return Structure(atoms=[i+(0.1*k,0,0) for k,i in enumerate(atoms)])
+
+
+class TestGroup(unittest.TestCase):
+
+    def test_sorted_unique(self):
+        g = Group([5,1,3,1])
+        self.assertEqual(g.tolist(),[1,3,5])
+        self.assertEqual(g.dtype,numpy.int32)
+
+    def test_operators(self):
+        g = Group([1,2,3],natoms=6)
+        self.assertEqual((g & Group([2,3,4])).tolist(),[2,3])
+        self.assertEqual((g | Group([0,3])).tolist(),[0,1,2,3])
+        self.assertEqual((g - Group([1])).tolist(),[2,3])
+        self.assertEqual((~g).tolist(),[0,4,5])
+        self.assertEqual((g & [0]).natoms,6)
+
+    def test_unsorted_operands(self):
+        # Plain lists are converted to groups first
+        g = Group([1,2,3])
+        self.assertEqual((g & [3,2,2]).tolist(),[2,3])
+        self.assertEqual((g | [5,0,0]).tolist(),[0,1,2,3,5])
+        self.assertEqual((g - [3,3,1]).tolist(),[2])
+
+    def test_complement(self):
+        self.assertRaises(ValueError,Group([1]).__invert__)
+        self.assertEqual(Group([1,3]).mask(4).tolist(),[False,True,False,True])
+
+
+class TestIndex(unittest.TestCase):
+
+    def test_bind(self):
+        index = Index()
+        index["structure"] = [0,1]
+        index["chain_b"]   = [3]
+        index.bind(structure())
+        # Groups are not hidden by attributes set by bind
+        self.assertEqual(index.structure.tolist(),[0,1])
+        self.assertEqual(index.chain.tolist(),[3])
+        self.assertEqual(index.structure.natoms,5)
+        self.assertEqual(index.residues([1]).tolist(),[0,1])
+        self.assertEqual(index.residues([2]).tolist(),[2])
+        self.assertEqual(index.chains([0]).tolist(),[0,1,2])
+        self.assertEqual(index.chains([4]).tolist(),[3,4])
+
+    def test_missing_group(self):
+        self.assertRaises(IndexError,getattr,Index(),"protein")
+
+
+class TestIndexFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        index = Index()
+        groups = {"empty": [], "one": [7], "full": range(15), "remainder": range(3,34,2), "large": [9998,12345,123456]}
+        for name, atoms in groups.items():
+            index[name] = atoms
+        filename = os.path.join(self.dir,"index.ndx")
+        index.write(filename)
+        other = Index(filename)
+        self.assertEqual(sorted(other.keys()),sorted(groups.keys()))
+        for name, atoms in groups.items():
+            self.assertEqual(other[name].tolist(),sorted(atoms))
+
+    def test_format(self):
+        index = Index()
+        index["remainder"] = range(17)
+        filename = os.path.join(self.dir,"index.ndx")
+        index.write(filename)
+        lines = open(filename).read().splitlines()
+        self.assertEqual(lines[0],"[ remainder ]")
+        self.assertEqual(lines[1].split(),[str(i) for i in range(1,16)])
+        self.assertEqual(lines[2],"  16   17")
+        self.assertEqual(len(lines),3)
+
+    def test_selected_groups(self):
+        index = Index()
+        index["a"], index["b"] = [1], [2]
+        filename = os.path.join(self.dir,"index.ndx")
+        index.write(filename,["b"])
+        self.assertEqual(Index(filename).keys(),["b"])
+
+    def test_read(self):
+        # GROMACS style names, numbers over several lines, gzipped
+        filename = os.path.join(self.dir,"index.ndx.gz")
+        f = gzip.open(filename,"w")
+        f.write("[ System ]\n   1    2\n   3\n[ Protein-H ]\n\n   2   3\n")
+        f.close()
+        index = Index(filename)
+        self.assertEqual(index.system.tolist(),[0,1,2])
+        self.assertEqual(index["protein_h"].tolist(),[1,2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+
+"""Block readers for GRO and PDB files, against the line by line parsers"""
+
+import os, shutil, tempfile, unittest
+
+import numpy
+
+from conf.reader import Ring, charMatrix, numbers
+from conf.gro    import groFrameIterator, groAtom, groline
+from conf.pdb    import pdbFrameIterator, pdbAtom
+
+
+def groText(nframes,natoms,prec=3):
+    fmt = groline.replace("8.3f","%d.%df"%(5+prec,prec))
+    out = []
+    for f in range(nframes):
+        out.append("Frame %d\n%5d\n" % (f,natoms))
+        for i in range(natoms):
+            out.append(fmt % (i//3+1,("ALA","GLY")[i%2],"CA",i+1,0.1*i+f,-0.2*i,0.3*i+0.001))
+        out.append("   5.00000   6.00000   7.00000\n")
+    return "".join(out)
+
+
+def pdbText(nframes,natoms):
+    out = []
+    for f in range(nframes):
+        out.append("TITLE     Model %d\nCRYST1   50.000   60.000   70.000  90.00  90.00  90.00 P 1           1\nMODEL     %4d\n" % (f,f+1))
+        for i in range(natoms):
+            out.append("ATOM  %5d  CA  ALA %s%4d    %8.3f%8.3f%8.3f  1.00%6.2f\n" % (i+1,"AB"[i>1],i+1,i+f,-2.0*i,3.0*i,0.5*i))
+        out.append("TER\nENDMDL\n")
+    return "".join(out)
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_charmatrix(self):
+        chars = charMatrix(["abc\n","a\n"],4)
+        self.assertEqual(chars.shape,(2,4))
+        self.assertEqual(["".join(i) for i in chars],["abc\n","a\n  "])
+
+    def test_numbers(self):
+        self.assertEqual(numbers(numpy.array(["1.5"," 2.0"])).tolist(),[1.5,2.0])
+        self.assertEqual(numbers(numpy.array(["  3","   "]),int,-1).tolist(),[3,-1])
+
+    def test_ring(self):
+        ring = Ring(2)
+        a, b, c = ring.next(4), ring.next(4), ring.next(4)
+        self.assertEqual(a.shape,(4,3))
+        self.assertFalse(numpy.may_share_memory(a,b))
+        self.assertTrue(numpy.may_share_memory(a,c))
+        # Another number of atoms starts a new ring
+        d = ring.next(5)
+        self.assertEqual(d.shape,(5,3))
+        self.assertFalse(numpy.may_share_memory(c,d))
+        # Without a ring, every frame gets its own array
+        ring = Ring()
+        self.assertFalse(numpy.may_share_memory(ring.next(4),ring.next(4)))
+
+
+class TestFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self,name,text):
+        filename = os.path.join(self.dir,name)
+        with open(filename,"w") as f:
+            f.write(text)
+        return filename
+
+    def check(self,frame,atoms,box):
+        # The atom data and coordinates match the line parsers
+        self.assertEqual(frame.atoms.tolist(),[[a[0],a[1],str(a[2]),a[3]] for a in atoms])
+        self.assertEqual(list(frame.names),[a[1] for a in atoms])
+        self.assertTrue(numpy.allclose(frame,[a[4:7] for a in atoms]))
+        self.assertTrue(numpy.allclose(frame.box(),box))
+
+    def test_gro(self):
+        for prec in (3,4):
+            text   = groText(3,7,prec)
+            frames = list(groFrameIterator(self.write("traj.gro",text)))
+            lines  = text.splitlines(True)
+            self.assertEqual(len(frames),3)
+            for f,frame in enumerate(frames):
+                atoms = [groAtom(i) for i in lines[10*f+2:10*f+9]]
+                self.check(frame,atoms,numpy.diag([5.,6.,7.]))
+                self.assertEqual(frame.title,"Frame %d\n" % f)
+            # The atom data are shared between frames
+            self.assertTrue(frames[0].atoms is frames[2].atoms)
+
+    def test_pdb(self):
+        text   = pdbText(2,4)
+        frames = list(pdbFrameIterator(self.write("traj.pdb",text)))
+        lines  = [i for i in text.splitlines(True) if i.startswith("ATOM")]
+        self.assertEqual(len(frames),2)
+        for f,frame in enumerate(frames):
+            atoms = [pdbAtom(i) for i in lines[4*f:4*f+4]]
+            self.check(frame,atoms,numpy.diag([5.,6.,7.]))
+            self.assertEqual(frame.b.tolist(),[a[8] for a in atoms])
+            self.assertTrue(frame.title.startswith("TITLE     Model %d" % f))
+        self.assertTrue(frames[0].atoms is frames[1].atoms)
+        # A single model without ENDMDL
+        frames = list(pdbFrameIterator(self.write("single.pdb",text.split("TER")[0])))
+        self.assertEqual(len(frames),1)
+        self.assertEqual(len(frames[0]),4)
+
+    def test_ring(self):
+        # With a ring, the coordinates of older frames are overwritten
+        filename = self.write("traj.gro",groText(3,4))
+        frames   = list(groFrameIterator(filename,ring=2))
+        self.assertTrue(numpy.allclose(frames[2][:,0],0.1*numpy.arange(4)+2))
+        self.assertTrue(numpy.may_share_memory(frames[0],frames[2]))
+        iterator = groFrameIterator(filename,ring=2)
+        x = [numpy.array(i) for i in iterator]
+        self.assertTrue(numpy.allclose(x[1][:,0],0.1*numpy.arange(4)+1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+
+"""Selection expressions and the within cell list"""
+
+import unittest
+
+import numpy
+
+from selection      import within, Expression, SelectionError
+from index          import Index
+from conf.structure import Structure
+
+
+def bruteWithin(x,ref,cutoff,L=None):
+    d = x[:,None,:]-ref[None,:,:]
+    if L is not None:
+        d -= L*numpy.round(d/L)
+    return ((d**2).sum(axis=2) <= cutoff**2).any(axis=1)
+
+
+def structure(coord=None,box=None):
+    """Chain A: ALA 1 (N, CA, CB), GLY 2 (N, CA); chain B: LIG 10 (C1, C2)"""
+    atoms = [("N","ALA","1","A"),("CA","ALA","1","A"),("CB","ALA","1","A"),
+             ("N","GLY","2","A"),("CA","GLY","2","A"),
+             ("C1","LIG","10","B"),("C2","LIG","10","B")]
+    if coord is None:
+        coord = [(0.1*i,0,0) for i in range(len(atoms))]
+    return Structure(atoms=numpy.array(atoms),coord=numpy.array(coord,dtype=float),box=box)
+
+
+class TestWithin(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(3)
+
+    def test_nonperiodic(self):
+        x   = self.rng.uniform(-2,3,size=(400,3))
+        ref = self.rng.uniform(0,1,size=(30,3))
+        for cutoff in (0.1,0.35,2.0):
+            self.assertTrue((within(x,ref,cutoff) == bruteWithin(x,ref,cutoff)).all())
+        # Processing in chunks
+        self.assertTrue((within(x,ref,0.35,chunk=37) == bruteWithin(x,ref,0.35)).all())
+
+    def test_periodic(self):
+        L   = numpy.array([4.0,5.0,6.0])
+        box = numpy.diag(L)
+        # Points outside the box are wrapped
+        x   = self.rng.uniform(-1,7,size=(500,3))
+        ref = self.rng.uniform(0,6,size=(40,3))
+        for cutoff in (0.3,0.8):
+            self.assertTrue((within(x,ref,cutoff,box) == bruteWithin(x,ref,cutoff,L)).all())
+        self.assertTrue((within(x,ref,0.8,box,chunk=50) == bruteWithin(x,ref,0.8,L)).all())
+
+    def test_periodic_small(self):
+        # Fewer than three cells in some dimensions
+        L   = numpy.array([1.0,2.5,6.0])
+        x   = self.rng.uniform(0,6,size=(300,3))
+        ref = self.rng.uniform(0,6,size=(10,3))
+        for cutoff in (0.45,0.9,1.2):
+            self.assertTrue((within(x,ref,cutoff,numpy.diag(L)) == bruteWithin(x,ref,cutoff,L)).all())
+
+    def test_across_boundary(self):
+        box = numpy.diag([3.0,3.0,3.0])
+        x   = numpy.array([[0.05,1,1],[1.5,1,1]])
+        ref = numpy.array([[2.95,1,1]])
+        self.assertEqual(within(x,ref,0.2,box).tolist(),[True,False])
+        self.assertEqual(within(x,ref,0.2).tolist(),[False,False])
+
+    def test_triclinic(self):
+        # Boxes that are not rectangular are not treated as periodic
+        box = numpy.array([[3.0,0,0],[1.0,3.0,0],[0,0,3.0]])
+        x   = self.rng.uniform(0,3,size=(100,3))
+        ref = self.rng.uniform(0,3,size=(5,3))
+        self.assertTrue((within(x,ref,0.5,box) == bruteWithin(x,ref,0.5)).all())
+
+    def test_empty(self):
+        self.assertEqual(len(within(numpy.zeros((0,3)),numpy.ones((2,3)),1)),0)
+        self.assertFalse(within(numpy.ones((3,3)),numpy.zeros((0,3)),1).any())
+
+
+class TestExpression(unittest.TestCase):
+
+    def select(self,text,s=None,index=None):
+        return numpy.flatnonzero(Expression(text,index).mask(structure() if s is None else s)).tolist()
+
+    def test_keywords(self):
+        self.assertEqual(self.select("name CA"),[1,4])
+        self.assertEqual(self.select("name C?"),[1,2,4,5,6])
+        self.assertEqual(self.select("resname ALA GLY"),[0,1,2,3,4])
+        self.assertEqual(self.select("resid 2-10"),[3,4,5,6])
+        self.assertEqual(self.select("resnr 1 10:10"),[0,1,2,5,6])
+        self.assertEqual(self.select("chain B"),[5,6])
+        self.assertEqual(self.select("all"),range(7))
+        self.assertEqual(self.select("none"),[])
+
+    def test_operators(self):
+        self.assertEqual(self.select("name CA and resid 2"),[4])
+        self.assertEqual(self.select("name N or name CB and resid 1"),[0,2,3])
+        self.assertEqual(self.select("(name N or name CB) and resid 2"),[3])
+        self.assertEqual(self.select("not chain A"),[5,6])
+        self.assertEqual(self.select("!name N & resname ALA | name C1"),[1,2,5])
+
+    def test_combine(self):
+        a, b = Expression("name CA"), Expression("resid 2")
+        s = structure()
+        self.assertEqual(numpy.flatnonzero((a & b).mask(s)).tolist(),[4])
+        self.assertEqual(numpy.flatnonzero((a | b).mask(s)).tolist(),[1,3,4])
+        self.assertEqual(numpy.flatnonzero((~a).mask(s)).tolist(),[0,2,3,5,6])
+        self.assertEqual(Expression("name CA").group(s).tolist(),[1,4])
+        self.assertEqual(Expression("name CA")(s).index.tolist(),[1,4])
+
+    def test_within(self):
+        e = Expression("within 0.15 of resname LIG")
+        self.assertFalse(e.static)
+        self.assertEqual(numpy.flatnonzero(e.mask(structure())).tolist(),[4,5,6])
+        # Across the periodic boundary
+        coord = [(0.1*i,0,0) for i in range(6)] + [(0.95,0,0)]
+        s = structure(coord,numpy.diag([1.0,1.0,1.0]))
+        self.assertEqual(self.select("within 0.1 of name C2 and not resname LIG",s),[0])
+
+    def test_frames(self):
+        # Frames sharing the atom table: only within is determined again
+        e = Expression("name CA and within 0.25 of chain B")
+        s = structure()
+        self.assertEqual(numpy.flatnonzero(e.mask(s)).tolist(),[4])
+        x = numpy.array(s)
+        x[5:,0] = (0.0,0.05)
+        t = Structure(atoms=s.atoms,coord=x)
+        self.assertEqual(numpy.flatnonzero(e.mask(t)).tolist(),[1])
+
+    def test_groups(self):
+        index = Index()
+        index["ligand"] = [5,6]
+        self.assertEqual(self.select("group ligand",index=index),[5,6])
+        self.assertEqual(self.select("lig or name N",index=index),[0,3,5,6])
+        self.assertRaises(SelectionError,self.select,"group ligand")
+
+    def test_errors(self):
+        for text in ("", "name", "name CA and", "resid a-b", "resid 1-", "(name CA",
+                     "name CA)", "foo", "within x of name CA", "within 0.5 name CA",
+                     "within", "and name CA"):
+            self.assertRaises(SelectionError,Expression,text)
+
+
+if __name__ == "__main__":
+    unittest.main()
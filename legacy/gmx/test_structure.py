@@ -0,0 +1,62 @@
+
+"""Selections of a Structure and their cached descriptors"""
+
+import unittest
+
+import numpy
+
+from conf.structure import Structure, msd
+
+
+class TestSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(5)
+        self.s   = Structure(coord=self.rng.normal(size=(10,3)))
+
+    def check(self,sel):
+        x = numpy.array(self.s)[sel.index]
+        self.assertTrue(numpy.allclose(sel.x(),x))
+        self.assertTrue(numpy.allclose(sel.mean(),x.mean(axis=0)))
+        self.assertTrue(numpy.allclose(sel.centered(),x-x.mean(axis=0)))
+        self.assertAlmostEqual(sel.radiusOfGyrationSquared(),((x-x.mean(axis=0))**2).sum())
+
+    def test_cached(self):
+        sel = self.s.select([1,3,4,8])
+        self.check(sel)
+        # Unchanged coordinates give the stored values
+        self.assertTrue(sel.centered() is sel.centered())
+        self.assertEqual(self.s.select(numpy.arange(10) < 4).index.tolist(),[0,1,2,3])
+        self.assertEqual(self.s.select(slice(2,5)).index.tolist(),[2,3,4])
+
+    def test_invalidate(self):
+        # Item assignment and in-place arithmetic are noticed
+        sel = self.s.select([0,2,5])
+        self.check(sel)
+        self.s[2] = (5,5,5)
+        self.check(sel)
+        self.s += 1
+        self.check(sel)
+        self.s *= 2
+        self.check(sel)
+        g = self.s.radiusOfGyrationSquared()
+        self.s[0] = (9,9,9)
+        self.assertNotAlmostEqual(self.s.radiusOfGyrationSquared(),g)
+        # Writes through a view need a touch
+        numpy.multiply(self.s,3,out=numpy.asarray(self.s))
+        self.s.touch()
+        self.check(sel)
+
+    def test_msd_noalign(self):
+        # Selections of different structures, each with its own coordinates
+        t = Structure(coord=self.rng.normal(size=(10,3)))
+        y = self.rng.normal(size=(10,3))
+        a, b = self.s.select([0,1,2]), t.select([4,5,6,7])
+        d = msd([a,b],y,align=False)
+        self.assertAlmostEqual(d[0],((numpy.array(self.s)[:3]-y[:3])**2).sum()/3)
+        self.assertAlmostEqual(d[1],((numpy.array(t)[4:8]-y[4:8])**2).sum()/4)
+        self.assertAlmostEqual(b.msd(y,align=False),d[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
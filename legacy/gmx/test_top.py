@@ -0,0 +1,108 @@
+
+"""Topologies with molecules kept as blocks, and the parsed file cache"""
+
+import os, shutil, tempfile, unittest
+
+import numpy
+
+from cache   import Cache
+from top     import top
+from top.top import TOP
+
+
+itp = """
+[ moleculetype ]
+; name  nrexcl
+PEP     1
+
+[ atoms ]
+; nr type resnr resname atom cgnr
+  1   P5   1    ALA     BB   1
+  2   P5   2    GLY     BB   2
+  3   C1   2    GLY     SC1  3 ; comment
+  4   C1   2    GLY     SC1  4
+"""
+
+topol = """
+#include "pep.itp"
+
+[ moleculetype ]
+W       1
+
+[ atoms ]
+  1   P4   1    W       W    1
+
+[ system ]
+Test
+
+[ molecules ]
+PEP     2
+W       3
+PEP     1
+"""
+
+
+class TestTOP(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir,"pep.itp"),"w") as f:
+            f.write(itp)
+        self.filename = os.path.join(self.dir,"topol.top")
+        with open(self.filename,"w") as f:
+            f.write(topol)
+        self.topcache = top.topcache
+        top.topcache  = Cache()
+        top._parsed.clear()
+
+    def tearDown(self):
+        top.topcache = self.topcache
+        top._parsed.clear()
+        shutil.rmtree(self.dir)
+
+    def test_blocks(self):
+        t = TOP(self.filename)
+        self.assertEqual(t.molecules,[("PEP",2),("W",3),("PEP",1)])
+        self.assertEqual(t.nmolecules,6)
+        self.assertEqual(t.natoms,15)
+        self.assertEqual(len(t.atoms),15)
+        self.assertEqual(len(t.residues),3*2+3)
+        self.assertEqual(list(t.expand()),["PEP","PEP","W","W","W","PEP"])
+
+    def test_tables(self):
+        t = TOP(self.filename)
+        atoms = t.atomtable()
+        self.assertEqual(atoms["name"].tolist(),[a[0] for a in t.atoms])
+        self.assertEqual(atoms["resname"].tolist(),[a[1] for a in t.atoms])
+        self.assertEqual(atoms["chain"].tolist(),[a[3] for a in t.atoms])
+        self.assertEqual(atoms["moltype"].tolist(),[a[7] for a in t.atoms])
+        res = t.residuetable()
+        # The residue offsets agree with the expanded residue list
+        self.assertEqual(res["start"].tolist(),list(numpy.cumsum([0]+[len(r) for r in t.residues])))
+        self.assertEqual(res["resname"].tolist(),[r[0][1] for r in t.residues])
+        self.assertEqual(res["first"].tolist(),[1,0,1,0,1,1,1,1,0])
+        self.assertEqual(res["molend"].tolist(),[2,2,4,4,5,6,7,9,9])
+        self.assertEqual(res["dup"].tolist(),[0,1,0,1,0,0,0,0,1])
+        self.assertEqual(res["moldup"].tolist(),[1,1,1,1,0,0,0,1,1])
+
+    def test_cache(self):
+        top.topcache = Cache(os.path.join(self.dir,"cache"))
+        TOP(self.filename)
+        self.assertEqual(len(os.listdir(top.topcache.directory)),2)
+        # The second time, the files are read from the cache
+        top._parsed.clear()
+        parseFile = top.parseFile
+        top.parseFile = None
+        try:
+            self.assertEqual(TOP(self.filename).natoms,15)
+        finally:
+            top.parseFile = parseFile
+        # But not after a file changed
+        with open(os.path.join(self.dir,"pep.itp"),"a") as f:
+            f.write("  5   C1   2    GLY     SC2  5\n")
+        top._parsed.clear()
+        self.assertEqual(TOP(self.filename).natoms,18)
+
+
+if __name__ == "__main__":
+    unittest.main()
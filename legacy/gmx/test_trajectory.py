@@ -0,0 +1,152 @@
+
+"""Frame offsets and random access to multi-frame GRO/PDB files"""
+
+import os, gzip, shutil, tempfile, unittest
+
+import numpy
+
+from cache           import Cache
+from conf            import trajectory
+from conf.trajectory import Trajectory, groOffsets, pdbOffsets, isBox
+
+
+groline = "%5d%-5s%5s%5d%8.3f%8.3f%8.3f"
+
+
+def groFrames(nframes,natoms,extra=lambda f,i: ""):
+    """Lines per frame of a GRO file; extra gives text to append to atom lines"""
+    frames = []
+    for f in range(nframes):
+        lines = ["Frame %d\n" % f, "%5d\n" % natoms]
+        for i in range(natoms):
+            lines.append(groline % (i//3+1,"ALA","CA",i+1,0.1*i+f,0.2*i,0.3*i) + extra(f,i) + "\n")
+        lines.append("   5.00000   5.00000   5.00000\n")
+        frames.append(lines)
+    return frames
+
+
+def pdbFrames(nframes,natoms):
+    frames = []
+    for f in range(nframes):
+        lines = ["TITLE     Model %d\n" % f, "CRYST1   50.000   50.000   50.000  90.00  90.00  90.00 P 1           1\n",
+                 "MODEL     %4d\n" % (f+1)]
+        for i in range(natoms):
+            lines.append("ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f  1.00  0.00\n" % (i+1,i+1,i+f,2.0*i,3.0*i))
+        lines.append("ENDMDL\n")
+        frames.append(lines)
+    return frames
+
+
+def offsets(frames):
+    """Expected offsets from the frame lines"""
+    out = [0]
+    for lines in frames:
+        out.append(out[-1]+len("".join(lines)))
+    return out
+
+
+class TestOffsets(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self,name,frames):
+        filename = os.path.join(self.dir,name)
+        with open(filename,"w") as f:
+            f.write("".join(["".join(i) for i in frames]))
+        return filename
+
+    def test_isbox(self):
+        self.assertTrue(isBox("   5.00000   5.00000   5.00000\n"))
+        self.assertTrue(isBox(" 5 5 5 0 0 1 0 1 1\n"))
+        self.assertFalse(isBox(groline % (1,"ALA","CA",1,0,0,0) + "\n"))
+        self.assertFalse(isBox("a b c\n"))
+
+    def test_gro_fixed(self):
+        frames = groFrames(4,7)
+        with open(self.write("fixed.gro",frames),"rb") as f:
+            self.assertEqual(groOffsets(f),offsets(frames))
+
+    def test_gro_variable(self):
+        # Velocities on some lines only: the lines differ in length
+        frames = groFrames(3,5,lambda f,i: (i == f) and "  0.1000  0.2000  0.3000" or "")
+        with open(self.write("variable.gro",frames),"rb") as f:
+            self.assertEqual(groOffsets(f),offsets(frames))
+
+    def test_gro_natoms(self):
+        # Frames with different numbers of atoms, including a single atom
+        frames = groFrames(1,3) + groFrames(1,1) + groFrames(1,12)
+        with open(self.write("natoms.gro",frames),"rb") as f:
+            self.assertEqual(groOffsets(f),offsets(frames))
+
+    def test_pdb(self):
+        frames = pdbFrames(3,4)
+        with open(self.write("models.pdb",frames),"rb") as f:
+            self.assertEqual(pdbOffsets(f),offsets(frames))
+
+    def test_pdb_single(self):
+        # No MODEL/ENDMDL records
+        frames = [pdbFrames(1,4)[0][3:-1]]
+        with open(self.write("single.pdb",frames),"rb") as f:
+            self.assertEqual(pdbOffsets(f),offsets(frames))
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.confcache = trajectory.confcache
+        trajectory.confcache = Cache(os.path.join(self.dir,"cache"),".idx")
+
+    def tearDown(self):
+        trajectory.confcache = self.confcache
+        shutil.rmtree(self.dir)
+
+    def check(self,filename,nframes):
+        traj = Trajectory(filename)
+        sequential = [numpy.array(i) for i in Trajectory(filename)]
+        self.assertEqual(len(traj),nframes)
+        self.assertEqual(len(sequential),nframes)
+        for k in (2,0,-1,1):
+            self.assertTrue(numpy.allclose(traj[k],sequential[k]))
+        self.assertEqual(len(traj[::2]),(nframes+1)//2)
+        self.assertRaises(IndexError,traj.frame,nframes)
+        traj.close()
+
+    def test_gro(self):
+        filename = os.path.join(self.dir,"traj.gro")
+        with open(filename,"w") as f:
+            f.write("".join(["".join(i) for i in groFrames(5,6)]))
+        self.check(filename,5)
+        # The offsets are stored and read back
+        self.assertEqual(len(os.listdir(trajectory.confcache.directory)),1)
+        self.assertEqual(Trajectory(filename).offsets.tolist(),offsets(groFrames(5,6)))
+
+    def test_no_cache(self):
+        trajectory.confcache = Cache()
+        filename = os.path.join(self.dir,"traj.gro")
+        with open(filename,"w") as f:
+            f.write("".join(["".join(i) for i in groFrames(3,4)]))
+        self.check(filename,3)
+        self.assertFalse(os.path.exists(os.path.join(self.dir,"cache")))
+
+    def test_gro_gz(self):
+        filename = os.path.join(self.dir,"traj.gro.gz")
+        f = gzip.open(filename,"w")
+        f.write("".join(["".join(i) for i in groFrames(4,6)]))
+        f.close()
+        self.check(filename,4)
+
+    def test_pdb(self):
+        filename = os.path.join(self.dir,"traj.pdb")
+        with open(filename,"w") as f:
+            f.write("".join(["".join(i) for i in pdbFrames(4,5)]))
+        self.check(filename,4)
+        self.assertTrue(Trajectory(filename)[3].title.startswith("TITLE     Model 3"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,8 @@
 
 
+import sys, random, math, re, os, itertools, numpy
 
-import sys, random, math, re, os, itertools
+from gmx.cache import Cache, fileTag
 
 
 
@@ -12,6 +13,10 @@ import sys, random, math, re, os, itertools
 includePattern = re.compile('#include "(.*)"')
 
 
+# Gromacs topology directive
+tagPattern = re.compile('^ *\[ *(.*) *\]')
+
+
 # Gromacs force field directory
 gmxlib = os.environ.get("GMXLIB")
 if not gmxlib:
@@ -22,6 +27,28 @@ if not gmxlib:
         gmxlib="."
 
 
+# Parsed topology files are stored between runs in the directory
+# given by GMXTOPCACHE, if that is set.
+topcache = Cache.environ("GMXTOPCACHE")
+
+
+# Directives for which data lines are retained when parsing.
+# Everything else (bondtypes, dihedraltypes, ...) only needs
+# to be seen to keep track of the current directive.
+_keep = ("moleculetype","atoms","molecules")
+
+
+# Parsed files, keyed by (path, mtime, size)
+_parsed = {}
+
+
+def findInclude(name,dir):
+    """Resolve an #included file name like grompp does; return None if not found"""
+    for fr in (name, os.path.join(dir,name), os.path.join(gmxlib,name)):
+        if os.path.exists(fr):
+            return fr
+    return None
+
 
 # The following function finds and follows #included files
 def reciter(filename):
@@ -33,20 +60,14 @@ def reciter(filename):
 
         # Check for an #include statement; yield the line if there is none
         if line.strip().startswith("#include"):
-            
-            # Extract the #include filename             
+
+            # Extract the #include filename
             matches = re.findall(includePattern,line)
 
             if matches:
-                fr = matches[0]
-
-                if not os.path.exists(fr):
-                    fr = os.path.join(dir,matches[0])
-
-                if not os.path.exists(fr):
-                    fr = os.path.join(gmxlib,matches[0])
+                fr = findInclude(matches[0],dir)
 
-                if not os.path.exists(fr):
+                if not fr:
                     yield "; " + line + " ; File not found\n"
                 else:
                     for j in reciter(fr):
@@ -55,116 +76,314 @@ def reciter(filename):
             yield line
 
 
-class TOP:
-    def __init__(self,other,out=None):
-        
-        # Process the topology file extract moleculetypes, atom lists and the molecule list
-        self.molecules = []
-        self.top       = []
+def parseFile(filename):
+    """
+    Parse a single topology file, without following #includes.
 
-        # Processed topology
-        # This is equal to the input target topology, but with all #include statements resolved
-        if out:
-            out = open(out,"w")
+    Returns a list of records (kind, item):
+      ("D", directive)     - start of a directive
+      ("I", include)       - an #include statement, not yet resolved
+      ("F", fields)        - data line (comments stripped, split), only
+                             for the directives that are needed to build
+                             the molecule list, or for lines before the
+                             first directive, which inherit the directive
+                             from the including file.
+    """
 
-        # List of line numbers at which to find moleculetype definitions
-        mols     = []
+    records = []
+    cur     = None
 
-        # Moleculetypes
-        moltypes = []
+    for line in open(filename):
 
-        # Atoms per moleculetype
-        atoms    = []
+        # Strip leading and trailing spaces
+        s = line.strip()
 
-        # Gromacs topology directive
-        tag      = re.compile('^ *\[ *(.*) *\]')
+        # Lines starting with [ indicate a directive
+        if s.startswith("["):
+            cur = re.findall(tagPattern,s)[0].strip()
+            records.append(("D",cur))
+            continue
 
-        # Last directive read (current)
-        cur      = None
+        if s.startswith("#include"):
+            matches = re.findall(includePattern,s)
+            if matches:
+                records.append(("I",matches[0]))
+            continue
 
-        # Set line counter
-        counter = 0
+        # Conditionals :S
+        # Conditionals are simply skipped
+        if s.startswith("#"):
+            continue
 
-        # Iterate over lines, processing #included files
-        for line in reciter(other):
-            if out:
-                out.write(line)
+        # Strip comments
+        s = s.split(';')[0].strip()
 
-            # Increment the line counter
-            counter += 1
+        # Skip empty lines and data for directives we do not need
+        if s and (cur is None or cur in _keep):
+            records.append(("F",s.split()))
 
-            # Add the line to the (processed) topology
-            self.top.append(line)
+    return records
 
-            # Strip leading and trailing spaces
-            s = line.strip()
 
-            # Lines starting with [ indicate a directive
-            if s.startswith("["):
-                # Extract the directive name
-                cur = re.findall(tag,s)[0].strip()
-                continue
+def cachedParse(filename):
+    """
+    Return the parsed records for a file, reading them from memory
+    or from the disk cache if the file did not change since.
+    """
 
-            # Conditionals :S
-            # Conditionals are simply skipped             
-            if s.startswith("#"):
-                continue            
+    path = os.path.abspath(filename)
+    st   = os.stat(path)
+    key  = (path, st.st_mtime, st.st_size)
 
-            # Strip comments
-            s = s.split(';')[0].strip()
+    records = _parsed.get(key)
+    if records is not None:
+        return records
 
-            # Skip empty lines
-            if not s:
-                continue
+    tag     = fileTag(path)
+    records = topcache.load(tag, os.path.basename(path))
+    if records is None:
+        records = parseFile(path)
+        topcache.save(tag, records, os.path.basename(path))
 
-            if cur == "moleculetype":
-                moltypes.append(s.split()[0])
-                atoms.append([])
-                mols.append(counter)
+    _parsed[key] = records
+
+    return records
+
+
+def reciterRecords(filename):
+    """Iterate over the parsed records of a topology, following #includes"""
+
+    dir = os.path.dirname(filename)
+
+    for kind, item in cachedParse(filename):
+        if kind == "I":
+            fr = findInclude(item,dir)
+            if fr:
+                for j in reciterRecords(fr):
+                    yield j
+        else:
+            yield kind, item
+
+
+class MoleculeType:
+    """Array based atom and residue table for a moleculetype"""
+
+    def __init__(self,name,atoms):
+        self.name = name
+
+        # Atom name, residue name and residue number (as given in the topology)
+        if atoms:
+            self.names, self.resnames, self.resids = [numpy.array(i) for i in zip(*atoms)[:3]]
+        else:
+            self.names, self.resnames, self.resids = [numpy.array([],dtype=str) for i in range(3)]
+
+        # Offsets of the residues in the atom list, with the total
+        # number of atoms added as last element.
+        n = len(self.names)
+        if n:
+            new = numpy.ones(n,dtype=bool)
+            new[1:] = (self.resnames[1:] != self.resnames[:-1]) | (self.resids[1:] != self.resids[:-1])
+            self.offsets = numpy.append(numpy.flatnonzero(new), n)
+        else:
+            self.offsets = numpy.array([0])
+
+    def __len__(self):
+        return len(self.names)
+
+
+class TOP(object):
+    def __init__(self,other,out=None):
+
+        # Process the topology file extract moleculetypes, atom lists and the molecule list
+        self.filename  = other
+
+        # Moleculetypes; atoms per moleculetype
+        self.moleculetypes = {}
+
+        # Molecules as listed in the topology: (moleculetype, count) blocks
+        self.molecules = []
+
+        # Lazily generated stuff
+        self._tables   = {}
+        self._atoms    = None
+        self._residues = None
+        self._top      = None
+
+        # Last directive read (current) and current moleculetype
+        cur   = None
+        atoms = None
+
+        # Iterate over records, processing #included files
+        for kind, item in reciterRecords(other):
+
+            if kind == "D":
+                cur = item
                 continue
 
-            if cur == "system":
-                mols.append(counter)
+            if cur == "moleculetype":
+                atoms = []
+                self.moleculetypes[item[0]] = atoms
                 continue
 
             if cur == "atoms":
                 # Comments are already skipped
-                a = s.split()                
-                atoms[-1].append((a[4],a[3],a[2],""))
+                atoms.append((item[4],item[3],item[2],""))
                 continue
 
             if cur == "molecules":
                 # Each molecules entry has a moleculetype name and a number
-                # The moleculetype name is added to the molecules list 
-                # as many times as the number indicates. This makes it easy
-                # to expand the molecules to atoms.
-                m = s.split()
-                for j in range(int(m[1])):
-                    self.molecules.append(m[0])
+                # These are kept as blocks, which are only expanded to
+                # atoms when requested.
+                self.molecules.append((item[0],int(item[1])))
 
+        # Processed topology
+        # This is equal to the input target topology, but with all #include statements resolved
         if out:
+            out = open(out,"w")
+            out.writelines(reciter(other))
             out.close()
 
 
-        # Convert moleculetypes to dictionary
-        self.moleculetypes = dict(zip(moltypes,atoms))
+    @property
+    def top(self):
+        """Processed topology lines, with #includes resolved"""
+        if self._top is None:
+            self._top = list(reciter(self.filename))
+        return self._top
+
+
+    @property
+    def natoms(self):
+        return sum([count*len(self.moleculetypes[t]) for t,count in self.molecules])
+
+
+    @property
+    def nmolecules(self):
+        return sum([count for t,count in self.molecules])
+
+
+    def moleculetype(self,name):
+        """Array based table for the moleculetype with the given name"""
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = MoleculeType(name,self.moleculetypes[name])
+        return table
+
+
+    def atomtable(self):
+        """
+        Return a dictionary of arrays for all atoms in the system:
+        name, resname, resid, chain (molecule index) and moltype.
+        """
+        names, resnames, resids, chains, moltypes = [], [], [], [], []
+
+        chain = 0
+        for t, count in self.molecules:
+            mt = self.moleculetype(t)
+            n  = len(mt)
+            names.append(numpy.tile(mt.names,count))
+            resnames.append(numpy.tile(mt.resnames,count))
+            resids.append(numpy.tile(mt.resids,count))
+            chains.append(numpy.repeat(numpy.arange(chain,chain+count),n))
+            moltypes.append(numpy.repeat(numpy.array([t]),n*count))
+            chain += count
+
+        if not names:
+            return dict([(i,numpy.array([])) for i in ("name","resname","resid","chain","moltype")])
+
+        return {
+            "name":    numpy.concatenate(names),
+            "resname": numpy.concatenate(resnames),
+            "resid":   numpy.concatenate(resids),
+            "chain":   numpy.concatenate(chains),
+            "moltype": numpy.concatenate(moltypes)
+            }
+
+
+    def residuetable(self):
+        """
+        Return a dictionary of arrays for all residues in the system:
+          start   - offset of the first atom (one extra element at the end)
+          resname - residue name
+          moltype - moleculetype name
+          chain   - molecule index
+          molend  - index of the first residue of the next molecule
+          first   - whether the residue is the first of its molecule
+          dup     - whether the residue has duplicate atom names
+          moldup  - whether the molecule has duplicate atom names
+        The table is built per moleculetype and tiled over the molecule
+        blocks, so it does not require expanding the atom list.
+        """
+        keys = ("resname","moltype","chain","molend","first","dup","moldup")
+        cols = dict([(i,[]) for i in keys])
+        starts = []
+
+        atom  = 0
+        chain = 0
+        nres  = 0
+        for t, count in self.molecules:
+            mt = self.moleculetype(t)
+            n  = len(mt)
+            r  = len(mt.offsets)-1
+            if not count or not r:
+                chain += count
+                continue
+
+            # Per residue stuff for a single molecule
+            first  = numpy.zeros(r,dtype=bool)
+            first[0] = True
+            dup    = numpy.array([len(set(mt.names[a:b])) < b-a for a,b in zip(mt.offsets[:-1],mt.offsets[1:])])
+            moldup = len(set(mt.names)) < n
+
+            mols = numpy.arange(count)
+            starts.append((atom + mt.offsets[:-1] + n*mols[:,None]).ravel())
+            cols["resname"].append(numpy.tile(mt.resnames[mt.offsets[:-1]],count))
+            cols["moltype"].append(numpy.repeat(numpy.array([t]),r*count))
+            cols["chain"].append(numpy.repeat(chain+mols,r))
+            cols["molend"].append(numpy.repeat(nres+r*(mols+1),r))
+            cols["first"].append(numpy.tile(first,count))
+            cols["dup"].append(numpy.tile(dup,count))
+            cols["moldup"].append(numpy.repeat(numpy.array([moldup]),r*count))
+
+            atom  += n*count
+            chain += count
+            nres  += r*count
+
+        table = dict([(i,numpy.concatenate(j) if j else numpy.array([])) for i,j in cols.items()])
+        table["start"] = numpy.append(numpy.concatenate(starts) if starts else numpy.array([],dtype=int),atom)
+
+        return table
 
-        molecules = [(i,len(list(j))) for i,j in itertools.groupby(self.molecules)]
 
+    @property
+    def atoms(self):
         # Build a full atom list
         # The chain identifier is unique for each molecule
         # The moleculetype name is added as last element
-        mr = zip(self.molecules, range(len(self.molecules)))
-        self.atoms = [[a,r,i,c,0,0,0,t] for t,c in mr for a,r,i,m in self.moleculetypes[t]]
-
-        # Build a residue list
-        if self.atoms:
-            self.residues = [[self.atoms[0]]]        
-            for i in self.atoms[1:]:
-                if i[1:4] != self.residues[-1][-1][1:4]:
-                    self.residues.append([])
-                self.residues[-1].append(i)
-        else:
-            self.residues = []
+        if self._atoms is None:
+            mr = zip(self.expand(), itertools.count())
+            self._atoms = [[a,r,i,c,0,0,0,t] for t,c in mr for a,r,i,m in self.moleculetypes[t]]
+        return self._atoms
 
 
+    @property
+    def residues(self):
+        # Build a residue list
+        if self._residues is None:
+            atoms = self.atoms
+            if atoms:
+                self._residues = [[atoms[0]]]
+                for i in atoms[1:]:
+                    if i[1:4] != self._residues[-1][-1][1:4]:
+                        self._residues.append([])
+                    self._residues[-1].append(i)
+            else:
+                self._residues = []
+        return self._residues
+
+
+    def expand(self):
+        """Iterate over the moleculetype names of all molecules"""
+        for t, count in self.molecules:
+            for j in xrange(count):
+                yield t
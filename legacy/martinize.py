@@ -111,6 +111,7 @@ www.cgmartini.nl
 and read our papers:
 Monticelli et al., J. Chem. Theory Comput., 2008, 4(5), 819-834
 de Jong et al., J. Chem. Theory Comput., 2013, DOI:10.1021/ct300646g
+MARTINIZE.py requires numpy.
 
 Primary input/output
 --------------------
@@ -140,6 +141,10 @@ file containing a specification in GROMACS' ssdump format
 (-ss). Alternatively, DSSP can be used for an on-the-fly assignment of
 the secondary structure. For this, the option -dssp has to be used
 giving the location of the executable as the argument. 
+Giving 'builtin' as argument to -dssp selects a built-in method, which
+follows the DSSP algorithm and does not require the executable. 
+With multimodel input files, the built-in method handles all frames
+at once.
 The option -collagen will set the whole structure to collagen. If this
 is not what you want (eg only part of the structure is collagen, you
 can give a secondary structure file/string (-ss) and specifiy collagen
@@ -149,6 +154,11 @@ With multimodel input files, the secondary structure as determined with
 DSSP will be averaged over the frames. In this case, a cutoff
 can be specified (-ssc) indicating the fraction of frames to match a
 certain secondary structure type for designation.
+DSSP is run for several chains and frames at the same time, using
+at most -np processes. The results are cached, based on the backbone
+coordinates, and if the environment variable DSSPCACHE is set, also
+stored in the directory it gives, so DSSP is not run again for the
+same structure in later runs.
 
 Topology
 --------
@@ -224,18 +234,45 @@ be appended to the atomistic moleculetype definitions.
 The option -multi can be specified multiple times, and takes a chain
 identifier as argument. Alternatively, the keyword 'all' can be given
 as argument, causing all chains to be multiscaled.
+
+Trajectories
+------------
+A trajectory with the same atoms as the input structure can be mapped
+with -trj, writing the coarse grained trajectory to -ox. The chains
+and the mapping are set up once from the first frame of the input
+structure, after which every trajectory frame is mapped directly from
+its coordinates. Trajectories can be multi-model PDB files, GRO files
+or TRR files.
+
+Batch processing
+----------------
+With -batch, a number of structures is processed, given as a directory
+or as a file listing one structure per line. The other options apply to
+each structure, with the output files written to a directory per
+structure, under the directory given with -bo. The directories are
+named after the input files, with a number added to make the names 
+unique. Relative paths of input files are taken from the directory 
+where martinize is started. The structures are processed
+concurrently by -np worker processes, which share the force field and
+the mapping tables. A summary listing the status, timing and
+number of chains for each structure is written to the output directory.
 ========================================================================\n
 """,
     ("-f",        Option(str,                      1,     None, "Input file (PDB|GRO)")),
     ("-o",        Option(str,                      1,     None, "Output topology (TOP)")),
     ("-x",        Option(str,                      1,     None, "Output coarse grained structure (PDB)")),
+    ("-trj",      Option(str,                      1,     None, "Input trajectory to map (PDB|GRO|TRR)")),
+    ("-ox",       Option(str,                      1,     None, "Output coarse grained trajectory (PDB|GRO)")),
     ("-n",        Option(str,                      1,     None, "Output index file with CG (and multiscale) beads.")),
     ("-nmap",     Option(str,                      1,     None, "Output index file containing per bead mapping.")),
     ("-v",        Option(bool,                     0,    False, "Verbose. Be load and noisy.")), 
     ("-h",        Option(bool,                     0,    False, "Display this help.")),
     ("-ss",       Option(str,                      1,     None, "Secondary structure (File or string)")),
     ("-ssc",      Option(float,                    1,      0.5, "Cutoff fraction for ss in case of ambiguity (default: 0.5).")),
-    ("-dssp",     Option(str,                      1,     None, "DSSP executable for determining structure")),
+    ("-dssp",     Option(str,                      1,     None, "DSSP executable for determining structure ('builtin' for built-in method)")),
+    ("-np",       Option(int,                      1,        0, "Number of concurrent DSSP runs or batch processes (0: number of CPUs)")),
+    ("-batch",    Option(str,                      1,     None, "Directory or list of input structures for batch processing")),
+    ("-bo",       Option(str,                      1,  'batch', "Output directory for batch processing")),
 #    ("-pymol",    Option(str,                      1,     None, "PyMOL executable for determining structure")),
     ("-collagen", Option(bool,                     0,    False, "Use collagen parameters")),
     ("-his",      Option(bool,                     0,    False, "Interactively set the charge of each His-residue.")),
@@ -321,6 +358,48 @@ def str2atom(a):
             return (a[2],a[0],int(a[1]),None)
     return (a[3],a[1],int(a[2]),a[0])
 
+# Make a fresh copy of the options and lists, such that the command
+# line can be parsed more than once in a single process, as done when
+# martinize is imported as a module. Options gathering arguments in one
+# of the lists get the corresponding new list.
+def option_copy(options=options,lists=lists):
+    new    = dict([(key,[]) for key in lists])
+    owner  = dict([(id(value),key) for key,value in lists.items()])
+    copied = []
+    for item in options:
+        if type(item) == str:
+            copied.append(item)
+            continue
+        name, opt = item
+        func = opt.func
+        key  = owner.get(id(getattr(func,"__self__",None)))
+        if key:
+            func = new[key].append
+        copied.append((name,Option(func,opt.num,opt.value,opt.description)))
+    return copied, new
+
+
+# Force field instances by name. The force field is only instantiated 
+# when it is first asked for, and is reused afterwards. The parameters
+# are not changed while processing structures, so the instance can be 
+# shared by consecutive runs in one process.
+_forceFields = {}
+
+def forceField(name):
+    name = name.lower()
+    ff   = _forceFields.get(name)
+    if ff is None:
+        try:
+            # Try to load the forcefield class from a different file
+            _tmp = __import__(name)
+            ff   = getattr(_tmp,name)()
+        except:
+            # Try to load the forcefield class from the current file
+            ff   = globals()[name]()
+        _forceFields[name] = ff
+    return ff
+
+
 def option_parser(args,options,lists,version=0):
 
     # Check whether there is a request for help
@@ -353,13 +432,7 @@ def option_parser(args,options,lists,version=0):
     ###_tmp  = __import__(options['-ff'].value.lower())
     ###options['ForceField']  = getattr(_tmp,options['-ff'].value.lower())()
     try:
-        try:
-            # Try to load the forcefield class from a different file
-            _tmp  = __import__(options['-ff'].value.lower())
-            options['ForceField']  = getattr(_tmp,options['-ff'].value.lower())()
-        except:
-            # Try to load the forcefield class from the current file
-            options['ForceField']  = globals()[options['-ff'].value.lower()]()
+        options['ForceField']  = forceField(options['-ff'].value)
     except:
         logging.error("Forcefield '%s' can not be found."%(options['-ff']))
         sys.exit()
@@ -543,7 +616,7 @@ def distance2(a,b):
 ##########################
 ## 4 # FG -> CG MAPPING ##  -> @MAP <-
 ##########################
-
+import numpy
 
 dnares3 = " DA DC DG DT" 
 dnares1 = " dA dC dG dT"
@@ -681,41 +754,91 @@ class CoarseGrained:
     # This will probably give only minor deviations, while also giving less headache
     mass = {'H': 1,'C': 12,'N': 14,'O': 16,'S': 32,'P': 31,'M': 0}
 
-# Determine average position for a set of weights and coordinates
-# This is a rather specific function that requires a list of items
-# [(m,(x,y,z),id),..] and returns the weighted average of the 
-# coordinates and the list of ids mapped to this bead
-def aver(b):
-    mwx,ids = zip(*[((m*x,m*y,m*z),i) for m,(x,y,z),i in b])              # Weighted coordinates     
-    tm  = sum(zip(*b)[0])                                                 # Sum of weights           
-    return [sum(i)/tm for i in zip(*mwx)],ids                             # Centre of mass           
+# Compiled mappings, keyed on residue name, atom names and ca2bb
+_mappings = {}
+
+# Compile the mapping for a residue to a sparse mass-weight matrix. 
+# The matrix has a row for each bead, listing (atom index, mass) for
+# the atoms mapped to the bead, together with the total mass of the
+# bead. The result is stored for the residue name and the list of
+# atom names, so every residue type is compiled only once for each
+# variant of the atom list encountered. A ValueError is raised if 
+# no atoms are found for a bead.
+def mapMatrix(r,ca2bb = False):
+    names = tuple([i[0] for i in r])
+    key   = (r[0][1],names,ca2bb)
+    m     = _mappings.get(key)
+    if m is None:
+        p = CoarseGrained.mapping[r[0][1]]                                         # Mapping for this residue 
+        if ca2bb: p = [["CA"]]+p[1:]                                               # Elnedyn maps BB to CA, ca2bb is False or True
+        m = []
+        for bead in p:
+            row = [(j,CoarseGrained.mass.get(atom[0],0)) for j,atom in enumerate(names) if atom in bead]
+            if not row:
+                raise ValueError, "No atoms for bead %d of residue %s"%(len(m)+1,r[0][1])
+            m.append((row,sum([w for j,w in row])))
+        _mappings[key] = m
+    return m
+
+# A sparse matrix, given as rows of (column, weight), is stored as
+# arrays of columns (rows, width) and weights (rows, width, 1), with the
+# rows padded to equal length with zero weights.
+def sparseArrays(rows):
+    width = max([len(i) for i in rows] or [0])
+    rows  = [i+(width-len(i))*[(0,0)] for i in rows]
+    return (numpy.array([[j for j,w in i] for i in rows],dtype=int).reshape((len(rows),width)),
+            numpy.array([[w for j,w in i] for i in rows],dtype=float).reshape((len(rows),width,1)))
+
+# Product of a sparse matrix, as given by sparseArrays, with an array of
+# coordinates. The columns are summed one at a time, so the atoms of a 
+# bead are added in the order of the row.
+def sparseProduct(cols,weights,x):
+    pos = numpy.zeros((len(cols),3))
+    for k in range(cols.shape[1]):
+        pos += weights[:,k]*x[cols[:,k]]
+    return pos
+
+# Map a list of residues in one go, multiplying the sparse matrix, 
+# built from the compiled matrices of the residues, with the array of 
+# coordinates. Returns the bead positions and the mapped atom indices
+# (relative to the start of the residue) for each residue.
+def mapResidues(residues,ca2bb = False):
+    matrices = [mapMatrix(r,ca2bb) for r in residues]
+    # Coordinate array
+    x        = numpy.array([i[4:7] for r in residues for i in r],dtype=float).reshape((-1,3))
+    # Matrix rows, with atom indices shifted to the coordinate array
+    rows     = []
+    totals   = []
+    offset   = 0
+    for r,m in zip(residues,matrices):
+        rows.extend([[(offset+j,w) for j,w in row] for row,tm in m])
+        totals.extend([tm for row,tm in m])
+        offset += len(r)
+    # Product
+    cols, weights = sparseArrays(rows)
+    pos      = (sparseProduct(cols,weights,x)/numpy.array(totals,dtype=float).reshape((-1,1))).tolist()
+    # Split per residue
+    out      = []
+    offset   = 0
+    for m in matrices:
+        out.append((pos[offset:offset+len(m)],[tuple([j for j,w in row]) for row,tm in m]))
+        offset += len(m)
+    return out
 
 # Return the CG beads for an atomistic residue, using the mapping specified above
 # The residue 'r' is simply a list of atoms, and each atom is a list:
 # [ name, resname, resid, chain, x, y, z ]
 def map(r,ca2bb = False):
-    p = CoarseGrained.mapping[r[0][1]]                                             # Mapping for this residue 
-    if ca2bb: p[0] = ["CA"]                                                        # Elnedyn maps BB to CA, ca2bb is False or True
-    # Get the name, mass and coordinates for all atoms in the residue
-    a = [(i[0],CoarseGrained.mass.get(i[0][0],0),i[4:]) for i in r]                    
-    # Store weight, coordinate and index for atoms that match a bead
-    q = [[(m,coord,a.index((atom,m,coord))) for atom,m,coord in a if atom in i] for i in p]
-
-    # Bead positions      
-    return zip(*[aver(i) for i in q])
+    return mapResidues([r],ca2bb)[0]
 
 # Mapping for index file
 def mapIndex(r,ca2bb = False):
-    p = CoarseGrained.mapping[r[0][1]]                                             # Mapping for this residue 
-    if ca2bb: p[0] = ["CA"]                                                        # Elnedyn maps BB to CA, ca2bb is False or True
-    # Get the name, mass and coordinates for all atoms in the residue
-    a = [(i[0],CoarseGrained.mass.get(i[0][0],0),i[4:]) for i in r]                    
     # Store weight, coordinate and index for atoms that match a bead
-    return [[(m,coord,a.index((atom,m,coord))) for atom,m,coord in a if atom in i] for i in p]
+    return [[(w,r[j][4:],j) for j,w in row] for row,tm in mapMatrix(r,ca2bb)]
 #############################
 ## 5 # SECONDARY STRUCTURE ##  -> @SS <-
 #############################
-import logging,os,sys
+import logging,os,sys,tempfile,shutil,hashlib,numpy
 import subprocess as subp
 
 #----+--------------------------------------+
@@ -862,37 +985,261 @@ def ssClassification(ss,program="dssp"):
 # NOTE: There is the *OLD* DSSP and the *NEW* DSSP, which require 
 # different calls. The old version uses '--' to indicate reading from stdin
 # whereas the new version uses '-i /dev/stdin'
+# The version is checked only once for each executable.
+_dsspNew = {}
+
+# DSSP results are cached, keyed on the backbone coordinates and the
+# executable. Besides in memory, the results are stored in the directory
+# given by the environment variable DSSPCACHE, if that is set.
+_dsspCache = {}
+dsspcache  = None
+if os.environ.get("DSSPCACHE"):
+    from gmx.cache import Cache
+    dsspcache = Cache(os.environ["DSSPCACHE"],".ss")
+
 def call_dssp(chain,atomlist,executable='dsspcmbi'):
     '''Get the secondary structure, by calling to dssp'''
-    ssdfile = 'chain_%s.ssd'%chain.id 
-
-    try:
-        if os.system(executable+" -V 2>/dev/null"):
-            logging.debug("New version of DSSP; Executing '%s -i /dev/stdin -o %s'"%(executable,ssdfile))
-            p = subp.Popen([executable,"-i","/dev/stdin","-o",ssdfile],stderr=subp.PIPE,stdout=subp.PIPE,stdin=subp.PIPE)
-        else:
-            logging.debug("Old version of DSSP; Executing '%s -- %s'"%(executable,ssdfile))
-            p = subp.Popen([executable,"--",ssdfile],stderr=subp.PIPE,stdout=subp.PIPE,stdin=subp.PIPE)
-    except OSError:
-        logging.error("A problem occured calling %s."%executable)
-        sys.exit(1)
 
+    # The input for DSSP
+    lines = []
     for atom in atomlist: 
         if atom[0][:2] == 'O1': atom=('O',)+atom[1:]
-        if atom[0][0]!='H' and atom[0][:2]!='O2': p.stdin.write(pdbOut(atom))
-    p.stdin.write('TER\n')
-    data = p.communicate()
-    p.wait()
-    main,ss = 0,''
-    for line in open(ssdfile).readlines(): 
-      if main and not line[13] == "!": ss+=line[16]
-      if line[:15] == '  #  RESIDUE AA': main=1
+        if atom[0][0]!='H' and atom[0][:2]!='O2': lines.append(pdbOut(atom))
+    lines.append('TER\n')
+
+    # Check the cache
+    bb  = "".join([i for i in lines if i[12:16].strip() in ("N","CA","C","O")])
+    tag = executable+"\n"+bb
+    key = hashlib.md5(tag).hexdigest()
+    ss  = _dsspCache.get(key)
+    if ss is None and dsspcache:
+        ss = dsspcache.load(tag)
+    if ss is not None:
+        logging.debug("Using cached DSSP result for chain %s"%chain.id)
+        _dsspCache[key] = ss
+        return ss
+
+    # Each call gets its own directory for the output file, which is
+    # removed also if DSSP fails.
+    tmpdir  = tempfile.mkdtemp(prefix="dssp")
+    ssdfile = os.path.join(tmpdir,'chain_%s.ssd'%chain.id)
+
+    try:
+        try:
+            if not executable in _dsspNew:
+                _dsspNew[executable] = bool(os.system(executable+" -V 2>/dev/null"))
+            if _dsspNew[executable]:
+                logging.debug("New version of DSSP; Executing '%s -i /dev/stdin -o %s'"%(executable,ssdfile))
+                p = subp.Popen([executable,"-i","/dev/stdin","-o",ssdfile],stderr=subp.PIPE,stdout=subp.PIPE,stdin=subp.PIPE)
+            else:
+                logging.debug("Old version of DSSP; Executing '%s -- %s'"%(executable,ssdfile))
+                p = subp.Popen([executable,"--",ssdfile],stderr=subp.PIPE,stdout=subp.PIPE,stdin=subp.PIPE)
+        except OSError:
+            # This may run in a worker thread, so no sys.exit here
+            raise RuntimeError("A problem occured calling %s."%executable)
+
+        data = p.communicate("".join(lines))
+        p.wait()
+        if not os.path.exists(ssdfile):
+            raise RuntimeError("A problem occured calling %s: no output for chain %s."%(executable,chain.id))
+        main,ss = 0,''
+        for line in open(ssdfile).readlines(): 
+          if main and not line[13] == "!": ss+=line[16]
+          if line[:15] == '  #  RESIDUE AA': main=1
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+
+    # Store the result
+    _dsspCache[key] = ss
+    if dsspcache:
+        dsspcache.save(tag,ss)
+
     return ss
      
+
+# Built-in secondary structure determination, following the DSSP 
+# algorithm (Kabsch and Sander, Biopolymers, 1983, 22, 2577-2637): 
+# backbone hydrogen bonds are assigned from the electrostatic energy 
+# between C=O and N-H groups, and the patterns of hydrogen bonds give
+# turns, helices (H/G/I) and bridges/ladders (B/E). Bends (S) follow 
+# from the CA trace. Bulges are not joined into ladders and the 
+# DSSP 9 A CA-CA preselection is not used. The result is given in the
+# DSSP letter codes. The calculation is done with numpy for a set of 
+# frames of a chain at once.
+
+# Backbone atoms for the calculation
+_ssBackbone = ("N","CA","C","O")
+
+# Get an array (residues, 4, 3) of backbone coordinates for a list of 
+# residues, with NaN for missing atoms, and a mask for prolines
+def ssBackbone(residues):
+    x = numpy.empty((len(residues),4,3))
+    x.fill(numpy.nan)
+    for i,residue in enumerate(residues):
+        for atom in residue:
+            name = atom[0] == 'O1' and 'O' or atom[0]
+            if name in _ssBackbone and numpy.isnan(x[i,_ssBackbone.index(name),0]):
+                x[i,_ssBackbone.index(name)] = atom[4:7]
+    pro = numpy.array([residue[0][1] in ("PRO","HYP") for residue in residues],dtype=bool)
+    return x, pro
+
+# Determine the secondary structure for an array of frames 
+# (frames, residues, 4, 3) of backbone coordinates in Angstrom.
+# Returns a list of strings. The frames are done in chunks to limit
+# the memory use, as all pairs of residues are considered.
+def ssFrames(x,pro=None,chunk=4000000):
+    x = numpy.asarray(x,dtype=float)
+    F, R = x.shape[:2]
+    if pro is None:
+        pro = numpy.zeros(R,dtype=bool)
+    step = max(1,chunk//max(1,R*R))
+    out  = []
+    for start in range(0,F,step):
+        out.extend(_ssChunk(x[start:start+step],pro))
+    return out
+
+def _ssChunk(x,pro):
+    F, R   = x.shape[:2]
+    N, CA, C, O = x[:,:,0], x[:,:,1], x[:,:,2], x[:,:,3]
+    ss     = numpy.empty((F,R),dtype="S1")
+    ss.fill("C")
+    if R < 3:
+        return [i.tostring() for i in ss]
+
+    olderr = numpy.seterr(invalid="ignore",divide="ignore")
+
+    # Chain breaks: C(i-1)-N(i) distance larger than 2.5 A
+    brk      = numpy.zeros((F,R),dtype=bool)
+    brk[:,1:] = ~(numpy.sqrt(((C[:,:-1]-N[:,1:])**2).sum(axis=-1)) <= 2.5)
+    # Segment numbers; turns and bends do not cross breaks
+    seg       = numpy.cumsum(brk,axis=1)
+
+    # Amide hydrogens, placed 1 A from the N, opposite to the C=O of 
+    # the previous residue. The first residue, prolines and residues
+    # following a break have no hydrogen.
+    H        = N.copy()
+    co       = C[:,:-1]-O[:,:-1]
+    H[:,1:] += co/numpy.sqrt((co**2).sum(axis=-1))[:,:,None]
+    H[:,0]   = numpy.nan
+    H[:,pro] = numpy.nan
+    H[brk]   = numpy.nan
+
+    # Hydrogen bond energy for acceptor i (C=O) and donor j (N-H), 
+    # in kcal/mol. Hydrogen bonds have an energy below -0.5.
+    def r(a,b):
+        d = numpy.sqrt(((a[:,:,None]-b[:,None,:])**2).sum(axis=-1))
+        return numpy.maximum(d,0.5)
+    E  = 27.888*(1/r(O,N) + 1/r(C,H) - 1/r(O,H) - 1/r(C,N))
+    hb = E < -0.5
+    # No hydrogen bonds within a residue or to the next residue
+    i  = numpy.arange(R)
+    hb[:,i,i] = False
+    hb[:,i[:-1],i[1:]] = False
+
+    # n-turns at i: hydrogen bond from C=O(i) to N-H(i+n)
+    turn = {}
+    for n in (3,4,5):
+        turn[n] = numpy.zeros((F,R),dtype=bool)
+        if R > n:
+            turn[n][:,:-n] = hb[:,i[:-n],i[n:]] & (seg[:,:-n] == seg[:,n:])
+
+    # Bends: angle between CA(i-2)->CA(i) and CA(i)->CA(i+2) over 70 degrees
+    bend = numpy.zeros((F,R),dtype=bool)
+    if R > 4:
+        u = CA[:,2:-2]-CA[:,:-4]
+        v = CA[:,4:]-CA[:,2:-2]
+        cos = (u*v).sum(axis=-1)/numpy.sqrt((u**2).sum(axis=-1)*(v**2).sum(axis=-1))
+        bend[:,2:-2] = (cos < numpy.cos(numpy.radians(70))) & (seg[:,:-4] == seg[:,4:])
+
+    # Bridges between interior residues i and j, |i-j| > 2
+    hbT = hb.transpose(0,2,1)
+    par = (hb[:,:-2,1:-1] & hbT[:,2:,1:-1]) | (hbT[:,1:-1,:-2] & hb[:,1:-1,2:])
+    apa = (hb[:,1:-1,1:-1] & hbT[:,1:-1,1:-1]) | (hb[:,:-2,2:] & hbT[:,2:,:-2])
+    far = numpy.abs(i[1:-1,None]-i[None,1:-1]) > 2
+    par &= far
+    apa &= far
+    # Ladders: consecutive bridges of the same type
+    lad = numpy.zeros(par.shape,dtype=bool)
+    lad[:,1:,1:]  |= par[:,1:,1:] & par[:,:-1,:-1]
+    lad[:,:-1,:-1] |= par[:,:-1,:-1] & par[:,1:,1:]
+    lad[:,1:,:-1] |= apa[:,1:,:-1] & apa[:,:-1,1:]
+    lad[:,:-1,1:] |= apa[:,:-1,1:] & apa[:,1:,:-1]
+    bridge = numpy.zeros((F,R),dtype=bool)
+    ladder = numpy.zeros((F,R),dtype=bool)
+    bridge[:,1:-1] = (par | apa).any(axis=2)
+    ladder[:,1:-1] = lad.any(axis=2)
+
+    # Turns and helices; minimal helices are two consecutive n-turns
+    helix = {}
+    turns = numpy.zeros((F,R),dtype=bool)
+    for n in (3,4,5):
+        helix[n] = numpy.zeros((F,R),dtype=bool)
+        start    = numpy.zeros((F,R),dtype=bool)
+        start[:,1:] = turn[n][:,:-1] & turn[n][:,1:]
+        for k in range(n):
+            helix[n][:,k:] |= start[:,:R-k]
+        for k in range(1,n):
+            turns[:,k:] |= turn[n][:,:R-k]
+
+    numpy.seterr(**olderr)
+
+    # Assign in order of increasing priority
+    ss[bend]         = "S"
+    ss[turns]        = "T"
+    ss[helix[5]]     = "I"
+    ss[helix[3]]     = "G"
+    ss[bridge]       = "B"
+    ss[ladder]       = "E"
+    ss[helix[4]]     = "H"
+
+    return [i.tostring() for i in ss]
+
+# The built-in method for a single chain
+def call_builtin(chain,atomlist,executable=None):
+    x, pro = ssBackbone(chain.residues)
+    return ssFrames(x[None],pro)[0]
+
 ssDetermination = {
-    "dssp": call_dssp
+    "dssp":    call_dssp,
+    "builtin": call_builtin
     }
-################################
+
+# Secondary structure codes given by the methods 
+ssSource = {
+    "builtin": "dssp"
+    }
+
+
+# Consensus secondary structure over frames. Frames are added one at a
+# time, and only the counts of each type per residue are kept, in an
+# array (residues, 256), indexed by the character code.
+# If residues have a single type over all frames, that type is taken.
+# Otherwise the most frequent type is taken if its fraction exceeds 
+# the cutoff, with ties going to the highest character code. Residues
+# not meeting the cutoff are set to " ".
+class SSConsensus:
+    def __init__(self):
+        self.frames = 0
+        self.counts = None
+
+    def add(self,ss):
+        if self.counts is None:
+            self.counts = numpy.zeros((len(ss),256),dtype=int)
+        n = min(len(ss),len(self.counts))
+        self.counts = self.counts[:n]
+        codes = numpy.fromstring(ss[:n],dtype=numpy.uint8)
+        self.counts[numpy.arange(n),codes] += 1
+        self.frames += 1
+
+    def consensus(self,cutoff):
+        if self.counts is None or not len(self.counts):
+            return ""
+        # Most frequent type, taking the highest code on ties
+        best  = 255 - self.counts[:,::-1].argmax(axis=1)
+        count = self.counts[numpy.arange(len(best)),best]
+        keep  = ((self.counts > 0).sum(axis=1) == 1) | (1.0*count/self.frames > cutoff)
+        best[~keep] = ord(" ")
+        return best.astype(numpy.uint8).tostring()
 ## 6 # FORCE FIELD PARAMETERS ##  -> @FF <-
 ################################
 
@@ -3062,7 +3409,7 @@ def rubberBands(atomList,lowerBound,upperBound,decayFactor,decayPower,forceConst
 #######################
 ## 8 # STRUCTURE I/O ##  -> @IO <-
 #######################
-import logging,math,random,sys
+import logging,math,random,sys,gzip,numpy
 
 #----+---------+
 ## A | PDB I/O |
@@ -3176,6 +3523,14 @@ def groBoxRead(a):
     b = [float(i) for i in a.split()] + 6*[0]             # Padding for rectangular boxes
     return b[0],b[3],b[4],b[5],b[1],b[6],b[7],b[8],b[2]   # Return full definition xx,xy,xz,yx,yy,yz,zx,zy,zz
 
+def groBoxString(box):
+    if not box:
+        return "%10.5f%10.5f%10.5f\n"%(0,0,0)
+    u, v, w = box[0:3], box[3:6], box[6:9]
+    if u[1] or u[2] or v[0] or v[2] or w[0] or w[1]:
+        return "%10.5f%10.5f%10.5f%10.5f%10.5f%10.5f%10.5f%10.5f%10.5f\n"%(u[0],v[1],w[2],u[1],u[2],v[0],v[2],w[0],w[1])
+    return "%10.5f%10.5f%10.5f\n"%(u[0],v[1],w[2])
+
 def groAtom(a):
     # In PDB files, there might by an insertion code. To handle this, we internally add
     # constant to all resids. To be consistent, we have to do the same for gro files.
@@ -3340,6 +3695,29 @@ def add_dummy(beads,dist=0.11,n=2):
         m *= -2
     return beads
 
+def cysteineContacts(sg,cutoff):
+    # Find the pairs of SG atoms within the cutoff (squared distance) 
+    # using a grid with cells the size of the cutoff. Only neighbouring
+    # cells have to be checked. The atoms are given as (key, x, y, z).
+    size = math.sqrt(cutoff)
+    grid = {}
+    for n,(key,x,y,z) in enumerate(sg):
+        grid.setdefault((int(math.floor(x/size)),int(math.floor(y/size)),int(math.floor(z/size))),[]).append(n)
+    out = []
+    for n,(key,x,y,z) in enumerate(sg):
+        cx,cy,cz = int(math.floor(x/size)),int(math.floor(y/size)),int(math.floor(z/size))
+        for i in (cx-1,cx,cx+1):
+            for j in (cy-1,cy,cy+1):
+                for k in (cz-1,cz,cz+1):
+                    for m in grid.get((i,j,k),[]):
+                        if m > n:
+                            d2 = distance2(sg[n][1:],sg[m][1:])
+                            if d2 <= cutoff:
+                                out.append((n,m,d2))
+    out.sort()
+    return out
+
+
 def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
     chainIndex = range(len(chains))
 
@@ -3349,8 +3727,23 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
 
     chainID = [chain.id for chain in chains]
 
+    # The chains to merge are tracked as disjoint sets, with the
+    # parent of each chain pointing towards the root of its set.
+    parent = range(len(chains))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    # Pairs of chains directly linked, for reporting
+    pairs = set()
+    def join(i,j):
+        pairs.add(i<j and (i,j) or (j,i))
+        i, j = root(i), root(j)
+        if i != j:
+            parent[max(i,j)] = min(i,j)
+
     # Mark the combinations of chains that need to be merged
-    merges = []
     if m_list:
         # Build a dictionary of chain IDs versus index
         # To give higher priority to top chains the lists are reversed 
@@ -3359,6 +3752,7 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
         chainID.reverse()
         dct = dict(zip(chainID,chainIndex))
         chainIndex.reverse()
+        chainID.reverse()
         # Convert chains in the merge_list to numeric, if necessary
         # NOTE The internal numbering is zero-based, while the 
         # command line chain indexing is one-based. We have to add
@@ -3366,66 +3760,50 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
         # the numbering from the command line, but then from the 
         # result we need to subtract one again to make indexing 
         # zero-based
-        merges = [[(i.isdigit() and int(i) or dct[i]+1)-1 for i in j] for j in m_list]
-        for i in merges:
-            i.sort()
-
-    # Rearrange merge list to a list of pairs
-    pairs = [(i[j],i[k]) for i in merges for j in range(len(i)-1) for k in range(j+1,len(i))]
-
-    # Check each combination of chains for connections based on
-    # ss-bridges, links and distance restraints
-    for i in chainIndex[:-1]:
-        for j in chainIndex[i+1:]:           
-            if (i,j) in pairs:
-                continue
-            # Check whether any link links these two groups
-            for a,b in l_list:                
-                if ((a in chains[i] and b in chains[j]) or 
-                    (a in chains[j] and b in chains[i])):
-                    logging.info("Merging chains %d and %d to allow link %s"%(i+1,j+1,str((a,b))))
-                    pairs.append( i<j and (i,j) or (j,i) )
-                    break
-            if (i,j) in pairs:
-                continue
-            # Check whether any cystine bond given links these two groups
-            #for a,b in s_list:
-            #    if ((a in chains[i] and b in chains[j]) or 
-            #        (a in chains[j] and b in chains[i])):
-            #        logging.info("Merging chains %d and %d to allow cystine bridge"%(i+1,j+1))
-            #        pairs.append( i<j and (i,j) or (j,i) )
-            #        break
-            #if (i,j) in pairs:
-            #    continue
-            # Check for cystine bridges based on distance
-            if not ss_cutoff:
-                continue
-            # Get SG atoms from cysteines from either chain
-            # Check this pair of chains
-            for cysA in chains[i]["CYS"]:
-                for cysB in chains[j]["CYS"]:
-                    d2 = distance2(cysA["SG"][4:7],cysB["SG"][4:7]) 
-                    if d2 <= ss_cutoff:
-                        logging.info("Found SS contact linking chains %d and %d (%f nm)"%(i+1,j+1,math.sqrt(d2)/10))
-                        pairs.append((i,j))
-                    break
-                if (i,j) in pairs:
-                    break
-
-    # Sort the combinations
-    pairs.sort(reverse=True)
-
-    merges = []
-    while pairs:
-        merges.append(set([pairs[-1][0]]))
-        for i in range(len(pairs)-1,-1,-1):
-            if pairs[i][0] in merges[-1]:
-                merges[-1].add(pairs.pop(i)[1])
-            elif pairs[i][1] in merges[-1]:
-                merges[-1].add(pairs.pop(i)[0])
-    merges = [list(i) for i in merges]
-    for i in merges:
-        i.sort()
+        for j in m_list:
+            merge = [(i.isdigit() and int(i) or dct[i]+1)-1 for i in j]
+            for i in merge[1:]:
+                join(merge[0],i)
+
+    # Lookup of chains by chain identifier and of chains by atom, 
+    # to find the chains involved in links without checking all 
+    # chains for every link.
+    byID   = {}
+    byAtom = {}
+    for i,chain in enumerate(chains):
+        byID.setdefault(chain.id,[]).append(i)
+        for atom in chain.atoms():
+            byAtom.setdefault(atom+(chain.id,),set()).add(i)
+
+    def linked(atom):
+        # Links specified with all fields can be looked up directly,
+        # otherwise the chains with the matching identifier are checked.
+        if atom[0] and atom[1] and atom[2]:
+            return byAtom.get(tuple(atom[:4]),set())
+        return set([i for i in byID.get(atom[3],[]) if atom in chains[i]])
+
+    # Check links for connecting different chains
+    for a,b in l_list:
+        for i in linked(a):
+            for j in linked(b):
+                if i != j and not (min(i,j),max(i,j)) in pairs:
+                    logging.info("Merging chains %d and %d to allow link %s"%(min(i,j)+1,max(i,j)+1,str((a,b))))
+                    join(i,j)
+
+    # Check for cystine bridges based on distance between SG atoms
+    if ss_cutoff:
+        sg = [(i,)+tuple(cys["SG"][4:7]) for i,chain in enumerate(chains) for cys in chain["CYS"] if cys["SG"]]
+        for n,m,d2 in cysteineContacts(sg,ss_cutoff):
+            i, j = sg[n][0], sg[m][0]
+            if i != j and not (min(i,j),max(i,j)) in pairs:
+                logging.info("Found SS contact linking chains %d and %d (%f nm)"%(min(i,j)+1,max(i,j)+1,math.sqrt(d2)/10))
+                join(i,j)
+
+    # Collect the sets of chains, ordered by the first chain in each
+    groups = {}
+    for i in chainIndex:
+        groups.setdefault(root(i),[]).append(i)
+    merges = [groups[i] for i in sorted(groups.keys()) if len(groups[i]) > 1]
 
     order = [j for i in merges for j in i]
 
@@ -3438,8 +3816,9 @@ def check_merge(chains, m_list=[], l_list=[], ss_cutoff=0):
         logging.info("All chains will be merged in a single moleculetype")
 
     # Determine the order for writing; merged chains go first
-    merges.extend([[j] for j in chainIndex if not j in order])
-    order.extend([j for j in chainIndex if not j in order])
+    merged = set(order)
+    merges.extend([[j] for j in chainIndex if not j in merged])
+    order.extend([j for j in chainIndex if not j in merged])
 
     return order, merges
 
@@ -3516,11 +3895,15 @@ class Chain:
         return newchain
 
     def __eq__(self,other):
-        return (self.seq        == other.seq    and 
-                self.ss         == other.ss     and
-                self.breaks     == other.breaks and
-                self.links      == other.links  and
-                self.multiscale == other.multiscale)
+        return self.fingerprint() == other.fingerprint()
+
+    # The fingerprint holds everything that makes a chain distinct for 
+    # the topology. Chains with equal fingerprints share a moleculetype.
+    # Being hashable, it allows grouping chains using a dictionary, 
+    # rather than comparing all pairs of chains.
+    def fingerprint(self):
+        return (self.seq, self.ss, tuple(self.breaks), 
+                tuple([tuple(i) for i in self.links]), bool(self.multiscale))
 
     # Extract a residue by number or the list of residues of a given type
     # This facilitates selecting residues for links, like chain["CYS"]
@@ -3638,7 +4021,7 @@ class Chain:
         if self.type() == "Protein":
             if method:
                 atomlist = [atom for residue in self.residues for atom in residue]
-                self.set_ss(ssDetermination[method](self,atomlist,executable),source=method)
+                self.set_ss(ssDetermination[method](self,atomlist,executable),source=ssSource.get(method,method))
             else:
                 self.set_ss(len(self)*"C")
         else:
@@ -3669,6 +4052,7 @@ class Chain:
         bb       = [1]
         fail     = False
         previous = ''
+        todo     = []
         for residue,rss,resname in zip(self.residues,self.sstypes,self.sequence):
             # For DNA we need to get the O3' to the following residue when calculating COM
             # The force and com options ensure that this part does not affect itp generation or anything else
@@ -3688,6 +4072,8 @@ class Chain:
                     del residue[store]
 
             # Check if residues names has changed, for example because user has set residues interactively.
+            # The original atoms are kept for mapping other frames.
+            source  = residue
             residue = [(atom[0],resname)+atom[2:] for atom in residue]
             if residue[0][1] in ("SOL","HOH","TIP"):
                 continue
@@ -3695,28 +4081,46 @@ class Chain:
                 logging.warning("Skipped unknown residue %s\n"%residue[0][1])
                 continue
             # Get the mapping for this residue
-            # CG.map returns bead coordinates and mapped atoms
+            # The compiled mapping is a sparse matrix of atom weights per bead.
             # This will fail if there are (too many) atoms missing, which is
             # only problematic if a mapped structure is written; the topology
             # is inferred from the sequence. So this is the best place to raise 
             # an error
             try:
-                beads, ids = map(residue,ca2bb=self.options['ForceField'].ca2bb)
-                beads      = zip(CoarseGrained.names[residue[0][1]],beads,ids)
-                if residue[0][1] in self.options['ForceField'].polar:
-                    beads = add_dummy(beads,dist=0.14,n=2)
-                elif residue[0][1] in self.options['ForceField'].charged:
-                    beads = add_dummy(beads,dist=0.11,n=1)
+                mapMatrix(residue,ca2bb=self.options['ForceField'].ca2bb)
+                todo.append((residue,rss,source))
             except ValueError:
                 logging.error("Too many atoms missing from residue %s %d(ch:%s):",residue[0][1],residue[0][2]-(32<<20),residue[0][3])
                 logging.error(repr([ i[0] for i in residue ]))
                 fail = True
 
-            for name,(x,y,z),ids in beads:                    
+        # Map all residues of the chain in one go
+        # For each bead, the source atoms, the weights and the offset are
+        # stored as well, to allow mapping other frames (see mapPlan).
+        # Dummy beads get the weights of the last real bead, with the
+        # offset from that bead as found here.
+        self._sources = []
+        mapped = mapResidues([residue for residue,rss,source in todo],ca2bb=self.options['ForceField'].ca2bb)
+        for (residue,rss,source),(beads,ids) in zip(todo,mapped):
+            matrix = mapMatrix(residue,ca2bb=self.options['ForceField'].ca2bb)
+            beads  = zip(CoarseGrained.names[residue[0][1]],beads,ids)
+            real   = len(beads)
+            if residue[0][1] in self.options['ForceField'].polar:
+                beads = add_dummy(beads,dist=0.14,n=2)
+            elif residue[0][1] in self.options['ForceField'].charged:
+                beads = add_dummy(beads,dist=0.11,n=1)
+
+            for k,(name,(x,y,z),ids) in enumerate(beads):                    
                 # Add the bead with coordinates and secondary structure id to the list
                 self._cg.append((name,residue[0][1][:3],residue[0][2],residue[0][3],x,y,z,ss2num[rss]))
                 # Add the ids to the list, after converting them to indices to the list of atoms
                 self.mapping.append([atid+i for i in ids])
+                # Source atoms and weights
+                row, tm = matrix[min(k,real-1)]
+                offset  = [i-j for i,j in zip((x,y,z),beads[real-1][1])]
+                if k < real:
+                    offset = (0,0,0)
+                self._sources.append(([source[j] for j,w in row],[w for j,w in row],tm,offset))
 
             # Increment the atom id; This pertains to the atoms that are included in the output.
             atid += len(residue)
@@ -3741,10 +4145,124 @@ class Chain:
         # Now add CONECTs for sidechains
         for i,j in bb:
             nsc = j-i-1
+#----+--------------------+
+## E | TRAJECTORY MAPPING |
+#----+--------------------+
+
+# A trajectory is mapped using a plan made from the first frame of the 
+# input structure, which sets the chains, their order and the beads.
+# The plan is a sparse matrix, with a row for each output particle, 
+# listing the atoms (indices in the frame) and their weights. The rows
+# are padded to equal length with zero weights, so a frame is mapped by
+# a single product of the matrix with the coordinate array, summing in
+# the same order as when mapping the structure. Multiscaled chains have 
+# their atoms written as well, as rows with a single atom. If there is
+# nothing to map, None is returned.
+def mapPlan(chains,order,atoms):
+    index   = dict([(id(a),k) for k,a in enumerate([a for a in atoms if a])])
+    rows, totals, offsets, lines = [], [], [], []
+    for i in order:
+        ci = chains[i]
+        if ci.multiscale:
+            for r in ci.residues:
+                for a in r:
+                    rows.append([(index[id(a)],1)])
+                    totals.append(1)
+                    offsets.append((0,0,0))
+                    lines.append((a[0],a[1],a[2],a[3],0))
+        coarseGrained = ci.cg(com=True)
+        if not coarseGrained:
+            continue
+        for (name,resn,resi,chain,x,y,z,ssid),(src,w,tm,offset) in zip(coarseGrained,ci._sources):
+            if ci.multiscale:
+                name = "v"+name
+            rows.append(zip([index[id(a)] for a in src],w))
+            totals.append(tm)
+            offsets.append(offset)
+            lines.append((name,resn,resi,chain,ssid))
+        lines.append(None)
+    if not rows:
+        # No chain gives particles to write
+        return None
+    cols, weights = sparseArrays(rows)
+    return {
+        "cols":    cols,
+        "weights": weights,
+        "totals":  numpy.array(totals,dtype=float)[:,None],
+        "offsets": numpy.array(offsets,dtype=float),
+        "lines":   lines
+        }
+
+
+# Map a frame (coordinate array in Angstrom) according to a plan
+def mapFrame(plan,x):
+    pos = sparseProduct(plan["cols"],plan["weights"],numpy.asarray(x,dtype=float))
+    return pos/plan["totals"] + plan["offsets"]
+
+
+# Iterate over the frames of a trajectory, yielding title, coordinates 
+# (Angstrom) and box (nm, xx,xy,xz,yx,yy,yz,zx,zy,zz)
+def trajectoryFrames(filename):
+    if filename.endswith(".trr"):
+        from gmx.trr import TRR
+        for nr,frame in enumerate(TRR(filename)):
+            box = frame.box()
+            if box is not None:
+                box = tuple(box.ravel())
+            yield "Frame %d t= %f\n"%(nr,frame.time), 10*frame.x(), box
+    else:
+        stream = streamTag(filename)
+        if stream.next() == "GRO":
+            frameIterator = groFrameIterator
+        else:
+            frameIterator = pdbFrameIterator
+        for title,atoms,box in frameIterator(stream):
+            yield title, [a[4:7] for a in atoms if a], box
+
+
+# Write mapped frames to a PDB or GRO file. The static part of each 
+# line is formatted once, so only the coordinates are formatted per frame.
+def writeTrajectory(filename,plan,frames):
+    gro = filename.endswith(".gro")
+    out = open(filename,"w")
+    head, tail = [], []
+    atid = 1
+    for i in plan["lines"]:
+        if i is None:
+            if not gro:
+                head.append("TER\n")
+                tail.append(None)
+            continue
+        name,resn,resi,chain,ssid = i
+        insc  = resi>>20
+        resid = resi - (insc<<20)
+        if resid > 1000000:
+            insc += 1
+            resid = resi - (insc<<20)
+        if gro:
+            head.append("%5d%-5s%5s%5d"%(resid%1e5,resn,name,atid%1e5))
+            tail.append("\n")
+        else:
+            head.append("ATOM  %5d %4s%4s %1s%4d%1s   "%(atid,name,resn[:3],chain,resid,chr(insc)))
+            tail.append("%6.2f%6.2f\n"%(1,ssid))
+        atid += 1
+    model = 1
+    for title,x,box in frames:
+        x = iter(x)
+        if gro:
+            lines = [h+"%8.3f%8.3f%8.3f"%tuple(x.next()/10)+t for h,t in zip(head,tail)]
+            out.write(title.rstrip()+"\n%5d\n"%len(lines)+"".join(lines))
+            out.write(groBoxString(box))
+        else:
+            lines = [t and h+"%8.3f%8.3f%8.3f"%tuple(x.next())+t or h for h,t in zip(head,tail)]
+            out.write("MODEL %8d\n"%model+title+(box and pdbBoxString(box) or "")+"".join(lines)+"ENDMDL\n")
+        model += 1
+    out.close()
+    return model-1
 ##################
 ## 7 # TOPOLOGY ##  -> @TOP <-
 ##################
-import logging,math
+import logging,math,copy
 
 # This is a generic class for Topology Bonded Type definitions
 class Bonded:
@@ -3794,9 +4312,14 @@ class Bonded:
         return bool(self.atoms) 
 
     def __str__(self):
+        return self.format()
+
+    # The line for the topology, with the atom numbers shifted, as
+    # for blocks of interactions from merged topologies.
+    def format(self,shift=0):
         if not self.atoms or not self.parameters:
             return ""
-        s = ["%5d" % i for i in self.atoms]
+        s = ["%5d" % (i+shift) for i in self.atoms]
         # For exclusions, no type is defined, which equals -1
         if self.type != -1: s.append(" %5d " % self.type)
         # Print integers and floats in proper format and neglect None terms
@@ -3814,7 +4337,8 @@ class Bonded:
         return self
 
     def __add__(self,num):
-        out  = self.__class__(self)
+        # A shallow copy with shifted atom numbers
+        out  = copy.copy(self)
         out += num
         return out
 
@@ -3850,11 +4374,11 @@ class Bond(Bonded):
         if self.parameters[1] == None:
             self.category = 'Constraint'
 
-    # Overriding __str__ method to suppress printing of bonds with Fc of 0
-    def __str__(self):
+    # Overriding format method to suppress printing of bonds with Fc of 0
+    def format(self,shift=0):
         if len(self.parameters) > 1 and self.parameters[1] == 0:
             return ""
-        return Bonded.__str__(self)
+        return Bonded.format(self,shift)
 
 
 # Similar to the preceding class
@@ -3913,30 +4437,163 @@ class Dihedral(Bonded):
             self.parameters = None
 
 
+# Block of bonded interactions of a single type and category, stored 
+# as a list of atom tuples and a list of parameter tuples. This is used
+# for large sets of interactions, like elastic networks. Shifting the
+# atom numbers, as done when merging topologies, only sets an offset,
+# which is applied when the block is written. The lines are formatted
+# in bulk, using a single format string for the whole block.
+class BondedArray:
+    def __init__(self,other=None,type=1,category=None,shift=0):
+        self.type     = type
+        self.category = category
+        self.shift    = shift
+        if isinstance(other,BondedArray):
+            # Share the lists; the shift is kept separately
+            self.atoms, self.parameters = other.atoms, other.parameters
+            self.type, self.category    = other.type, other.category
+            self.shift = other.shift + shift
+        elif other:
+            # List of dictionaries, as obtained from rubberBands
+            self.atoms      = [tuple(i["atoms"]) for i in other]
+            self.parameters = [tuple([j for j in i["parameters"] if j != None]) for i in other]
+        else:
+            self.atoms, self.parameters = [], []
+
+    def __len__(self):
+        return len(self.atoms)
+
+    def __nonzero__(self):
+        return bool(self.atoms)
+
+    def __iadd__(self,num):
+        self.shift += int(num)
+        return self
+
+    def __add__(self,num):
+        return BondedArray(self,shift=int(num))
+
+    def __eq__(self,other):
+        if type(other) in (list,tuple):
+            return tuple([i-self.shift for i in other]) in self.atoms
+        return self is other
+
+    def __str__(self):
+        return self.format()
+
+    def format(self,shift=0):
+        if not self.atoms:
+            return ""
+        # The format follows Bonded.format and formatString
+        fmt = " ".join(["%5d"]*len(self.atoms[0]) + [" %5d "%self.type] +
+                       [{str: "%s", int: "%5d", float: "%8.5f"}.get(type(i),"%s") for i in self.parameters[0]])
+        shift = self.shift + shift
+        return "\n".join([fmt%(tuple([k+shift for k in i])+j) for i,j in zip(self.atoms,self.parameters)])
+
+
 # This list allows to retrieve Bonded class items based on the category
 # If standard, dictionary type indexing is used, only exact matches are
 # returned. Alternatively, partial matching can be achieved by setting
 # a second 'True' argument. 
+#
+# When topologies are merged, the items of the other list are added 
+# as they are, as a block with an offset for the atom numbers. Only the
+# start of the block and the offset are stored. The offsets are applied 
+# when the items are formatted (lines) or retrieved (shifted, item).
 class CategorizedList(list):
+    # The offset of items that were not merged
+    noshift = 0
+
+    def __init__(self,*args):
+        list.__init__(self,*args)
+        # Start positions and offsets of merged blocks
+        self.offsets = []
+
     def __getitem__(self,tag): 
         if type(tag) == int:
             # Call the parent class __getitem__
             return list.__getitem__(self,tag)
+        match = self._match(tag)
+        return [i for i in self if match(i)]
 
+    def _match(self,tag):
+        if tag is None:
+            return lambda i: True
         if type(tag) == str:
-            return [i for i in self if i.category == tag]
-
+            return lambda i: i.category == tag
         if tag[1]:
-            return [i for i in self if tag[0] in i.category]
+            return lambda i: tag[0] in i.category
         else:
-            return [i for i in self if i.category == tag[0]]
+            return lambda i: i.category == tag[0]
+
+    # Add the offsets of two blocks
+    def add(self,a,b):
+        return a+b
+
+    # An item with the offset applied
+    def apply(self,item,shift):
+        if shift:
+            return item+shift
+        return item
+
+    def merge(self,other,shift):
+        """Add the items of other as block(s) with the offset shift"""
+        n = len(self)
+        self.offsets.append((n,shift))
+        self.offsets.extend([(n+i,self.add(j,shift)) for i,j in getattr(other,"offsets",[])])
+        self.extend(other)
+        # Items added later are not shifted
+        self.offsets.append((len(self),self.noshift))
+
+    def blocks(self):
+        """The items as (items, offset) pairs, per merged block"""
+        bounds = [(0,self.noshift)] + self.offsets + [(len(self),None)]
+        return [(list.__getslice__(self,i,k),j) for (i,j),(k,l) in zip(bounds,bounds[1:]) if k > i]
+
+    def item(self,k):
+        """Item k with the offset applied"""
+        if k < 0:
+            k += len(self)
+        shift = self.noshift
+        for i,j in self.offsets:
+            if i > k:
+                break
+            shift = j
+        return self.apply(list.__getitem__(self,k),shift)
+
+    def shifted(self,tag=None):
+        """The (matching) items with the offsets applied"""
+        match = self._match(tag)
+        return [self.apply(i,shift) for items,shift in self.blocks() for i in items if match(i)]
+
+    def lines(self,tag=None,test=None):
+        """The formatted (matching) items, with the offsets applied"""
+        match = self._match(tag)
+        return [i.format(shift) for items,shift in self.blocks() for i in items if match(i) and (not test or test(i))]
+
+
+# List of atom tuples for a topology. The offsets are given as tuples
+# of shifts for the atom, residue and charge group numbers.
+class AtomList(CategorizedList):
+    noshift = (0,0,0)
+
+    def add(self,a,b):
+        return (a[0]+b[0],a[1]+b[1],a[2]+b[2])
+
+    # The following used work: zip>list expansions>zip back, but that only works if
+    # all the tuples in the original list of of equal length. With masses and charges
+    # that is not necessarly the case.
+    def apply(self,atom,shift):
+        if shift == self.noshift:
+            return atom
+        return (atom[0]+shift[0],atom[1],atom[2]+shift[1],atom[3],atom[4],atom[5]+shift[2])+atom[6:]
 
 
 class Topology:
     def __init__(self,other=None,options=None,name=""):
         self.name        = ''
         self.nrexcl      = 1
-        self.atoms       = CategorizedList()
+        self.atoms       = AtomList()
         self.vsites      = CategorizedList() 
         self.exclusions  = CategorizedList() 
         self.bonds       = CategorizedList()
@@ -3994,18 +4651,12 @@ class Topology:
         if not isinstance(other,Topology):
             other = Topology(other)
         shift     = len(self.atoms)
-        last      = self.atoms[-1]
-        # The following used work: zip>list expansions>zip back, but that only works if
-        # all the tuples in the original list of of equal length. With masses and charges
-        # that is not necessarly the case.
-        for atom in other.atoms:
-            atom = list(atom)
-            atom[0] += shift    # Update atom numbers
-            atom[2] += last[2]  # Update residue numbers
-            atom[5] += last[5]  # Update charge group numbers
-            self.atoms.append(tuple(atom))
+        last      = self.atoms.item(-1)
+        # The atoms and interactions of other are added as blocks, with
+        # the atom, residue and charge group numbers shifted on output.
+        self.atoms.merge(other.atoms,(shift,last[2],last[5]))
         for attrib in ["bonds","vsites","angles","dihedrals","impropers","constraints","posres"]:
-            getattr(self,attrib).extend([source+shift for source in getattr(other,attrib)])
+            getattr(self,attrib).merge(getattr(other,attrib),shift)
         return self
 
     def __add__(self,other):
@@ -4016,6 +4667,24 @@ class Topology:
         return out
 
     def __str__(self):
+        return "\n".join(self.header() + list(self.body()))
+
+    # Write the topology to a stream, section by section, rather than 
+    # joining everything into a single string first. The sections are 
+    # formatted as they are written. A body can be given as a list of 
+    # text blocks, to write a stored body.
+    def write(self,dev,body=None):
+        if body is None:
+            body = self.body()
+        dev.write("\n".join(self.header()))
+        for block in body:
+            dev.write("\n")
+            dev.write(block)
+
+    # The header contains the comments and the moleculetype name.
+    # It is separate from the body, such that the body can be reused
+    # for a moleculetype with a different name.
+    def header(self):
         if self.multiscale:
              out  = [ '; MARTINI (%s) Multiscale virtual sites topology section for "%s"' %(self.options['ForceField'].name,self.name) ]
         else:
@@ -4039,38 +4708,43 @@ class Topology:
                      '; Name         Exclusions',  
                      '%-15s %3d' % (self.name,self.nrexcl)]
 
-        out.append('\n[ atoms ]')
+        return out
+
+    # The body is generated as text blocks, one per section. The items
+    # of merged topologies are formatted with the offsets of their blocks.
+    def body(self):
+        out = ['\n[ atoms ]']
 
         # For virtual sites and dummy beads we have to be able to specify the mass.
         # Thus we need two different format strings:
         fs8 = '%5d %5s %5d %5s %5s %5d %7.4f ; %s'  
         fs9 = '%5d %5s %5d %5s %5s %5d %7.4f %7.4f ; %s'  
-        out.extend([len(i)==9 and fs9%i or fs8%i for i in self.atoms])
+        out.extend([len(i)==9 and fs9%i or fs8%i for i in self.atoms.shifted()])
+        yield "\n".join(out)
 
         # Print out the vsites only if they excist. Right now it can only be type 1 virual sites.
-        vsites = [str(i) for i in self.vsites]
+        vsites = self.vsites.lines()
         if vsites:
-            out.append('\n[ virtual_sites2 ]')
-            out.extend(vsites)
+            yield "\n".join(['\n[ virtual_sites2 ]'] + vsites)
 
         # Print out the exclusions only if they excist.
-        exclusions = [str(i) for i in self.exclusions]
+        exclusions = self.exclusions.lines()
         if exclusions:
-            out.append('\n[ exclusions ]')
-            out.extend(exclusions)
+            yield "\n".join(['\n[ exclusions ]'] + exclusions)
 
         if self.multiscale:
-            out += ['\n;\n; Coarse grained to atomistic mapping\n;',
-                    '#define mapping virtual_sitesn',
-                    '[ mapping ]']
+            out = ['\n;\n; Coarse grained to atomistic mapping\n;',
+                   '#define mapping virtual_sitesn',
+                   '[ mapping ]']
             for i,j in self.mapping:
                 out.append( ("%5d     2 "%i)+" ".join(["%5d"%k for k in j]) )
+            yield "\n".join(out)
             
             logging.info('Created virtual sites section for multiscaled topology')
-            return "\n".join(out)
+            return
 
         # Bonds in order: backbone, backbone-sidechain, sidechain, short elastic, long elastic        
-        out.append("\n[ bonds ]")       
+        out = ["\n[ bonds ]"]
         for bondType,bondDesc in (
                 ("BB","Backbone bonds"),
                 ("SC","Sidechain bonds"),
@@ -4078,57 +4752,61 @@ class Topology:
                 ("Elastic long", "Long elastic bonds for extended regions"),
                 ("Cystine","Cystine bridges"),
                 ("Link","Links")):
-            bonds = [ str(i) for i in self.bonds[bondType] if not i.parameters[1] == None ]
+            bonds = self.bonds.lines(bondType,lambda i: not i.parameters[1] == None)
             if bonds:
                 out.append("; "+bondDesc)
                 out.extend(bonds)
 
         # Rubber Bands
-        bonds = [str(i) for i in self.bonds["Rubber",True]]
+        bonds = self.bonds.lines(("Rubber",True))
         if bonds:
             # Add a CPP style directive to allow control over the elastic network
             out.append("#ifndef NO_RUBBER_BANDS")
             out.append("#ifndef RUBBER_FC\n#define RUBBER_FC %f\n#endif"%self.options['ElasticMaximumForce'])
             out.extend(bonds)
             out.append("#endif")
+        yield "\n".join(out)
 
         # Constraints
-        out.append("\n[ constraints ]")
-        out.extend([str(i) for i in self.bonds["Constraint"]])
+        out = ["\n[ constraints ]"]
+        out.extend(self.bonds.lines("Constraint"))
         for bondType,bondDesc in (
                 ("Cystine","Cystine bridges"),
                 ("Link","Links")):
-            bonds = [ str(i) for i in self.bonds[bondType] if i.parameters[1] == None ]
+            bonds = self.bonds.lines(bondType,lambda i: i.parameters[1] == None)
             if bonds:
                 out.append("; "+bondDesc)
                 out.extend(bonds)
+        yield "\n".join(out)
 
         # Angles
-        out.append("\n[ angles ]")
+        out = ["\n[ angles ]"]
         out.append("; Backbone angles")
-        out.extend([str(i) for i in self.angles["BBB"]])
+        out.extend(self.angles.lines("BBB"))
         out.append("; Backbone-sidechain angles")
-        out.extend([str(i) for i in self.angles["BBS"]])
+        out.extend(self.angles.lines("BBS"))
         out.append("; Sidechain angles")
-        out.extend([str(i) for i in self.angles["SC"]])
+        out.extend(self.angles.lines("SC"))
+        yield "\n".join(out)
 
         # Dihedrals
-        out.append("\n[ dihedrals ]")
+        out = ["\n[ dihedrals ]"]
         out.append("; Backbone dihedrals")
-        out.extend([str(i) for i in self.dihedrals["BBBB"] if i.parameters])
+        out.extend(self.dihedrals.lines("BBBB",lambda i: i.parameters))
         out.append("; Sidechain improper dihedrals")
-        out.extend([str(i) for i in self.dihedrals["SC"] if i.parameters])
+        out.extend(self.dihedrals.lines("SC",lambda i: i.parameters))
+        yield "\n".join(out)
 
         # Postition Restraints
         if self.posres:
-            out.append("\n#ifdef POSRES")
+            out = ["\n#ifdef POSRES"]
             out.append("#ifndef POSRES_FC\n#define POSRES_FC %.2f\n#endif"%self.options['PosResForce'])
             out.append(" [ position_restraints ]")
-            out.extend(['  %5d    1    POSRES_FC    POSRES_FC    POSRES_FC'%i for i in self.posres])
+            out.extend(['  %5d    1    POSRES_FC    POSRES_FC    POSRES_FC'%i for i in self.posres.shifted()])
             out.append("#endif")
+            yield "\n".join(out)
 
         logging.info('Created coarsegrained topology')
-        return "\n".join(out)
 
   
     # The sequence function can be used to generate the topology for 
@@ -4363,7 +5041,8 @@ class Topology:
                 ElasticLowerBound,ElasticUpperBound,
                 ElasticDecayFactor,ElasticDecayPower,
                 ElasticMaximumForce,ElasticMinimumForce)
-            self.bonds.extend([Bond(i,options=self.options,type=6,category="Rubber band") for i in rubberList])
+            if rubberList:
+                self.bonds.append(BondedArray(rubberList,type=6,category="Rubber band"))
         
         # Note the equivalent of atomistic atoms that have been processed 
         if chain and self.multiscale:
@@ -4584,7 +5263,7 @@ class Topology:
 #############
 ## 8 # MAIN #  -> @MAIN <-
 #############
-import sys,logging,random,math,os,re
+import sys,logging,random,math,os,re,time,itertools,numpy
 
 def main(options):
     # Check whether to read from a gro/pdb file or from stdin
@@ -4609,7 +5288,27 @@ def main(options):
     model     = 1
     cgOutPDB  = None
     ssTotal   = []
+    ssCount   = SSConsensus()
     cysteines = []
+
+    # DSSP is run concurrently for chains, using a pool of threads, as 
+    # the work is done by the DSSP processes. If no coarse grained 
+    # structure is written, the results are only collected as needed, 
+    # so DSSP also runs concurrently for successive frames.
+    dsspPool  = None
+    pending   = 0
+    builtin   = options["-dssp"] and options["-dssp"].value == "builtin"
+    if options["-dssp"] and not builtin and not options["-ss"] and not options['Collagen']:
+        from multiprocessing.pool import ThreadPool
+        import multiprocessing
+        nproc    = options["-np"].value or multiprocessing.cpu_count()
+        dsspPool = ThreadPool(nproc)
+
+    # The built-in secondary structure determination is done for all 
+    # frames at once, unless the coarse grained structure is written. 
+    # Until then the backbone coordinates of the protein chains are kept.
+    ssBatch = builtin and not options["-x"].value
+
     for title,atoms,box in frameIterator(inStream):
     
         if fileType == "PDB":
@@ -4683,6 +5382,8 @@ def main(options):
         # Check which chains need merging
         if model == 1:
             order, merge = check_merge(chains, options['mergeList'], options['linkList'], options['CystineCheckBonds'] and options['CystineMaxDist2'])
+            # Keep the first frame for setting up trajectory mapping
+            firstAtoms, firstChains = atoms, chains
     
 
         # Get the total length of the sequence
@@ -4727,7 +5428,9 @@ def main(options):
                 chain.set_ss(sstmp[:ln])
                 sstmp = ss[:ln]                         
         else:
-            if options["-dssp"]:
+            if builtin:
+                method, executable = "builtin", None
+            elif options["-dssp"]:
                 method, executable = "dssp", options["-dssp"].value
             #elif options["-pymol"]:
             #    method, executable = "pymol", options["-pymol"].value
@@ -4735,15 +5438,32 @@ def main(options):
                 logging.warning("No secondary structure or determination method speficied. Protein chains will be set to 'COIL'.")
                 method, executable = None, None
         
-            for chain in chains:
-                ss += chain.dss(method, executable)
-        
-            # Used to be: if method in ("dssp","pymol"): but pymol is not supported
-            if method in ["dssp"]:
-                logging.debug('%s determined secondary structure:\n'%method.upper()+ss)
+            if dsspPool:
+                ss = [dsspPool.apply_async(chain.dss,(method, executable)) for chain in chains]
+            elif ssBatch:
+                ss = [chain.type() == "Protein" and ssBackbone(chain.residues) or chain.dss() for chain in chains]
+            else:
+                for chain in chains:
+                    ss += chain.dss(method, executable)
         
         # Collect the secondary structure classifications for different frames
-        ssTotal.append(ss)    
+        # Pending results are kept until they are available.
+        if type(ss) == str:
+            ssCount.add(ss)
+        else:
+            ssTotal.append(ss)    
+
+        # Collect pending DSSP results. This is needed for the current frame
+        # if the structure is written. Otherwise, the number of frames with
+        # pending results is limited to twice the number of DSSP runs.
+        if dsspPool:
+            limit = not options["-x"].value and 2*nproc or 0
+            while len(ssTotal) - pending > limit:
+                ss = "".join([i.get() for i in ssTotal[pending]])
+                logging.debug('DSSP determined secondary structure:\n'+ss)
+                ssCount.add(ss)
+                ssTotal[pending] = None
+                pending += 1
     
         # Write the coarse grained structure if requested
         if options["-x"].value:
@@ -4788,6 +5508,59 @@ def main(options):
         cysteines.append([cys for cys in cyslist if cys])
     
         model += 1
+
+
+    # Collect the remaining DSSP results
+    if dsspPool:
+        for i in range(pending,len(ssTotal)):
+            ss = "".join([j.get() for j in ssTotal[i]])
+            logging.debug('DSSP determined secondary structure:\n'+ss)
+            ssCount.add(ss)
+            ssTotal[i] = None
+        dsspPool.close()
+        dsspPool.join()
+
+    if model == 1:
+        raise RuntimeError("No atoms read from %s."%(options["-f"] and options["-f"].value or "standard input"))
+
+
+    # Determine the secondary structure for the frames collected, doing 
+    # all frames of a chain at once. Chains are matched over frames by 
+    # their position and number of residues.
+    if ssBatch:
+        groups = {}
+        for f,frame in enumerate(ssTotal):
+            for k,item in enumerate(frame):
+                if type(item) != str:
+                    groups.setdefault((k,len(item[1])),[]).append(f)
+        for (k,n),frames in groups.items():
+            x = numpy.array([ssTotal[f][k][0] for f in frames])
+            for f,ss in zip(frames,ssFrames(x,ssTotal[frames[0]][k][1])):
+                ssTotal[f][k] = ss
+        # Set the secondary structure for the chains of the last frame,
+        # and of the first, which are used for mapping a trajectory.
+        for frameChains,frame in ((firstChains,ssTotal[0]),(chains,ssTotal[-1])):
+            for chain,ss in zip(frameChains,frame):
+                if chain.type() == "Protein":
+                    chain.set_ss(ss,source="dssp")
+        for frame in ssTotal:
+            ssCount.add("".join(frame))
+        ssTotal = []
+
+
+    # Map a trajectory, using the chains from the first frame
+    if options["-trj"].value:
+        if not options["-ox"].value:
+            logging.warning("No output file given (-ox) for the mapped trajectory. The trajectory is skipped.")
+        else:
+            logging.info("Mapping trajectory %s."%options["-trj"].value)
+            plan    = mapPlan(firstChains,order,firstAtoms)
+            if plan is None:
+                logging.warning("No chains to coarse grain in the first frame; nothing to map for the trajectory.")
+            else:
+                frames  = ((title,mapFrame(plan,x),box) for title,x,box in trajectoryFrames(options["-trj"].value))
+                nframes = writeTrajectory(options["-ox"].value,plan,frames)
+                logging.info("Wrote %d frames of the coarse grained trajectory."%nframes)
     
     
     # Write the index file if requested.
@@ -4837,7 +5610,7 @@ def main(options):
             # This gives out a list of atoms in residue, each tuple has other 
             # stuff in it that's needed elsewhere so we just take the last 
             # element which is the atom index (in that residue)
-            for j_count, j in enumerate(mapIndex(i)):
+            for j_count, j in enumerate(mapIndex(i,options["ForceField"].ca2bb)):
                 outNDX.write('[ Bead %i of residue %i ]\n'%(j_count+1,i_count+1))
                 line = ''
                 for k in j:
@@ -4856,25 +5629,7 @@ def main(options):
     if options['-o']:
 
         # Collect the secondary structure stuff and decide what to do with it
-        # First rearrange by the residue
-        ssTotal = zip(*ssTotal)
-        ssAver  = []
-        for i in ssTotal:
-            si = list(set(i))
-            if len(si) == 1:
-                # Only one type -- consensus
-                ssAver.append(si[0])
-            else:
-                # Transitions between secondary structure types
-                i = list(i)
-                si = [(1.0*i.count(j)/len(i),j) for j in si]
-                si.sort()
-                if si[-1][0] > options["-ssc"].value:
-                    ssAver.append(si[-1][1])
-                else:
-                    ssAver.append(" ")
-        
-        ssAver = "".join(ssAver)
+        ssAver = ssCount.consensus(options["-ssc"].value)
         logging.info('(Average) Secondary structure has been determined (see head of .itp-file).')
         
 
@@ -4931,6 +5686,17 @@ def main(options):
         # moleculetypes.
         
         molecules = [tuple([chains[i] for i in j]) for j in merge]
+
+        # Molecules are identical if the chains have the same fingerprints
+        # and the same links apply. The links are listed with the position
+        # of the chain in the molecule instead of the chain identifier.
+        def moleculeKey(mol):
+            ids  = [chain.id for chain in mol]
+            sig  = []
+            for atomA,atomB,bondlength,forceconst in options['linkListCG']:
+                if atomA[3] in ids and atomB[3] in ids:
+                    sig.append((atomA[:3],ids.index(atomA[3]),atomB[:3],ids.index(atomB[3]),bondlength,forceconst))
+            return tuple([chain.fingerprint() for chain in mol]), tuple(sig)
         
         # At this point we should have a list or dictionary of chains
         # Each chain should be given a unique name, based on the value
@@ -4944,15 +5710,33 @@ def main(options):
         # XXX *NOTE*: This should probably be gathered in a 'Universe' class
         itp = 0
         moleculeTypes = {}
-        for mi in range(len(molecules)):
-            mol = molecules[mi]
+        # Moleculetype names and topologies by molecule key 
+        keyTypes = {}
+        keyItps  = {}
+        for mol in molecules:
+            key = moleculeKey(mol)
             # Check if the moleculetype is already listed
             # If not, generate the topology from the chain definition
-            if not mol in moleculeTypes or options['SeparateTop']:
+            # Skip this step if we are to write all chains to separate moleculetypes
+            if key in keyTypes and not options['SeparateTop']:
+                # Set the name of the moleculetype to the one of the equal molecule
+                moleculeTypes[mol] = keyTypes[key]
+            elif key in keyItps:
+                # Separate topologies are requested for identical molecules, 
+                # without elastic network. Only the name is different.
+                name = "+".join([chain.getname(options['-name'].value) for chain in mol])
+                moleculeTypes[mol] = name
+                top, body = keyItps[key]
+                top.name  = name
+                destination = options["-o"] and open(name+".itp",'w') or sys.stdout
+                top.write(destination,body)
+                itp += 1
+            else:
                 # Name of the moleculetype
                 # XXX: The naming should be changed; now it becomes Protein_X+Protein_Y+...
                 name = "+".join([chain.getname(options['-name'].value) for chain in mol])
                 moleculeTypes[mol] = name
+                keyTypes[key] = name
     
                 # Write the molecule type topology
                 top = Topology(mol[0],options=options,name=name)
@@ -4982,27 +5766,26 @@ def main(options):
                 if options['ElasticNetwork']:
                     rubberType = options['ForceField'].EBondType
                     rubberList = rubberBands(
-                        [(i[0],j) for i,j in zip(top.atoms,coords) if i[4] in options['ElasticBeads']],
+                        [(i[0],j) for i,j in zip(top.atoms.shifted(),coords) if i[4] in options['ElasticBeads']],
                         options['ElasticLowerBound'],options['ElasticUpperBound'],
                         options['ElasticDecayFactor'],options['ElasticDecayPower'],
                         options['ElasticMaximumForce'],options['ElasticMinimumForce'])
-                    top.bonds.extend([Bond(i,options=options,type=rubberType,category="Rubber band") for i in rubberList])
+                    if rubberList:
+                        top.bonds.append(BondedArray(rubberList,type=rubberType,category="Rubber band"))
     
                 # Write out the MoleculeType topology
+                # The body only depends on the coordinates through the 
+                # elastic network, so without, it is kept for reuse.
+                # Otherwise, it is formatted while it is written.
+                body = None
+                if options['SeparateTop'] and not options['ElasticNetwork']:
+                    body = list(top.body())
+                    keyItps[key] = (top, body)
                 destination = options["-o"] and open(moleculeTypes[mol]+".itp",'w') or sys.stdout
-                destination.write(str(top))        
+                top.write(destination,body)
         
                 itp += 1
         
-            # Check whether other chains are equal to this one 
-            # Skip this step if we are to write all chains to separate moleculetypes
-            if not options['SeparateTop']:
-                for j in range(mi+1,len(molecules)):
-                    if not molecules[j] in moleculeTypes and mol == molecules[j]:
-                        # Molecule j is equal to a molecule mi
-                        # Set the name of the moleculetype to the one of that molecule
-                        moleculeTypes[molecules[j]] = moleculeTypes[mol]
-        
         logging.info('Written %d ITP file%s'%(itp,itp>1 and "s" or ""))
                 
         # WRITING THE MASTER TOPOLOGY
@@ -5048,8 +5831,142 @@ Martini system from %s
 
     # The following lines are always printed (if no errors occur).
     print "\n\tThere you are. One MARTINI. Shaken, not stirred.\n"
-    Q = martiniq.pop(random.randint(0,len(martiniq)-1))
+    Q = martiniq[random.randint(0,len(martiniq)-1)]
     print "\n", Q[1], "\n%80s"%("--"+Q[0]), "\n"
+
+    return chains
+
+# Run martinize from within Python, with the arguments as given on the
+# command line. When importing martinize as a module, this allows 
+# processing many structures in one process, loading the modules, the 
+# force field and the mapping tables only once.
+def run(args):
+    opts, optlists = option_copy()
+    return main(option_parser(list(args),opts,optlists,version))
+
+
+# Batch processing. The structures are given as a directory or as a 
+# file listing the structures. Each structure is processed in a worker
+# process, running martinize with the command line arguments for the 
+# batch, with the input and the options for batch processing replaced.
+# The workers are forked after the force field is loaded, so they all
+# start out with it. 
+batchExtensions = (".pdb",".gro",".ent",".pdb.gz",".gro.gz",".ent.gz")
+
+def batchInputs(source):
+    if os.path.isdir(source):
+        return sorted([os.path.join(source,i) for i in os.listdir(source) if i.lower().endswith(batchExtensions)])
+    return [i.strip() for i in open(source) if i.strip() and not i.strip().startswith("#")]
+
+
+def batchName(filename):
+    name = os.path.basename(filename)
+    for ext in batchExtensions:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def batchNames(inputs):
+    """Names of the output directories, made unique with a number suffix"""
+    names, used = [], set()
+    for filename in inputs:
+        name, n = batchName(filename), 1
+        while name in used:
+            n   += 1
+            name = "%s-%d"%(batchName(filename),n)
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def batchWorker(item):
+    """Process a single structure in its own directory; return a summary tuple"""
+    filename, name, outdir, args = item
+    here  = os.getcwd()
+    start = time.time()
+    out   = os.path.join(outdir,name)
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    # Send the output of this run to a log file
+    log    = open(os.path.join(out,"martinize.log"),"w")
+    stdout = sys.stdout
+    streams = [(h,h.stream) for h in logging.getLogger().handlers if hasattr(h,"stream")]
+    sys.stdout = log
+    for h,stream in streams:
+        h.stream = log
+    try:
+        os.chdir(out)
+        chains = run(args+["-f",os.path.abspath(os.path.join(here,filename))])
+        status = ("OK", len(chains), sum([len(i) for i in chains]), "")
+    except (Exception, SystemExit), e:
+        logging.error("Processing %s failed: %s"%(filename,e))
+        status = ("FAILED", 0, 0, str(e).splitlines() and str(e).splitlines()[0] or e.__class__.__name__)
+    finally:
+        os.chdir(here)
+        sys.stdout = stdout
+        for h,stream in streams:
+            h.stream = stream
+        log.close()
+    return (name, status[0], time.time()-start) + status[1:]
+
+
+def batch(options):
+    inputs = batchInputs(options["-batch"].value)
+    outdir = options["-bo"].value
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # The arguments for the individual runs; the input, the batch 
+    # options and the number of processes are dropped. Each run uses
+    # a single DSSP process, as the structures run concurrently.
+    # The runs are done in the output directories, so input files and
+    # a DSSP executable given with a path are made absolute. Output 
+    # files are written to the directory of each structure.
+    args, skip = [], options['Arguments'][:]
+    while skip:
+        ar = skip.pop(0)
+        par = [skip.pop(0) for i in range(options[ar].num)]
+        if ar == "-trj" or (ar == "-ss" and os.path.exists(par[0])) or (ar == "-dssp" and os.sep in par[0]):
+            par = [os.path.abspath(par[0])]
+        if not ar in ("-f","-batch","-bo","-np"):
+            args.extend([ar]+par)
+    args.extend(["-np","1"])
+
+    import multiprocessing
+    nproc = options["-np"].value or multiprocessing.cpu_count()
+    logging.info("Processing %d structures using %d processes."%(len(inputs),nproc))
+
+    start   = time.time()
+    items   = [(i,name,outdir,args) for i,name in zip(inputs,batchNames(inputs))]
+    if nproc > 1:
+        pool    = multiprocessing.Pool(nproc)
+        results = pool.imap(batchWorker,items)
+    else:
+        pool    = None
+        results = itertools.imap(batchWorker,items)
+
+    summary = open(os.path.join(outdir,"summary.txt"),"w")
+    summary.write("; %-20s %7s %9s %7s %9s  %s\n"%("structure","status","time(s)","chains","residues","message"))
+    failed  = 0
+    for n,result in enumerate(results):
+        summary.write("  %-20s %7s %9.3f %7d %9d  %s\n"%result)
+        summary.flush()
+        failed += result[1] != "OK"
+        logging.info("%5d/%d %-20s %s (%.3f s)"%(n+1,len(inputs),result[0],result[1],result[2]))
+    total = time.time() - start
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    # Throughput
+    rate = total and len(inputs)/total or 0
+    summary.write("; %d structures, %d failed, %.3f s, %.3f structures/s\n"%(len(inputs),failed,total,rate))
+    summary.close()
+    logging.info("Processed %d structures (%d failed) in %.3f s: %.3f structures/s"%(len(inputs),failed,total,rate))
+
+
 if __name__ == '__main__':
     import sys,logging
     args = sys.argv[1:]
@@ -5062,4 +5979,11 @@ if __name__ == '__main__':
     # Parse commandline options.
     options = option_parser(args,options,lists,version)
 
-    main(options)
+    if options["-batch"]:
+        batch(options)
+    else:
+        try:
+            main(options)
+        except RuntimeError, e:
+            logging.error(str(e))
+            sys.exit(1)
@@ -0,0 +1,6 @@
+"""
+Tests for the legacy scripts. The tests of the gmx package are in that
+package. All tests are run from the legacy directory with:
+
+    python -m unittest discover
+"""
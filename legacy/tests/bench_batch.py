@@ -0,0 +1,69 @@
+
+"""
+Benchmark for batch processing in martinize: the time for processing
+a number of structures with separate martinize runs, compared to a
+single run with -batch. The structures are generated poly-alanine
+helices, with the secondary structure given on the command line.
+
+Run from the legacy directory with:
+
+    python tests/bench_batch.py [structures [residues [processes]]]
+"""
+
+import os, sys, math, time, shutil, tempfile, subprocess
+
+here      = os.path.dirname(os.path.abspath(__file__))
+martinize = os.path.join(os.path.dirname(here),"martinize.py")
+
+
+def helix(n):
+    """PDB text of an ideal poly-alanine helix of n residues"""
+    # Atom name, radius, phase (degrees) and height relative to the CA
+    atoms = (("N",1.55,-28,-0.9),("CA",2.3,0,0),("C",1.64,28,0.9),("O",1.8,40,2.1),("CB",3.3,-10,-0.2))
+    out = []
+    for i in range(n):
+        for name,r,phi,z in atoms:
+            a = math.radians(100*i+phi)
+            out.append("ATOM  %5d  %-3s ALA A%4d    %8.3f%8.3f%8.3f  1.00  0.00\n" %
+                       (len(out)+1,name,i+1,r*math.cos(a),r*math.sin(a),1.5*i+z))
+    return "".join(out)+"END\n"
+
+
+def timed(command,cwd):
+    start = time.time()
+    with open(os.devnull,"w") as null:
+        subprocess.check_call(command,cwd=cwd,stdout=null,stderr=null)
+    return time.time()-start
+
+
+def main(structures=20,residues=100,processes=1):
+    tmp = tempfile.mkdtemp()
+    try:
+        inputs = os.path.join(tmp,"inputs")
+        os.makedirs(inputs)
+        pdb = helix(residues)
+        for i in range(structures):
+            with open(os.path.join(inputs,"helix%03d.pdb"%i),"w") as f:
+                f.write(pdb)
+        args = ["-ss",residues*"H","-o","topol.top","-x","cg.pdb"]
+
+        # Separate runs, one after the other
+        separate = 0
+        for i in sorted(os.listdir(inputs)):
+            out = os.path.join(tmp,"separate",i[:-4])
+            os.makedirs(out)
+            separate += timed([sys.executable,martinize,"-f",os.path.join(inputs,i)]+args,out)
+
+        # A single batch run
+        batch = timed([sys.executable,martinize,"-batch",inputs,"-bo",os.path.join(tmp,"batch"),
+                       "-np",str(processes)]+args,tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+    print "%d structures of %d residues" % (structures,residues)
+    print "separate runs:          %8.3f s (%.3f structures/s)" % (separate,structures/separate)
+    print "batch (%2d processes):   %8.3f s (%.3f structures/s)" % (processes,batch,structures/batch)
+
+
+if __name__ == "__main__":
+    main(*[int(i) for i in sys.argv[1:4]])
@@ -0,0 +1,179 @@
+
+"""Backmapping structures and trajectories with backward, run as a script"""
+
+import os, sys, json, struct, shutil, tempfile, subprocess, unittest
+
+
+here     = os.path.dirname(os.path.abspath(__file__))
+backward = os.path.join(os.path.dirname(here),"backward.py")
+
+
+# A coarse grained peptide with some water: (resid, resname, name, x, y, z)
+system = [(1,"ALA","BB",1.0,1.0,1.0),(2,"LEU","BB",1.38,1.0,1.05),(2,"LEU","SC1",1.38,1.1,1.05),
+          (3,"GLY","BB",1.76,1.0,1.0),(4,"SER","BB",2.14,1.0,1.05),(4,"SER","SC1",2.14,1.1,1.05),
+          (5,"LYS","BB",2.52,1.0,1.0),(5,"LYS","SC1",2.52,1.1,1.0),(5,"LYS","SC2",2.52,1.2,1.0),
+          (6,"ALA","BB",2.9,1.0,1.05),(7,"W","W",3.0,3.0,3.0),(8,"W","W",3.5,3.0,3.0),(9,"W","W",4.0,3.0,3.0)]
+
+
+def frame(k):
+    """Coordinates of frame k: the peptide moved along x"""
+    return [(x+0.1*k*(r < 7),y,z) for r,rn,name,x,y,z in system]
+
+
+def groFrame(x,title="CG test"):
+    lines = ["%s\n%5d\n"%(title,len(x))]
+    for i,(a,c) in enumerate(zip(system,x)):
+        lines.append("%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"%(a[:3]+(i+1,)+c))
+    lines.append("   5.00000   5.00000   5.00000\n")
+    return "".join(lines)
+
+
+def trrFrame(k,x):
+    """A TRR frame in single precision with box and coordinates"""
+    n = len(x)
+    return (struct.pack(">ll",1993,13) + struct.pack(">l",12) + "GMX_trn_file" +
+            struct.pack(">"+13*"l"+"ff",0,0,36,0,0,0,0,12*n,0,0,n,k,0,float(k),0.0) +
+            struct.pack(">9f",5,0,0,0,5,0,0,0,5) +
+            struct.pack(">%df"%(3*n),*[c for p in x for c in p]))
+
+
+def residues(frame):
+    """Residues of a GRO frame as ((resid, resname), [names])"""
+    out = []
+    for line in frame:
+        key = (int(line[:5]),line[5:10].strip())
+        if not out or out[-1][0] != key:
+            out.append((key,[]))
+        out[-1][1].append(line[10:15].strip())
+    return out
+
+
+def topology(res):
+    """Target topology for a peptide with the atoms of each residue in reverse order, and water"""
+    lines, n = ["[ moleculetype ]\nPEP 3\n\n[ atoms ]\n"], 0
+    for (r,resn),names in res:
+        for name in reversed(names):
+            n += 1
+            lines.append("%5d  X %5d %5s %5s %5d\n"%(n,r,resn,name,n))
+    lines.append("\n[ moleculetype ]\nSOL 2\n\n[ atoms ]\n 1 OW 1 SOL OW 1\n 2 HW 1 SOL HW1 1\n 3 HW 1 SOL HW2 1\n")
+    lines.append("\n[ system ]\nTest\n\n[ molecules ]\nPEP 1\nSOL 3\n")
+    return "".join(lines)
+
+
+def groFrames(filename):
+    """Frames of a GRO file as lists of atom lines"""
+    lines, out = open(filename).readlines(), []
+    while lines:
+        n = int(lines[1])
+        out.append(lines[2:n+2])
+        lines = lines[n+3:]
+    return out
+
+
+class TestBackward(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self,name,text):
+        with open(os.path.join(self.dir,name),"wb") as f:
+            f.write(text)
+        return name
+
+    def backward(self,args,fail=False):
+        p = subprocess.Popen([sys.executable,backward]+args,cwd=self.dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if fail:
+            self.assertNotEqual(p.returncode,0)
+        else:
+            self.assertEqual(p.returncode,0,err)
+        return out+err
+
+    def test_frames(self):
+        self.write("cg.gro","".join([groFrame(frame(k)) for k in range(3)]))
+        self.backward(["-f","cg.gro","-o","aa.gro","-seed","1"])
+        frames = groFrames(os.path.join(self.dir,"aa.gro"))
+        self.assertEqual(len(frames),3)
+        self.assertEqual(len(set([len(i) for i in frames])),1)
+        # The peptide moves along with the coarse grained structure
+        x = [float(frames[k][0][20:28]) for k in range(3)]
+        self.assertAlmostEqual(x[1]-x[0],0.1,1)
+        self.assertAlmostEqual(x[2]-x[0],0.2,1)
+
+    def test_trr(self):
+        # The same frames from a TRR file give the same atoms
+        self.write("cg.gro","".join([groFrame(frame(k)) for k in range(3)]))
+        self.write("first.gro",groFrame(frame(0)))
+        self.write("cg.trr","".join([trrFrame(k,frame(k)) for k in range(3)]))
+        self.backward(["-f","cg.gro","-o","aa.gro","-seed","1"])
+        self.backward(["-f","first.gro","-trr","cg.trr","-o","trr.gro","-seed","1"])
+        gro = groFrames(os.path.join(self.dir,"aa.gro"))
+        trr = groFrames(os.path.join(self.dir,"trr.gro"))
+        self.assertEqual(len(trr),3)
+        self.assertEqual([len(i) for i in trr],[len(i) for i in gro])
+        self.assertEqual([i[:20] for i in trr[2]],[i[:20] for i in gro[2]])
+        self.assertAlmostEqual(float(trr[2][0][20:28]),float(gro[2][0][20:28]),1)
+
+    def test_trr_natoms(self):
+        # A frame with another number of atoms is an error
+        self.write("first.gro",groFrame(frame(0)))
+        self.write("cg.trr",trrFrame(0,frame(0))+trrFrame(1,frame(1)[:-1]))
+        err = self.backward(["-f","first.gro","-trr","cg.trr","-o","trr.gro"],fail=True)
+        self.assertTrue("Frame 2 of cg.trr: Coordinates given for 12 atoms, while the structure has 13." in err)
+
+    def test_parallel(self):
+        # Every residue has its own random stream: the output does not
+        # depend on the number of processes or the chunks of residues
+        self.write("cg.gro","".join([groFrame(frame(k)) for k in range(2)]))
+        self.backward(["-f","cg.gro","-o","serial.gro","-seed","3"])
+        serial = open(os.path.join(self.dir,"serial.gro")).read()
+        for n,chunk in (("2","0"),("2","1"),("3","2")):
+            self.backward(["-f","cg.gro","-o","parallel.gro","-seed","3","-np",n,"-chunk",chunk])
+            self.assertEqual(open(os.path.join(self.dir,"parallel.gro")).read(),serial)
+        self.backward(["-f","cg.gro","-o","other.gro","-seed","4"])
+        self.assertNotEqual(open(os.path.join(self.dir,"other.gro")).read(),serial)
+
+    def test_profile(self):
+        # The report holds the stages, the unbreak time and the residue
+        # statistics, also when frames are processed by workers
+        self.write("cg.gro","".join([groFrame(frame(k)) for k in range(3)]))
+        for n in ("1","2"):
+            self.backward(["-f","cg.gro","-o","aa.gro","-np",n,"-profile","profile.json"])
+            report = json.load(open(os.path.join(self.dir,"profile.json")))
+            self.assertEqual(report["frames"],3)
+            self.assertEqual(report["processes"],int(n))
+            self.assertEqual([i["stage"] for i in report["stages"]][:2],["topology","structure"])
+            self.assertTrue("unbreak" in report["parts"])
+            self.assertEqual(dict([(i,j["count"]) for i,j in report["residues"].items()]),
+                             {"ALA": 6, "LEU": 3, "GLY": 3, "SER": 3, "LYS": 3, "W": 9})
+        # Without periodic boundary conditions nothing is unbroken
+        self.backward(["-f","cg.gro","-o","aa.gro","-nopbc","-profile","profile.json"])
+        self.assertFalse("unbreak" in json.load(open(os.path.join(self.dir,"profile.json")))["parts"])
+
+    def test_target(self):
+        # The atoms of a residue are written in the order of the target
+        # topology, except for residues with duplicate names (the two
+        # carboxyl oxygens of the last residue), which follow the mapping
+        self.write("cg.gro",groFrame(frame(0)))
+        self.backward(["-f","cg.gro","-o","aa.gro","-seed","1"])
+        res = residues(groFrames(os.path.join(self.dir,"aa.gro"))[0])
+        self.write("aa.top",topology(res))
+        out = self.backward(["-f","cg.gro","-o","target.gro","-p","aa.top","-atomlist","atoms.txt","-seed","1"])
+        target = residues(groFrames(os.path.join(self.dir,"target.gro"))[0])
+        self.assertEqual([i[0] for i in target],[i[0] for i in res])
+        for (key,names),(_,ref) in zip(target[:-1],res[:-1]):
+            self.assertEqual(names,ref[::-1])
+        self.assertEqual(target[-1][1],res[-1][1])
+        self.assertTrue("The target list for residue ALA contains duplicate names" in out)
+        # The atom list follows the topology, including the solvent
+        atoms = open(os.path.join(self.dir,"atoms.txt")).read().split()
+        self.assertEqual(len(atoms),3*(sum([len(i[1]) for i in res])+9))
+        self.assertEqual(atoms[:3],["1",res[0][1][-1],"ALA"])
+        self.assertEqual(atoms[-3:],["59","HW2","SOL"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+
+"""Batch processing of structures with martinize"""
+
+import os, sys, shutil, logging, tempfile, subprocess, unittest
+
+import martinize
+from bench_batch import helix, martinize as script
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def martinize(self,args):
+        p = subprocess.Popen([sys.executable,script]+args,cwd=self.dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return p.returncode, err
+
+    def test_names(self):
+        self.assertEqual(martinize.batchNames(["a/x.pdb","b/x.pdb","x.gro.gz","y.ent"]),["x","x-2","x-3","y"])
+
+    def test_no_atoms(self):
+        with open(os.path.join(self.dir,"empty.pdb"),"w") as f:
+            f.write("REMARK no atoms\n")
+        code, err = self.martinize(["-f","empty.pdb","-o","topol.top"])
+        self.assertEqual(code,1)
+        self.assertTrue("No atoms read from empty.pdb" in err)
+
+    def test_batch(self):
+        inputs = os.path.join(self.dir,"inputs")
+        os.makedirs(inputs)
+        for name,text in (("empty.pdb",""),("helix.pdb",helix(8))):
+            with open(os.path.join(inputs,name),"w") as f:
+                f.write(text)
+        code, err = self.martinize(["-batch","inputs","-bo","out","-ss",8*"H","-o","topol.top"])
+        self.assertEqual(code,0,err)
+        summary = [i.split() for i in open(os.path.join(self.dir,"out","summary.txt")) if not i.startswith(";")]
+        self.assertEqual([i[:2] for i in summary],[["empty","FAILED"],["helix","OK"]])
+        self.assertEqual(summary[0][5:8],["No","atoms","read"])
+        self.assertEqual(summary[1][3:5],["1","8"])
+        self.assertTrue(os.path.exists(os.path.join(self.dir,"out","helix","topol.top")))
+
+    def test_repeated(self):
+        # Runs in a single process do not affect each other, also
+        # when more are done than there are closing quotes
+        with open(os.path.join(self.dir,"helix.pdb"),"w") as f:
+            f.write(helix(8))
+        outdir = os.path.join(self.dir,"out")
+        args   = ["-ss",8*"H","-o","topol.top","-x","cg.pdb"]
+        # Without a handler, the first run would set up logging to stderr
+        root = logging.getLogger()
+        null = logging.NullHandler()
+        root.addHandler(null)
+        try:
+            for i in range(10):
+                extra  = i == 3 and ["-multi","A","-merge","A"] or []
+                result = martinize.batchWorker((os.path.join(self.dir,"helix.pdb"),"run%d"%i,outdir,args+extra))
+                self.assertEqual(result[1],"OK",result)
+        finally:
+            root.removeHandler(null)
+        self.assertEqual(martinize.lists,{"cystines": [], "links": [], "merges": [], "multi": []})
+        for name in ("Protein_A.itp","cg.pdb"):
+            first = open(os.path.join(outdir,"run0",name)).read()
+            self.assertEqual(open(os.path.join(outdir,"run9",name)).read(),first)
+        # Multiscaling is only used for the run it was given for
+        self.assertTrue("Multiscale" in open(os.path.join(outdir,"run3","Protein_A.itp")).readline())
+        self.assertFalse("Multiscale" in open(os.path.join(outdir,"run9","Protein_A.itp")).readline())
+
+
+if __name__ == "__main__":
+    unittest.main()
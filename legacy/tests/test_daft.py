@@ -0,0 +1,174 @@
+
+"""Building DAFT assays with daft, run as a script"""
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy
+
+from bench_batch import helix
+from gmx.cache   import Cache, fileTag
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+daft = os.path.join(os.path.dirname(here),"daft.py")
+
+
+def coords(text):
+    """Coordinates of the atoms in PDB text"""
+    return numpy.array([[float(i[30:38]),float(i[38:46]),float(i[46:54])] for i in text.splitlines() if i.startswith("ATOM")])
+
+
+def distances(x):
+    return numpy.sqrt(((x[:,None]-x[None])**2).sum(axis=2))
+
+
+def files(top):
+    """Contents of all files below a directory, by relative path"""
+    out = {}
+    for path,dirs,names in os.walk(top):
+        for name in names:
+            out[os.path.relpath(os.path.join(path,name),top)] = open(os.path.join(path,name)).read()
+    return out
+
+
+class TestDaft(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pdb = os.path.join(self.dir,"helix.pdb")
+        with open(self.pdb,"w") as f:
+            f.write(helix(6))
+        self.env = dict(os.environ)
+        self.env["HOME"] = self.dir
+        self.env.pop("DAFTCACHE",None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def daft(self,args,cwd="run"):
+        cwd = os.path.join(self.dir,cwd)
+        if not os.path.isdir(cwd):
+            os.makedirs(cwd)
+        p = subprocess.Popen([sys.executable,daft]+args,cwd=cwd,env=self.env,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode,0,err)
+        return out
+
+    def replica(self,k,cwd="run"):
+        return open(os.path.join(self.dir,cwd,"0","test","test-%04d"%k,"test.pdb")).read()
+
+    def test_cache(self):
+        cache = Cache(os.path.join(self.dir,"cache"))
+        self.env["DAFTCACHE"] = cache.directory
+        args  = ["-f",self.pdb,"-name","test","-n","2","-seed","3"]
+        self.daft(args,"first")
+        tag   = fileTag(self.pdb)
+        name  = cache.filename(tag,"helix.pdb")
+        self.assertEqual(os.listdir(cache.directory),[os.path.basename(name)])
+        # A stored structure is used instead of reading the file
+        stuff = cache.load(tag,"helix.pdb")
+        stuff["atoms"] = [("XX",)+a[1:] for a in stuff["atoms"]]
+        cache.save(tag,stuff,"helix.pdb")
+        self.daft(args,"second")
+        self.assertTrue(" XX " in self.replica(1,"second"))
+        # But not if it is stored with another tag
+        with open(name,"wb") as f:
+            pickle.dump(("other",stuff),f,2)
+        self.daft(args,"third")
+        self.assertEqual(self.replica(1,"third"),self.replica(1,"first"))
+
+    def test_no_cache(self):
+        self.daft(["-f",self.pdb,"-name","test","-n","1"])
+        self.assertFalse(os.path.exists(os.path.join(self.dir,".cache")))
+
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        self.env["HOME"] = self.dir
+        self.env.pop("DAFTCACHE",None)
+        # Two helices of different lengths
+        self.items = []
+        for n in (6,4):
+            self.items.append(os.path.join(self.dir,"helix%d.pdb"%n))
+            with open(self.items[-1],"w") as f:
+                f.write(helix(n))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def daft(self,args,cwd="run"):
+        cwd = os.path.join(self.dir,cwd)
+        if not os.path.isdir(cwd):
+            os.makedirs(cwd)
+        p = subprocess.Popen([sys.executable,daft,"-f",self.items[0],"-f",self.items[1],"-name","t"]+args,
+                             cwd=cwd,env=self.env,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode,0,err)
+        return out
+
+    def replica(self,k,cwd="run",combination="0-1"):
+        return open(os.path.join(self.dir,cwd,combination,"t","t-%04d"%k,"t.pdb")).read()
+
+    def check(self,cwd,nrep,keep=None):
+        # The items are moved as rigid bodies. Rotations in the plane
+        # keep z and rotations around x (adsorption) keep x.
+        x = [coords(open(i).read()) for i in self.items]
+        for k in range(1,nrep+1):
+            y = coords(self.replica(k,cwd))
+            for a,b in ((x[0],y[:len(x[0])]),(x[1],y[len(x[0]):])):
+                self.assertTrue(numpy.allclose(distances(a),distances(b),atol=0.01))
+                if keep is not None:
+                    self.assertTrue(numpy.allclose(b[:,keep]-b[0,keep],a[:,keep]-a[0,keep],atol=0.01))
+
+    def test_rotations(self):
+        self.daft(["-n","4","-seed","5","-3d"],"3d")
+        self.check("3d",4)
+        self.daft(["-n","4","-seed","5"],"plane")
+        self.check("plane",4,2)
+        self.daft(["-n","4","-seed","5","-ads","2"],"ads")
+        self.check("ads",4,0)
+        # The replicas differ
+        self.assertNotEqual(self.replica(1,"3d"),self.replica(2,"3d"))
+
+    def test_processes(self):
+        # Each combination has its own random stream from the seed: the
+        # output does not depend on the number of processes
+        args = ["-n","3","-seed","3","-c","1","-c","2","-c","2!"]
+        self.daft(args,"serial")
+        self.daft(args+["-np","3"],"parallel")
+        serial = files(os.path.join(self.dir,"serial"))
+        self.assertEqual(len([i for i in serial if i.endswith(".pdb")]),15)
+        self.assertEqual(files(os.path.join(self.dir,"parallel")),serial)
+
+    def test_extend(self):
+        # Extending a run gives new replicas, not the ones written before
+        self.daft(["-n","2","-seed","3"])
+        self.daft(["-n","2","-seed","3"])
+        replicas = [self.replica(k) for k in range(1,5)]
+        self.assertEqual(len(set(replicas)),4)
+        self.daft(["-n","2","-seed","3"],"again")
+        self.assertEqual([self.replica(k,"again") for k in (1,2)],replicas[:2])
+
+    def test_pack(self):
+        # Packed replicas are extracted to the files written without -pack
+        self.daft(["-n","3","-seed","3","-c","1","-c","2!"],"files")
+        self.daft(["-n","3","-seed","3","-c","1","-c","2!","-pack"],"packed")
+        packed = os.path.join(self.dir,"packed")
+        self.assertFalse(os.path.exists(os.path.join(packed,"0-1","t","t-0001")))
+        self.assertEqual(self.daft(["-unpack","0-1/t/t.pdb","-k","2"],"packed"),self.replica(2,"files"))
+        for combination in ("0","1","0-1"):
+            self.daft(["-unpack",os.path.join(combination,"t","t.pdb")],"packed")
+            for k in (1,2,3):
+                self.assertEqual(self.replica(k,"packed",combination),self.replica(k,"files",combination))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+
+"""Calling DSSP from martinize, with the stand-in script fakedssp"""
+
+import os, shutil, tempfile, unittest, random
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+import martinize
+from gmx.cache import Cache
+
+
+fakedssp = os.path.join(here,"fakedssp")
+
+
+class Chain:
+    def __init__(self,id):
+        self.id = id
+
+
+def backbone(n,seed=1):
+    """Atom list of a chain of n residues with backbone atoms only"""
+    random.seed(seed)
+    return [(name,"ALA",i+1,"A",random.random(),random.random(),random.random())
+            for i in range(n) for name in ("N","CA","C","O")]
+
+
+class TestCallDSSP(unittest.TestCase):
+
+    def setUp(self):
+        self.dir    = tempfile.mkdtemp()
+        self.calls  = os.path.join(self.dir,"calls")
+        self.tmp    = os.path.join(self.dir,"tmp")
+        os.makedirs(self.tmp)
+        os.environ["FAKEDSSP_CALLS"] = self.calls
+        os.environ.pop("FAKEDSSP_FAIL",None)
+        # Temporary directories of the DSSP calls go here, to check cleanup
+        self.tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        self.dsspcache = martinize.dsspcache
+        martinize.dsspcache = Cache(os.path.join(self.dir,"cache"),".ss")
+        martinize._dsspCache.clear()
+
+    def tearDown(self):
+        tempfile.tempdir = self.tempdir
+        martinize.dsspcache = self.dsspcache
+        martinize._dsspCache.clear()
+        os.environ.pop("FAKEDSSP_CALLS",None)
+        os.environ.pop("FAKEDSSP_FAIL",None)
+        shutil.rmtree(self.dir)
+
+    def ncalls(self):
+        return os.path.exists(self.calls) and len(open(self.calls).readlines()) or 0
+
+    def test_result(self):
+        ss = martinize.call_dssp(Chain("A"),backbone(12),fakedssp)
+        self.assertEqual(ss,"HHHHEEEECCTH")
+        self.assertEqual(os.listdir(self.tmp),[])
+
+    def test_cache(self):
+        atoms = backbone(12)
+        ss = martinize.call_dssp(Chain("A"),atoms,fakedssp)
+        # In memory
+        self.assertEqual(martinize.call_dssp(Chain("B"),atoms,fakedssp),ss)
+        self.assertEqual(self.ncalls(),1)
+        # On disk
+        martinize._dsspCache.clear()
+        self.assertEqual(martinize.call_dssp(Chain("A"),atoms,fakedssp),ss)
+        self.assertEqual(self.ncalls(),1)
+        # Other coordinates
+        martinize.call_dssp(Chain("A"),backbone(12,seed=2),fakedssp)
+        self.assertEqual(self.ncalls(),2)
+
+    def test_no_disk_cache(self):
+        # Without DSSPCACHE only the memory cache is used
+        martinize.dsspcache = None
+        atoms = backbone(12)
+        martinize.call_dssp(Chain("A"),atoms,fakedssp)
+        martinize._dsspCache.clear()
+        martinize.call_dssp(Chain("A"),atoms,fakedssp)
+        self.assertEqual(self.ncalls(),2)
+        self.assertFalse(os.path.exists(os.path.join(self.dir,"cache")))
+
+    def test_missing_executable(self):
+        missing = os.path.join(self.dir,"nodssp")
+        self.assertRaises(RuntimeError,martinize.call_dssp,Chain("A"),backbone(5),missing)
+        self.assertEqual(os.listdir(self.tmp),[])
+
+    def test_no_output(self):
+        os.environ["FAKEDSSP_FAIL"] = "1"
+        self.assertRaises(RuntimeError,martinize.call_dssp,Chain("A"),backbone(5),fakedssp)
+        self.assertEqual(os.listdir(self.tmp),[])
+        self.assertFalse(os.path.exists(martinize.dsspcache.directory) and os.listdir(martinize.dsspcache.directory))
+
+    def test_failure_in_pool(self):
+        # A failure in a worker thread must come back, rather than block
+        from multiprocessing.pool import ThreadPool
+        pool   = ThreadPool(2)
+        result = pool.apply_async(martinize.call_dssp,(Chain("A"),backbone(5),os.path.join(self.dir,"nodssp")))
+        self.assertRaises(RuntimeError,result.get,10)
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+
+"""Mapping structures and trajectories to coarse grained beads in martinize"""
+
+import os, sys, random, shutil, tempfile, subprocess, unittest
+
+import martinize
+from bench_batch import helix, martinize as script
+
+
+def residue(resname,names,resid,rng):
+    return [(name,resname,resid,"A",rng.uniform(0,50),rng.uniform(0,50),rng.uniform(0,50)) for name in names]
+
+
+class TestMapping(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(5)
+        self.residues = [residue("SER",["N","CA","C","O","CB","OG"],1,rng),
+                         residue("LYS",["N","H","CA","CB","CG","CD","CE","NZ","C","O"],2,rng),
+                         residue("SER",["N","CA","CB","OG","C","O"],3,rng)]
+
+    def test_residues(self):
+        mass = martinize.CoarseGrained.mass
+        for r,(beads,ids) in zip(self.residues,martinize.mapResidues(self.residues)):
+            mapping = martinize.CoarseGrained.mapping[r[0][1]]
+            self.assertEqual(len(beads),len(mapping))
+            for bead,names,idx in zip(beads,mapping,ids):
+                atoms = [a for a in r if a[0] in names]
+                self.assertEqual([r[i] for i in idx],atoms)
+                w = [mass[a[0][0]] for a in atoms]
+                for k in range(3):
+                    self.assertAlmostEqual(bead[k],sum([i*a[4+k] for i,a in zip(w,atoms)])/sum(w))
+        # Mapping residue by residue gives the same
+        self.assertEqual(martinize.mapResidues(self.residues),[martinize.map(r) for r in self.residues])
+
+    def test_ca2bb(self):
+        beads, ids = martinize.map(self.residues[1],ca2bb=True)
+        for i,j in zip(beads[0],self.residues[1][2][4:7]):
+            self.assertAlmostEqual(i,j)
+        self.assertEqual(ids[0],(2,))
+
+    def test_missing(self):
+        self.assertRaises(ValueError,martinize.mapMatrix,[a for a in self.residues[0] if a[0] not in ("CB","OG")])
+
+    def test_sparse(self):
+        cols, weights = martinize.sparseArrays([[(0,1),(2,3)],[(1,2)],[]])
+        self.assertEqual(cols.tolist(),[[0,2],[1,0],[0,0]])
+        self.assertEqual(weights[:,:,0].tolist(),[[1,3],[2,0],[0,0]])
+        x = [[1,0,0],[0,1,0],[0,0,1]]
+        self.assertEqual(martinize.sparseProduct(cols,weights,martinize.numpy.array(x,dtype=float)).tolist(),
+                         [[1,0,3],[0,2,0],[0,0,0]])
+        # Nothing to map
+        cols, weights = martinize.sparseArrays([])
+        self.assertEqual((cols.shape,weights.shape),((0,0),(0,0,1)))
+        self.assertEqual(martinize.mapResidues([]),[])
+
+
+ligand = """HETATM    1  C1  LIG X   1       0.000   0.000   0.000  1.00  0.00
+HETATM    2  C2  LIG X   1       1.500   0.000   0.000  1.00  0.00
+END
+"""
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def martinize(self,args):
+        p = subprocess.Popen([sys.executable,script]+args,cwd=self.dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode,0,err)
+        return err
+
+    def test_structure(self):
+        # Mapping the input as trajectory gives the coarse grained structure
+        with open(os.path.join(self.dir,"helix.pdb"),"w") as f:
+            f.write(helix(10))
+        self.martinize(["-f","helix.pdb","-ss",10*"H","-x","cg.pdb","-trj","helix.pdb","-ox","traj.pdb","-o","topol.top"])
+        cg   = [i[:54] for i in open(os.path.join(self.dir,"cg.pdb")) if i.startswith("ATOM")]
+        traj = [i[:54] for i in open(os.path.join(self.dir,"traj.pdb")) if i.startswith("ATOM")]
+        self.assertEqual(len(cg),10)
+        self.assertEqual(traj,cg)
+
+    def test_nothing_to_map(self):
+        self.assertEqual(martinize.mapPlan([],[],[]),None)
+        with open(os.path.join(self.dir,"ligand.pdb"),"w") as f:
+            f.write(ligand)
+        err = self.martinize(["-f","ligand.pdb","-trj","ligand.pdb","-ox","out.gro","-o","topol.top"])
+        self.assertTrue("nothing to map" in err)
+        self.assertFalse(os.path.exists(os.path.join(self.dir,"out.gro")))
+
+
+if __name__ == "__main__":
+    unittest.main()
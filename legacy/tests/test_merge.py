@@ -0,0 +1,74 @@
+
+"""Finding the chains to merge in martinize, from merges, links and cystine bridges"""
+
+import random, unittest
+
+import martinize
+
+
+class FakeChain:
+    """A chain with atoms (name, resname, resid) and SG atoms at given positions"""
+
+    def __init__(self,id,atoms=(),sg=()):
+        self.id     = id
+        self._atoms = list(atoms)
+        self.sg     = [{"SG": ("SG","CYS",i+1,id)+tuple(x)} for i,x in enumerate(sg)]
+
+    def atoms(self):
+        return self._atoms
+
+    def __contains__(self,atom):
+        return atom[3] in (None,self.id) and [a for a in self._atoms
+                                              if [i for i,j in zip(atom[:3],a) if i is not None and i != j] == []] != []
+
+    def __getitem__(self,resname):
+        return resname == "CYS" and self.sg or []
+
+
+class TestCheckMerge(unittest.TestCase):
+
+    def chains(self):
+        return [FakeChain(i,[("BB","ALA",1),("BB","LYS",2)]) for i in "ABCDE"]
+
+    def test_none(self):
+        self.assertEqual(martinize.check_merge(self.chains()),([0,1,2,3,4],[[0],[1],[2],[3],[4]]))
+
+    def test_all(self):
+        self.assertEqual(martinize.check_merge(self.chains(),["all"]),([0,1,2,3,4],[[0,1,2,3,4]]))
+
+    def test_merges(self):
+        # Merged chains go first, ordered by their first chain;
+        # chains can be given by identifier or by number
+        order, merges = martinize.check_merge(self.chains(),[["D","B"],["1","5"]])
+        self.assertEqual(merges,[[0,4],[1,3],[2]])
+        self.assertEqual(order,[0,4,1,3,2])
+
+    def test_transitive(self):
+        # Merges sharing a chain, directly or through a link, join into one
+        links = [((None,"LYS",2,"C"),("BB","ALA",1,"E"))]
+        order, merges = martinize.check_merge(self.chains(),[["A","B"],["B","C"]],links)
+        self.assertEqual(merges,[[0,1,2,4],[3]])
+        # A link within a chain does not merge anything
+        links = [((None,"LYS",2,"C"),(None,"ALA",1,"C"))]
+        self.assertEqual(martinize.check_merge(self.chains(),[],links)[1],[[0],[1],[2],[3],[4]])
+
+    def test_cystines(self):
+        chains = self.chains()
+        chains[1].sg = FakeChain("B",sg=[(0,0,0),(40,0,0)]).sg
+        chains[3].sg = FakeChain("D",sg=[(20,0,0),(41,1,0)]).sg
+        chains[4].sg = FakeChain("E",sg=[(0,1,0)]).sg
+        # The second SG of B bridges to D, the first one to E
+        self.assertEqual(martinize.check_merge(chains,ss_cutoff=4)[1],[[1,3,4],[0],[2]])
+        self.assertEqual(martinize.check_merge(chains,ss_cutoff=0.5)[1],[[0],[1],[2],[3],[4]])
+
+    def test_contacts(self):
+        # The grid search finds the same pairs as checking all pairs
+        rng = random.Random(2)
+        sg  = [(i,rng.uniform(-20,20),rng.uniform(-20,20),rng.uniform(-20,20)) for i in range(200)]
+        for cutoff in (4.0,25.0):
+            brute = [(n,m,martinize.distance2(sg[n][1:],sg[m][1:])) for n in range(len(sg)) for m in range(n+1,len(sg))]
+            self.assertEqual(martinize.cysteineContacts(sg,cutoff),[i for i in brute if i[2] <= cutoff])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+
+"""The built-in secondary structure determination in martinize"""
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+import numpy
+
+import martinize
+from bench_batch import helix, martinize as script
+
+
+def place(a,b,c,bond,angle,torsion):
+    """Position of d, given the bond cd, the angle bcd and the torsion abcd"""
+    angle, torsion = numpy.radians(angle), numpy.radians(torsion)
+    bc = (c-b)/numpy.linalg.norm(c-b)
+    n  = numpy.cross(b-a,bc)
+    n /= numpy.linalg.norm(n)
+    m  = numpy.cross(n,bc)
+    return c + bond*(-numpy.cos(angle)*bc + numpy.sin(angle)*(numpy.cos(torsion)*m + numpy.sin(torsion)*n))
+
+
+def backbone(phipsi):
+    """Backbone coordinates (residues, 4, 3) for a list of (phi, psi) angles"""
+    x = []
+    N, CA, C = numpy.array([-1.458,0,0]), numpy.zeros(3), numpy.array([0.55,1.42,0])
+    for k,(phi,psi) in enumerate(phipsi):
+        if k:
+            pN, pCA, pC = N, CA, C
+            N  = place(pN,pCA,pC,1.329,116.2,phipsi[k-1][1])
+            CA = place(pCA,pC,N,1.458,121.7,180)
+            C  = place(pC,N,CA,1.525,111.2,phi)
+        x.append((N,CA,C,place(N,CA,C,1.231,120.5,psi+180)))
+    return numpy.array(x)
+
+
+alpha   = [(-57,-47)]*14
+# Two strands joined by a type II' turn
+hairpin = [(-130,120)]*6 + [(60,-120),(-80,0)] + [(-130,120)]*6
+coil    = [(-70,150),(60,40),(-150,80),(-80,-10),(75,-170),(-60,140),
+           (-120,10),(90,0),(-160,160),(-70,-30),(60,60),(-100,120)]
+
+
+def residues(x,resname="ALA"):
+    """Residues in the martinize atom format for backbone coordinates"""
+    return [[(name,resname,i+1,"A")+tuple(c) for name,c in zip(("N","CA","C","O"),r)] for i,r in enumerate(x)]
+
+
+class TestBackbone(unittest.TestCase):
+
+    def test_residues(self):
+        x   = backbone(alpha[:4])
+        res = residues(x)
+        # Extra atoms, an O1 instead of O, a missing atom and a proline
+        res[0].append(("CB","ALA",1,"A",9.,9.,9.))
+        res[1][3] = ("O1",)+res[1][3][1:]
+        del res[2][1]
+        res[3] = [(a[0],"PRO")+a[2:] for a in res[3]]
+        y, pro = martinize.ssBackbone(res)
+        self.assertEqual(y.shape,(4,4,3))
+        self.assertTrue(numpy.allclose(y[:2],x[:2]))
+        self.assertTrue(numpy.isnan(y[2,1]).all())
+        self.assertTrue(numpy.allclose(y[2,[0,2,3]],x[2,[0,2,3]]))
+        self.assertEqual(pro.tolist(),[False,False,False,True])
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_helix(self):
+        self.assertEqual(martinize.ssFrames(backbone(alpha)[None]),["C"+12*"H"+"C"])
+
+    def test_sheet(self):
+        self.assertEqual(martinize.ssFrames(backbone(hairpin)[None]),["C"+5*"E"+"TT"+5*"E"+"C"])
+
+    def test_coil(self):
+        ss = martinize.ssFrames(backbone(coil)[None])[0]
+        self.assertEqual(len(ss),len(coil))
+        self.assertFalse(set(ss) & set("HGIEB"))
+        self.assertEqual(martinize.ssFrames(backbone([(-130,120)]*8)[None]),[8*"C"])
+
+    def test_proline(self):
+        # Prolines have no amide hydrogen to donate: with every other
+        # residue a proline, there are single turns, but no helix.
+        pro = numpy.zeros(len(alpha),dtype=bool)
+        pro[::2] = True
+        ss = martinize.ssFrames(backbone(alpha)[None],pro)[0]
+        self.assertTrue("T" in ss and not "H" in ss)
+        # Without any, only the bends from the CA trace remain
+        ss = martinize.ssFrames(backbone(alpha)[None],pro|True)[0]
+        self.assertEqual(set(ss),set("CS"))
+
+    def test_chunks(self):
+        # Frames in chunks give the same as all frames at once
+        x = numpy.array([backbone(alpha),backbone(hairpin),backbone(coil+[(-57,-47)]*2)])
+        x[1,3,3] = numpy.nan
+        whole = martinize.ssFrames(x)
+        self.assertEqual(martinize.ssFrames(x,chunk=1),whole)
+        self.assertEqual(whole,martinize._ssChunk(x,numpy.zeros(14,dtype=bool)))
+        self.assertEqual(whole,[martinize.ssFrames(i[None])[0] for i in x])
+
+    def test_break(self):
+        # Strands moved apart do not form a ladder, and a helix broken
+        # in the middle has no hydrogen bonds across the break
+        x = backbone(hairpin)
+        x[8:] += 20
+        self.assertEqual(martinize.ssFrames(x[None])[0],14*"C")
+        y = backbone(alpha)
+        y[7:] += (0,0,10)
+        self.assertFalse("HHHH" in martinize.ssFrames(y[None])[0][5:9])
+
+    def test_short(self):
+        self.assertEqual(martinize._ssChunk(backbone(alpha[:2])[None],numpy.zeros(2,dtype=bool)),["CC"])
+        self.assertEqual(martinize.ssFrames(numpy.zeros((0,5,4,3))),[])
+
+
+class TestConsensus(unittest.TestCase):
+
+    def test_consensus(self):
+        c = martinize.SSConsensus()
+        self.assertEqual(c.consensus(0.5),"")
+        for ss in ("HHEC","HHEC","HTCC","HTEC"):
+            c.add(ss)
+        self.assertEqual(c.frames,4)
+        self.assertEqual(c.counts.sum(),16)
+        # A single type; ties going to the highest code; the cutoff
+        self.assertEqual(c.consensus(0.4),"HTEC")
+        self.assertEqual(c.consensus(0.5),"H EC")
+        self.assertEqual(c.consensus(0.8),"H  C")
+
+    def test_shorter(self):
+        # Only the residues in all frames are kept
+        c = martinize.SSConsensus()
+        c.add("HHHH")
+        c.add("HHE")
+        c.add("HHEEE")
+        self.assertEqual(c.counts.shape,(3,256))
+        self.assertEqual(c.consensus(0.5),"HHE")
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_builtin_trajectory(self):
+        # The secondary structure determined for all frames at once is
+        # also set for the chains of the first frame, used for mapping.
+        model = helix(12).replace("END\n","")
+        with open(os.path.join(self.dir,"mm.pdb"),"w") as f:
+            f.write("MODEL 1\n"+model+"ENDMDL\nMODEL 2\n"+model+"ENDMDL\n")
+        p = subprocess.Popen([sys.executable,script,"-f","mm.pdb","-dssp","builtin","-trj","mm.pdb","-ox","out.gro","-o","topol.top"],
+                             cwd=self.dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode,0,err)
+        lines = open(os.path.join(self.dir,"out.gro")).readlines()
+        self.assertEqual(len(lines),2*(12+3))
+        self.assertEqual(int(lines[1]),12)
@@ -0,0 +1,87 @@
+
+"""Merging topology lists in martinize, with offsets per block, and grouping molecules"""
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+import martinize
+from bench_batch import helix, martinize as script
+
+
+def bonds(pairs,category="BB"):
+    return martinize.CategorizedList([martinize.Bond(atoms=pair,type=1,parameters=(0.35,1250),category=category) for pair in pairs])
+
+
+class TestMerge(unittest.TestCase):
+
+    def test_offsets(self):
+        a = bonds([(1,2),(2,3)])
+        b = bonds([(1,2)])
+        c = bonds([(1,2),(2,3)],category="SC")
+        b.merge(c,2)
+        a.merge(b,3)
+        a.append(martinize.Bond(atoms=(1,9),type=1,parameters=(0.2,None),category="Link"))
+        self.assertEqual([tuple(i.atoms) for i in a.shifted()],[(1,2),(2,3),(4,5),(6,7),(7,8),(1,9)])
+        self.assertEqual([tuple(i.atoms) for i in a.shifted("SC")],[(6,7),(7,8)])
+        self.assertEqual(tuple(a.item(3).atoms),(6,7))
+        self.assertEqual(a.item(-1).atoms,(1,9))
+        # The items themselves are not changed
+        self.assertEqual([i.atoms for i in c],[(1,2),(2,3)])
+        self.assertEqual(a.lines("SC"),[str(i) for i in a.shifted("SC")])
+
+    def test_atoms(self):
+        a = martinize.AtomList([(1,"Qd",1,"LYS","BB",1,1.0,"C"),(2,"C3",1,"LYS","SC1",2,0,"C")])
+        b = martinize.AtomList([(1,"P5",1,"GLY","BB",1,0,"C")])
+        a.merge(b,(2,1,2))
+        self.assertEqual(a.item(-1),(3,"P5",2,"GLY","BB",3,0,"C"))
+        self.assertEqual(len(a.shifted()),3)
+
+    def test_lines(self):
+        a = bonds([(1,2),(2,3)])
+        a.merge(bonds([(1,2)]),3)
+        self.assertEqual(a.lines(test=lambda i: i.atoms[0] == 1),["%s"%a[0],"    4     5      1   0.35000  1250"])
+
+
+def chain(n,chainid,shift):
+    """ATOM lines of a helix of n residues, with the chain identifier set and shifted along x"""
+    return "".join([i[:21]+chainid+i[22:30]+"%8.3f"%(float(i[30:38])+shift)+i[38:]
+                    for i in helix(n).splitlines(True) if i.startswith("ATOM")])
+
+
+class TestMolecules(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Chains A, B and D are the same, C is shorter
+        with open(os.path.join(self.dir,"multi.pdb"),"w") as f:
+            f.write("TER\n".join([chain(10,"A",0),chain(10,"B",30),chain(6,"C",60),chain(10,"D",90)])+"END\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def martinize(self,args):
+        p = subprocess.Popen([sys.executable,script,"-f","multi.pdb","-ss",36*"H","-o","topol.top"]+args,
+                             cwd=self.dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode,0,err)
+        lines = open(os.path.join(self.dir,"topol.top")).read().split("[ molecules ]")[1].splitlines()
+        return [i.split()[0] for i in lines if i.strip() and not i.startswith(";")]
+
+    def itp(self,name):
+        return open(os.path.join(self.dir,name+".itp")).read()
+
+    def test_identical(self):
+        # Identical chains share a moleculetype
+        self.assertEqual(self.martinize([]),["Protein_A","Protein_A","Protein_C","Protein_A"])
+        self.assertEqual(sorted([i for i in os.listdir(self.dir) if i.endswith(".itp")]),["Protein_A.itp","Protein_C.itp"])
+
+    def test_separate(self):
+        # With -sep every chain gets its own moleculetype, which differs
+        # only by name for identical chains
+        self.assertEqual(self.martinize(["-sep"]),["Protein_A","Protein_B","Protein_C","Protein_D"])
+        a, d = self.itp("Protein_A"), self.itp("Protein_D")
+        self.assertEqual(a.replace("Protein_A","Protein_D"),d)
+        self.assertNotEqual(len(a),len(self.itp("Protein_C")))
+
+
+if __name__ == "__main__":
+    unittest.main()